@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark the time (and the heavy modules loaded) for `import weightwatcher`
+
+Each run imports weightwatcher in a fresh interpreter.  Usage:
+
+    python benchmarks/bench_import.py [--runs 10] [--max-seconds 1.0]
+
+Exits with status 1 if the median import time exceeds --max-seconds, 
+or if a framework / plotting / fitting package is loaded at import time"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+# packages that must only be imported on first use
+HEAVY_MODULES = ['tensorflow', 'keras', 'torch', 'matplotlib', 'pandas', 'powerlaw', 'sklearn', 'scipy', 'tqdm']
+
+IMPORT_SCRIPT = """
+import sys, time, json
+t0 = time.perf_counter()
+import weightwatcher
+elapsed = time.perf_counter() - t0
+heavy = [m for m in {heavy} if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+"""
+
+
+def time_import(repo_root):
+    script = IMPORT_SCRIPT.format(heavy=HEAVY_MODULES)
+    out = subprocess.check_output([sys.executable, "-c", script], cwd=repo_root, stderr=subprocess.DEVNULL)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    
+    results = [time_import(repo_root) for _ in range(args.runs)]
+    seconds = np.array([r['seconds'] for r in results])
+    heavy = sorted(set(m for r in results for m in r['heavy']))
+
+    print("import weightwatcher: median {:.3f}s  min {:.3f}s  max {:.3f}s  ({} runs)".format(
+        np.median(seconds), np.min(seconds), np.max(seconds), args.runs))
+    print("heavy modules loaded at import: {}".format(heavy or "none"))
+    
+    failed = len(heavy) > 0
+    if args.max_seconds is not None and np.median(seconds) > args.max_seconds:
+        print("median import time exceeds {}s".format(args.max_seconds))
+        failed = True
+        
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
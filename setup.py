@@ -31,16 +31,18 @@ setup(
     description = ww.__description__,
     long_description = readme,
     long_description_content_type="text/markdown",
-    packages = ["weightwatcher"],
+    packages = ["weightwatcher", "weightwatcher.adapters"],
     include_package_data = True,
     test_suite = 'tests',
     python_requires = ">= 3.3.*",
     install_requires = ['numpy',
                         'matplotlib',
                         'powerlaw',
-                        'tensorflow',
                         'sklearn',
                         'pandas'],
+    # the framework adapters import these lazily, only install the one(s) you use
+    extras_require = {'tensorflow': ['tensorflow'],
+                      'torch': ['torch']},
     entry_points = '''
         [console_scripts]
         weightwatcher=weightwatcher:main
@@ -2,7 +2,8 @@ import unittest
 import warnings
 warnings.simplefilter(action='ignore', category=RuntimeWarning)
 
-import sys, logging
+import sys, os, logging
+import importlib.util
 import weightwatcher as ww
 from weightwatcher import  LAYER_TYPE 
 
@@ -11,6 +12,55 @@ import pandas as pd
 
 #  https://kapeli.com/cheat_sheets/Python_unittest_Assertions.docset/Contents/Resources/Documents/index
 
+
+def small_model(*layers):
+	"""nn.Sequential of the layers, with reproducible weights (torch seed 0), 
+	by default Linear(100, 200), Conv2d(16, 32, 3), Linear(200, 64)
+	"""
+	import torch
+	import torch.nn as nn
+
+	if not layers:
+		layers = [nn.Linear(100, 200), nn.Conv2d(16, 32, 3), nn.Linear(200, 64)]
+	torch.manual_seed(0)
+	for layer in layers:
+		for module in layer.modules():
+			if hasattr(module, 'reset_parameters'):
+				module.reset_parameters()
+	return nn.Sequential(*layers)
+
+
+def write_safetensors(filename, arrays):
+	"""Write the numpy arrays to a safetensors file: 8 byte header size, json header, then the raw tensors
+	"""
+	import json, struct
+	import numpy as np
+
+	dtypes = {np.dtype(np.float32): 'F32', np.dtype(np.float16): 'F16', np.dtype(np.int8): 'I8', np.dtype(np.uint8): 'U8'}
+	header, data = {}, b""
+	for name, W in arrays.items():
+		header[name] = {'dtype': dtypes[W.dtype], 'shape': list(W.shape), 'data_offsets': [len(data), len(data) + W.nbytes]}
+		data += W.tobytes()
+	header = json.dumps(header).encode()
+	with open(filename, 'wb') as f:
+		f.write(struct.pack('<Q', len(header)) + header + data)
+
+
+class SmallModelTest(unittest.TestCase):
+	"""Base class of the tests on a small model (see make_model()), and a watcher of it, built once for the class"""
+
+	@classmethod
+	def make_model(cls):
+		return small_model()
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		cls.model = cls.make_model()
+		cls.watcher = ww.WeightWatcher(model=cls.model, log=False)
+
+
 class Test_VGG11(unittest.TestCase):
 
 	@classmethod
@@ -306,5 +356,1301 @@ class Test_VGG11(unittest.TestCase):
 		
 
 
+class Test_Import(unittest.TestCase):
+
+	def test_import_is_lazy(self):
+		"""Test that import weightwatcher does not load the frameworks, plotting or fitting packages
+		"""
+		import subprocess
+		heavy = ['tensorflow', 'torch', 'matplotlib', 'pandas', 'powerlaw', 'sklearn', 'scipy']
+		script = "import sys, weightwatcher; print([m for m in {} if m in sys.modules])".format(heavy)
+		out = subprocess.check_output([sys.executable, "-c", script]).decode().strip()
+		self.assertEqual(out.splitlines()[-1], "[]", "modules loaded by import weightwatcher: {}".format(out))
+
+
+class Test_Workers(SmallModelTest):
+
+	def test_workers_same_as_serial(self):
+		"""Test that computing the ESDs in worker processes gives the same results as in process
+		"""
+		details = self.watcher.analyze()
+		parallel_details = self.watcher.analyze(workers=2)
+
+		self.assertEqual(len(details), 3)
+		self.assertEqual(list(details.layer_id), list(parallel_details.layer_id))
+		for col in ['num_evals', 'lambda_max', 'alpha', 'log_norm']:
+			for a, b in zip(details[col], parallel_details[col]):
+				self.assertAlmostEqual(a, b, places=6)
+
+	def test_workers_randomize(self):
+		"""Test that the randomized ESD is computed by the workers
+		"""
+		details = self.watcher.analyze(workers=2, randomize=True)
+		self.assertIn('max_rand_eval', details.columns)
+		self.assertTrue((details.max_rand_eval > 0).all())
+
+
+class Test_Catalog(SmallModelTest):
+
+	@classmethod
+	def make_model(cls):
+		import torch.nn as nn
+		return small_model(nn.Sequential(nn.Conv2d(16, 32, 3), nn.ReLU()), nn.Linear(100, 200))
+
+	def test_catalog_lookups(self):
+		"""Test that the catalog indexes the layers by id, qualified name and type, without reading the weights
+		"""
+		from weightwatcher.constants import LAYER_TYPE
+
+		catalog = self.watcher.layer_catalog()
+		self.assertEqual([e.name for e in catalog], ['Sequential', '0', '0.0', '0.1', '1'])
+		self.assertEqual(catalog.get('0.0').layer_id, 2)
+		self.assertIs(catalog.get(4).layer, self.model[1])
+		self.assertEqual([e.layer_id for e in catalog.by_type[LAYER_TYPE.CONV2D]], [2])
+
+		entry = catalog.get('0.0')
+		self.assertEqual((entry.N, entry.M, entry.rf), (32, 16, 9))
+		self.assertEqual(entry.weights().shape, (32, 16, 3, 3))
+		self.assertFalse(catalog.get('0.1').has_weights)
+
+	def test_catalog_is_cached(self):
+		"""Test that the catalog is built once, and the layer types are memoized per class
+		"""
+		import torch.nn as nn
+
+		catalog = self.watcher.layer_catalog()
+		self.watcher.analyze(layers=['1'])
+		self.assertIs(self.watcher.layer_catalog(), catalog)
+		self.assertIsNot(self.watcher.layer_catalog(refresh=True), catalog)
+		self.assertIn(nn.Linear, catalog.adapter.type_cache)
+
+	def test_catalog_model_changed(self):
+		"""Test that the cached catalog is rebuilt when a layer of the model is replaced in place
+		"""
+		import torch.nn as nn
+
+		model = nn.Sequential(nn.Linear(100, 200), nn.Linear(200, 64))
+		watcher = ww.WeightWatcher(model=model, log=False)
+		details = watcher.describe()
+		self.assertEqual((details.N[1], details.M[1]), (200, 64))
+		catalog = watcher.layer_catalog()
+		self.assertIs(watcher.layer_catalog(), catalog)
+
+		model[1] = nn.Linear(200, 300)
+		details = watcher.describe()
+		self.assertEqual((details.N[1], details.M[1]), (300, 200))
+		self.assertIsNot(watcher.layer_catalog(), catalog)
+
+	def test_describe_does_not_read_weights(self):
+		"""Test that describe() only uses the shapes, and never extracts the weights
+		"""
+		adapter = self.watcher.layer_catalog().adapter
+		def extract_spy(layer):
+			raise AssertionError("weights extracted by describe()")
+
+		adapter.get_weights_and_biases = extract_spy
+		try:
+			details = self.watcher.describe()
+			ww2x_details = self.watcher.describe(ww2x=True)
+		finally:
+			del adapter.get_weights_and_biases
+
+		self.assertEqual(list(details.layer_id), [2, 4])
+		self.assertEqual(list(details.num_evals), [16 * 9, 100])
+		self.assertEqual(len(ww2x_details), 9 + 1)
+		self.assertEqual(list(ww2x_details.slice_id), list(range(9)) + [0])
+
+	def test_filter_by_name(self):
+		"""Test filtering and getting the ESD by qualified layer name
+		"""
+		details = self.watcher.analyze(layers=['1'])
+		self.assertEqual(list(details.layer_id), [4])
+		self.assertEqual(list(details.name), ['1'])
+
+		esd = self.watcher.get_ESD(layer='0.0')
+		self.assertEqual(len(esd), 16 * 9)
+		self.assertEqual(len(self.watcher.get_ESD(layer='0.1')), 0)
+
+
+class Test_MaxMemory(SmallModelTest):
+
+	def test_max_memory_same_results(self):
+		"""Test that the memory budgeted mode gives the same results, and reports the peak memory per layer
+		"""
+		details = self.watcher.analyze(randomize=True)
+		bounded_details = self.watcher.analyze(randomize=True, max_memory=10**9)
+
+		self.assertIn('peak_memory', bounded_details.columns)
+		self.assertTrue((bounded_details.peak_memory > 0).all())
+		self.assertTrue((bounded_details.max_rand_eval > 0).all())
+		for col in ['num_evals', 'alpha', 'log_norm']:
+			for a, b in zip(details[col], bounded_details[col]):
+				self.assertAlmostEqual(a, b, places=6)
+
+	def test_max_memory_releases_layers(self):
+		"""Test that the layers are released once their details are computed
+		"""
+		layers = []
+		release_weights = self.watcher.release_weights
+		def release_spy(ww_layer, params):
+			layers.append(ww_layer)
+			return release_weights(ww_layer, params)
+
+		self.watcher.release_weights = release_spy
+		try:
+			self.watcher.analyze(max_memory=10**9)
+		finally:
+			del self.watcher.release_weights
+
+		self.assertEqual(len(layers), 3)
+		for ww_layer in layers:
+			self.assertIsNone(ww_layer.layer)
+			self.assertIsNone(ww_layer.weights)
+			self.assertIsNone(ww_layer.evals)
+			self.assertEqual(ww_layer.Wmats, [])
+
+	def test_max_memory_tracemalloc(self):
+		"""Test that tracemalloc is not started by max_memory, and that it is used, and kept running, if started by the caller
+		"""
+		import tracemalloc
+
+		details = self.watcher.analyze(max_memory=10**9)
+		self.assertFalse(tracemalloc.is_tracing())
+		for N, M, peak in zip(details.N, details.M, details.peak_memory):
+			self.assertTrue(peak >= N * M * 4)
+
+		tracemalloc.start()
+		try:
+			details = self.watcher.analyze(max_memory=10**9)
+			self.assertTrue(tracemalloc.is_tracing())
+		finally:
+			tracemalloc.stop()
+		self.assertTrue((details.peak_memory > 0).all())
+
+	def test_max_memory_workers(self):
+		"""Test that a budget smaller than one layer still computes every layer with workers
+		"""
+		details = self.watcher.analyze()
+		bounded_details = self.watcher.analyze(workers=2, max_memory=1)
+		self.assertEqual(list(details.layer_id), list(bounded_details.layer_id))
+		for a, b in zip(details.alpha, bounded_details.alpha):
+			self.assertAlmostEqual(a, b, places=6)
+
+
+class Test_PyTorchWeights(SmallModelTest):
+
+	@classmethod
+	def make_model(cls):
+		import torch.nn as nn
+		return small_model(nn.Linear(100, 200), nn.Conv2d(16, 32, 3))
+
+	def test_weights_are_views(self):
+		"""Test that the extracted weights share memory with the parameters, and are read only
+		"""
+		import numpy as np
+
+		layers = [l for l in ww.weightwatcher.WWLayerIterator(self.model) if l.has_weights]
+		self.assertEqual(len(layers), 2)
+		for ww_layer, layer in zip(layers, [self.model[0], self.model[1]]):
+			self.assertTrue(np.shares_memory(ww_layer.weights, layer.weight.detach().numpy()))
+			self.assertFalse(ww_layer.weights.flags.writeable)
+			self.assertEqual(ww_layer.weights.dtype, np.float32)
+			self.assertTrue(ww_layer.has_biases)
+
+	def test_conv2D_slices_are_views(self):
+		"""Test that the Conv2D slices are a single (rf, N, M) view of the weights
+		"""
+		import numpy as np
+
+		ww_layer = next(ww.weightwatcher.WWLayerIterator(self.model, filters=[2]))
+		W = self.model[1].weight.detach().numpy()
+
+		self.assertEqual(ww_layer.Wmats.shape, (9, 32, 16))
+		self.assertTrue(np.shares_memory(ww_layer.Wmats, W))
+		for i in range(3):
+			for j in range(3):
+				self.assertTrue(np.array_equal(ww_layer.Wmats[i * 3 + j], W[:, :, i, j]))
+
+	def test_ww2x_slices_share_weights(self):
+		"""Test that the ww2x slices reference the layer and its weights, instead of copying them
+		"""
+		import numpy as np
+
+		slices = list(ww.weightwatcher.WW2xSliceIterator(self.model, filters=[2]))
+		W = self.model[1].weight.detach().numpy()
+
+		self.assertEqual(len(slices), 9)
+		self.assertEqual([s.slice_id for s in slices], list(range(9)))
+		for ww_slice in slices:
+			self.assertIs(ww_slice.layer, self.model[1])
+			self.assertIs(ww_slice.weights, slices[0].weights)
+			self.assertEqual(ww_slice.Wmats.shape, (1, 32, 16))
+			self.assertTrue(np.shares_memory(ww_slice.Wmats, W))
+			self.assertEqual(ww_slice.columns, ['slice_id'])
+
+	def test_conv2d_fft_exact_spectrum(self):
+		"""Test that the conv2d_fft ESD is the spectrum of the (circular) convolution operator
+		"""
+		import numpy as np
+		from weightwatcher.spectrum import conv2D_fft_eigenvalues
+
+		rng = np.random.RandomState(0)
+		O, I, k, n = 4, 3, 3, 5
+		K = rng.normal(size=(O, I, k, k))
+
+		A = np.zeros((O, n, n, I, n, n))
+		for x in range(n):
+			for y in range(n):
+				for i in range(k):
+					for j in range(k):
+						A[:, x, y, :, (x + i) % n, (y + j) % n] += K[:, :, i, j]
+		exact_evals = np.sort(np.linalg.svd(A.reshape(O * n * n, I * n * n), compute_uv=False) ** 2)
+
+		stack = K.transpose(2, 3, 0, 1).reshape(k * k, O, I)
+		params = {'fft_grid': n, 'normalize': False, 'max_evals': 10 ** 6}
+		evals, sv_max, rank_loss = conv2D_fft_eigenvalues(stack, (k, k), O, I, params)
+		self.assertTrue(np.allclose(evals, exact_evals))
+		self.assertAlmostEqual(sv_max ** 2, exact_evals[-1])
+
+	def test_conv2d_fft_analyze(self):
+		"""Test that conv2d_fft subsamples the conv2D ESD to rf x M eigenvalues, in process and with workers
+		"""
+		details = self.watcher.analyze(conv2d_fft=True, fft_grid=8)
+		self.assertEqual(list(details.num_evals), [100, 9 * 16])
+
+		parallel_details = self.watcher.analyze(conv2d_fft=True, fft_grid=8, workers=2)
+		for a, b in zip(details.lambda_max, parallel_details.lambda_max):
+			self.assertAlmostEqual(a, b, places=6)
+
+	def test_filters_before_weights(self):
+		"""Test that the filters are applied before the weights are extracted, so only the layers kept are extracted
+		"""
+		extracted = []
+		layer_iterator = ww.weightwatcher.WWLayerIterator(self.model, filters=[2])
+		get_weights_and_biases = layer_iterator.adapter.get_weights_and_biases
+		def extract_spy(layer):
+			extracted.append(layer)
+			return get_weights_and_biases(layer)
+
+		layer_iterator.adapter.get_weights_and_biases = extract_spy
+		try:
+			layers = list(layer_iterator)
+		finally:
+			del layer_iterator.adapter.get_weights_and_biases
+
+		self.assertEqual([l.layer_id for l in layers], [2])
+		self.assertEqual(extracted, [self.model[1]])
+		self.assertEqual((layers[0].N, layers[0].M, layers[0].rf), (32, 16, 9))
+
+	def test_half_precision(self):
+		"""Test that float16 weights keep their dtype, and give the same alphas as float32
+		"""
+		import copy
+		import numpy as np
+
+		half_model = copy.deepcopy(self.model).half()
+		layers = [l for l in ww.weightwatcher.WWLayerIterator(half_model) if l.has_weights]
+		self.assertEqual(layers[0].weights.dtype, np.float16)
+
+		details = self.watcher.analyze()
+		half_details = ww.WeightWatcher(model=half_model, log=False).analyze()
+		for a, b in zip(details.alpha, half_details.alpha):
+			self.assertAlmostEqual(a, b, places=1)
+
+	def test_bfloat16(self):
+		"""Test that bfloat16 weights, which numpy does not support, are analyzed as float32
+		"""
+		import copy
+		import numpy as np
+		import torch
+
+		bf16_model = copy.deepcopy(self.model).to(torch.bfloat16)
+		layers = [l for l in ww.weightwatcher.WWLayerIterator(bf16_model) if l.has_weights]
+		self.assertEqual(layers[0].weights.dtype, np.float32)
+
+		details = ww.WeightWatcher(model=bf16_model, log=False).analyze()
+		self.assertEqual(len(details), 2)
+
+
+class Test_GroupedConv(SmallModelTest):
+
+	@classmethod
+	def make_model(cls):
+		import torch.nn as nn
+		return small_model(nn.Conv2d(16, 32, 3, groups=4), nn.Conv2d(32, 32, 3, groups=32))
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		import torch
+		import torch.nn as nn
+
+		super().setUpClass()
+
+		# the same convolutions, as dense block diagonal kernels
+		cls.dense_model = nn.Sequential(nn.Conv2d(16, 32, 3), nn.Conv2d(32, 32, 3))
+		with torch.no_grad():
+			for grouped, dense in zip(cls.model, cls.dense_model):
+				g = grouped.groups
+				n, m = grouped.out_channels // g, grouped.in_channels // g
+				dense.weight.zero_()
+				for k in range(g):
+					dense.weight[k*n:(k+1)*n, k*m:(k+1)*m] = grouped.weight[k*n:(k+1)*n]
+
+	def test_grouped_describe(self):
+		"""Test that grouped convolutions report the shape of the whole operator, and their groups
+		"""
+		details = self.watcher.describe()
+		self.assertEqual(list(details.groups), [4, 32])
+		self.assertEqual(list(details.N), [32, 32])
+		self.assertEqual(list(details.M), [16, 32])
+		self.assertEqual(list(details.num_evals), [16 * 9, 32 * 9])
+
+	def test_grouped_esd(self):
+		"""Test that the ESD of a grouped convolution, computed from the blocks, is the ESD of the dense operator
+		"""
+		import numpy as np
+
+		dense_watcher = ww.WeightWatcher(model=self.dense_model, log=False)
+		for layer_id in [1, 2]:
+			evals = self.watcher.get_ESD(layer=layer_id)
+			dense_evals = dense_watcher.get_ESD(layer=layer_id)
+			self.assertEqual(len(evals), len(dense_evals))
+			self.assertTrue(np.allclose(evals, dense_evals))
+
+	def test_grouped_analyze(self):
+		"""Test that grouped convolutions are analyzed in all modes
+		"""
+		details = self.watcher.analyze()
+		self.assertEqual(list(details.num_evals), [16 * 9, 32 * 9])
+
+		fft_details = self.watcher.analyze(conv2d_fft=True)
+		self.assertEqual(list(fft_details.num_evals), [16 * 9, 32 * 9])
+
+		ww2x_details = self.watcher.analyze(ww2x=True)
+		self.assertEqual(len(ww2x_details), 2 * 9)
+		self.assertEqual(list(ww2x_details.num_evals[:9]), [16] * 9)
+
+
+class Test_Checkpoint(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		import tempfile
+		import numpy as np
+		import torch
+		import torch.nn as nn
+
+		cls.model = small_model(nn.Linear(100, 200), nn.Conv2d(16, 32, 3), nn.LayerNorm(32), nn.Linear(200, 64))
+		cls.watcher = ww.WeightWatcher(log=False)
+
+		cls.tmpdir = tempfile.TemporaryDirectory()
+		state_dict = cls.model.state_dict()
+		arrays = {name: t.numpy() for name, t in state_dict.items()}
+
+		cls.files = {}
+		cls.files['pt'] = os.path.join(cls.tmpdir.name, "model.pt")
+		torch.save(state_dict, cls.files['pt'])
+
+		cls.files['npz'] = os.path.join(cls.tmpdir.name, "model.npz")
+		np.savez(cls.files['npz'], **arrays)
+
+		cls.files['safetensors'] = os.path.join(cls.tmpdir.name, "model.safetensors")
+		write_safetensors(cls.files['safetensors'], arrays)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.tmpdir.cleanup()
+
+	def test_describe_checkpoint(self):
+		"""Test that the layers are found from the tensor names and shapes
+		"""
+		for fmt, filename in self.files.items():
+			details = self.watcher.describe(model=filename)
+			self.assertEqual(list(details.name), ['0', '1', '3'], fmt)
+			self.assertEqual(list(details.layer_type), [str(LAYER_TYPE.DENSE), str(LAYER_TYPE.CONV2D), str(LAYER_TYPE.DENSE)], fmt)
+			self.assertEqual(list(details.num_evals), [100, 16*9, 64], fmt)
+
+	def test_analyze_checkpoint(self):
+		"""Test that analyzing a checkpoint file gives the same results as the model
+		"""
+		expected = self.watcher.analyze(model=self.model)
+		for fmt, filename in self.files.items():
+			details = self.watcher.analyze(model=filename)
+			for a, b in zip(expected.alpha, details.alpha):
+				self.assertAlmostEqual(a, b, places=6, msg=fmt)
+
+	def test_checkpoint_is_memory_mapped(self):
+		"""Test that the tensors are memory mapped, not read in memory
+		"""
+		import numpy as np
+		for fmt in ['npz', 'safetensors']:
+			model = self.watcher.load_model(self.files[fmt])
+			W = model.layers[0].weight.load()
+			self.assertIsInstance(W, np.memmap, fmt)
+
+
+@unittest.skipUnless(importlib.util.find_spec("tensorflow"), "tensorflow not installed")
+class Test_KerasCheckpoint(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		import tempfile
+		import tensorflow as tf
+
+		tf.random.set_seed(0)
+		layers = tf.keras.layers
+		cls.model = tf.keras.Sequential([layers.Input((12, 12, 3)), layers.Conv2D(16, 3), layers.Flatten(),
+										 layers.Dense(200), layers.BatchNormalization(), layers.Dense(50)])
+		cls.watcher = ww.WeightWatcher(log=False)
+
+		cls.tmpdir = tempfile.TemporaryDirectory()
+		cls.files = {}
+		cls.files['h5'] = os.path.join(cls.tmpdir.name, "model.h5")
+		cls.model.save(cls.files['h5'])
+		cls.files['weights_h5'] = os.path.join(cls.tmpdir.name, "weights.h5")
+		cls.model.save_weights(cls.files['weights_h5'])
+		cls.files['tf_checkpoint'] = tf.train.Checkpoint(model=cls.model).save(os.path.join(cls.tmpdir.name, "ckpt"))
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.tmpdir.cleanup()
+
+	def test_h5_layer_ids_and_types(self):
+		"""Test that the HDF5 layers match the keras model layers, using the saved model_config
+		"""
+		expected = self.watcher.describe(model=self.model)
+		for fmt in ['h5', 'weights_h5']:
+			details = self.watcher.describe(model=self.files[fmt])
+			self.assertEqual(list(details.layer_id), list(expected.layer_id), fmt)
+			self.assertEqual(list(details.name), list(expected.name), fmt)
+			self.assertEqual(list(details.layer_type), list(expected.layer_type), fmt)
+
+	def test_analyze_keras_checkpoints(self):
+		"""Test that analyzing the HDF5 files and TF checkpoint gives the same results as the model
+		"""
+		expected = self.watcher.analyze(model=self.model)
+		for fmt, filename in self.files.items():
+			details = self.watcher.analyze(model=filename)
+			self.assertEqual(len(details), len(expected), fmt)
+			for a, b in zip(expected.alpha, details.alpha):
+				self.assertAlmostEqual(a, b, places=6, msg=fmt)
+
+	def test_h5_grouped_conv2D(self):
+		"""Test that the groups of the convolutions are read from the model_config of the HDF5 file
+		"""
+		import numpy as np
+		import tensorflow as tf
+
+		layers = tf.keras.layers
+		model = tf.keras.Sequential([layers.Input((12, 12, 16)), layers.Conv2D(32, 3, groups=2)])
+		filename = os.path.join(self.tmpdir.name, "grouped.h5")
+		model.save(filename)
+
+		expected = self.watcher.analyze(model=model)
+		details = self.watcher.analyze(model=filename)
+		for column in ['N', 'M', 'num_evals', 'alpha', 'lambda_max']:
+			self.assertTrue(np.allclose(details[column], expected[column]), msg=column)
+
+
+class Test_Factored(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		import json, tempfile
+		import torch
+		import torch.nn as nn
+
+		class LoraLinear(nn.Module):
+			"""peft style LoRA layer: base layer, and one (A, B) pair of linear layers per adapter"""
+			def __init__(self, in_features, out_features, r, alpha):
+				super().__init__()
+				self.base_layer = nn.Linear(in_features, out_features)
+				self.lora_A = nn.ModuleDict({'default': nn.Linear(in_features, r, bias=False)})
+				self.lora_B = nn.ModuleDict({'default': nn.Linear(r, out_features, bias=False)})
+				self.scaling = {'default': alpha / r}
+				self.active_adapters = ['default']
+
+		cls.model = small_model(LoraLinear(100, 200, 4, 8), nn.Linear(200, 64))
+		lora = cls.model[0]
+		cls.B, cls.A = lora.lora_B['default'].weight.detach().numpy(), lora.lora_A['default'].weight.detach().numpy()
+		cls.scale = 2.0
+
+		# the same model, with the merged weights
+		cls.merged_model = nn.Sequential(nn.Linear(100, 200), nn.Linear(200, 64))
+		cls.merged_model.load_state_dict({'0.weight': lora.base_layer.weight + cls.scale * torch.tensor(cls.B @ cls.A), 
+										  '0.bias': lora.base_layer.bias, '1.weight': cls.model[1].weight, 
+										  '1.bias': cls.model[1].bias})
+
+		cls.watcher = ww.WeightWatcher(model=cls.model, log=False)
+
+		# peft style checkpoints, with and without the base weights, and the adapter_config.json
+		cls.tmpdir = tempfile.TemporaryDirectory()
+		state_dict = {name.replace('.default', ''): t.detach().numpy() for name, t in cls.model.state_dict().items()}
+		adapter_dict = {name: W for name, W in state_dict.items() if 'lora_' in name}
+
+		cls.files = {}
+		for key, arrays in [('model', state_dict), ('adapter', adapter_dict)]:
+			os.mkdir(os.path.join(cls.tmpdir.name, key))
+			with open(os.path.join(cls.tmpdir.name, key, "adapter_config.json"), 'w') as f:
+				json.dump({'r': 4, 'lora_alpha': 8}, f)
+
+			cls.files[key] = os.path.join(cls.tmpdir.name, key, "model.safetensors")
+			write_safetensors(cls.files[key], arrays)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.tmpdir.cleanup()
+
+	def delta_evals(self):
+		import numpy as np
+		sv = np.linalg.svd(self.scale * self.B.astype(np.float64) @ self.A, compute_uv=False)
+		return np.sort(sv * sv)[-4:]
+
+	def test_factored_describe(self):
+		"""Test that the factored layer is one layer, with its rank, and that its parts are not analyzed on their own
+		"""
+		details = self.watcher.describe()
+		self.assertEqual(list(details.name), ['0', '1'])
+		self.assertEqual(details.factor_rank[0], 4)
+		self.assertEqual(list(details.num_evals), [100, 64])
+
+	def test_merged_esd(self):
+		"""Test that the ESD of a factored layer is the ESD of the merged weights W_base + scale B A
+		"""
+		import numpy as np
+		merged_watcher = ww.WeightWatcher(model=self.merged_model, log=False)
+		evals = self.watcher.get_ESD(layer='0')
+		merged_evals = merged_watcher.get_ESD(layer='0')
+		self.assertTrue(np.allclose(evals, merged_evals))
+
+		details = self.watcher.analyze(randomize=False)
+		merged_details = merged_watcher.analyze(randomize=False)
+		for a, b in zip(details.alpha, merged_details.alpha):
+			self.assertAlmostEqual(a, b, places=6)
+
+	def test_delta_esd(self):
+		"""Test that the ESD of the adapter delta is computed from the factors, with only r eigenvalues
+		"""
+		import numpy as np
+		details = self.watcher.analyze(layers=['0'], adapter_delta=True, randomize=False)
+		self.assertEqual(details.num_evals[0], 4)
+		self.assertAlmostEqual(details.lambda_max[0], self.delta_evals()[-1], places=4)
+
+	def test_lora_checkpoint(self):
+		"""Test that the lora_A and lora_B tensors of a checkpoint are grouped into one factored layer, scaled by lora_alpha / r
+		"""
+		expected = self.watcher.analyze(randomize=False)
+		details = self.watcher.analyze(model=self.files['model'], randomize=False)
+		self.assertEqual(list(details.name), ['0', '1'])
+		for a, b in zip(expected.alpha, details.alpha):
+			self.assertAlmostEqual(a, b, places=5)
+
+		# without the base weights, only the delta is analyzed
+		details = self.watcher.analyze(model=self.files['adapter'], randomize=False)
+		self.assertEqual(list(details.name), ['0'])
+		self.assertEqual(details.num_evals[0], 4)
+		self.assertAlmostEqual(details.lambda_max[0], self.delta_evals()[-1], places=4)
+
+
+class Test_Sparse(SmallModelTest):
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		import torch
+		import torch.nn as nn
+
+		super().setUpClass()
+		with torch.no_grad():
+			for layer in [cls.model[0], cls.model[1]]:
+				layer.weight.mul_(torch.rand(layer.weight.shape) > 0.9)
+
+		# the same weights, as a torch sparse tensor
+		cls.sparse_model = nn.Sequential(nn.Linear(100, 200))
+		cls.sparse_model[0].weight = nn.Parameter(cls.model[0].weight.detach().to_sparse())
+
+	def test_sparsity_column(self):
+		"""Test that the sparsity of the weights is reported
+		"""
+		details = self.watcher.analyze()
+		self.assertTrue(details.sparsity[0] > 0.85)
+		self.assertTrue(details.sparsity[1] > 0.85)
+		self.assertEqual(details.sparsity[2], 0)
+		self.assertEqual(list(details.num_evals), [100, 16 * 9, 64])
+
+	def test_sparse_esd(self):
+		"""Test that the ESD of pruned layers, computed from the sparse matrices, is the dense ESD
+		"""
+		import numpy as np
+		from weightwatcher.spectrum import combined_eigenvalues
+		params = {'normalize': False, 'glorot_fix': False, 'conv2d_norm': True}
+
+		W = self.model[0].weight.detach().numpy()
+		expected, _, _ = combined_eigenvalues([W], 200, 100, 100, params)
+		self.assertTrue(np.allclose(self.watcher.get_ESD(layer='0'), expected))
+
+		W = self.model[1].weight.detach().numpy().transpose(2, 3, 0, 1).reshape(9, 32, 16)
+		expected, _, _ = combined_eigenvalues([W], 32, 16, 16, params)
+		self.assertTrue(np.allclose(self.watcher.get_ESD(layer='1'), expected))
+
+	def test_torch_sparse_tensor(self):
+		"""Test that torch sparse weights are analyzed without densifying them
+		"""
+		import numpy as np
+		watcher = ww.WeightWatcher(model=self.sparse_model, log=False)
+		evals = watcher.get_ESD(layer='0')
+		self.assertTrue(np.allclose(evals, self.watcher.get_ESD(layer='0')))
+
+		details = watcher.analyze(randomize=True)
+		self.assertEqual(len(details), 1)
+		self.assertTrue(details.max_rand_eval[0] > 0)
+
+
+class Test_Quantized(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		import tempfile
+		import numpy as np
+		import torch.nn as nn
+
+		cls.model = small_model(nn.Linear(100, 200), nn.Linear(200, 64))
+		cls.watcher = ww.WeightWatcher(log=False)
+
+		# int8 weights, with per output channel scales
+		rng = np.random.default_rng(0)
+		cls.values = rng.integers(-127, 128, size=(200, 100)).astype(np.int8)
+		cls.scale = rng.uniform(0.01, 0.02, size=200)
+		cls.dequantized = cls.values * cls.scale[:, None]
+
+		cls.tmpdir = tempfile.TemporaryDirectory()
+		arrays = {'0.weight': cls.values, '0.weight_scale': cls.scale[:, None].astype(np.float32)}
+		cls.filename = os.path.join(cls.tmpdir.name, "model.safetensors")
+		write_safetensors(cls.filename, arrays)
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.tmpdir.cleanup()
+
+	def test_streaming_gram(self):
+		"""Test that the eigenvalues accumulated over small chunks are the eigenvalues of the dequantized matrix
+		"""
+		import numpy as np
+		from weightwatcher import quantized
+		from weightwatcher.quantized import QuantizedMatrix, gram_eigenvalues
+
+		chunk_bytes = quantized.CHUNK_BYTES
+		quantized.CHUNK_BYTES = 8 * 100 * 7
+		try:
+			for values, scale, axis in [(self.values, self.scale, 0), (self.values.T, self.scale, 1)]:
+				W = QuantizedMatrix(values, scale, axis=axis)
+				expected = np.linalg.svd(W.toarray(np.float64), compute_uv=False) ** 2
+				self.assertTrue(np.allclose(np.sort(gram_eigenvalues(W)), np.sort(expected)))
+		finally:
+			quantized.CHUNK_BYTES = chunk_bytes
+
+	def test_int8_checkpoint(self):
+		"""Test that int8 weights with per channel scales are analyzed without dequantizing them first
+		"""
+		import numpy as np
+		from weightwatcher.quantized import QuantizedMatrix
+
+		model = self.watcher.load_model(self.filename)
+		self.assertEqual(len(model.layers), 1)
+		weights = self.watcher.layer_catalog(self.filename).get('0').weights()
+		self.assertIsInstance(weights, QuantizedMatrix)
+
+		expected = np.sort(np.linalg.svd(self.dequantized, compute_uv=False) ** 2)
+		evals = self.watcher.get_ESD(model=self.filename, layer='0')
+		self.assertTrue(np.allclose(evals, expected))
+
+	def test_quantized_arena(self):
+		"""Test that quantized matrices are passed to the workers in their storage format
+		"""
+		import numpy as np
+		from weightwatcher.arena import WeightArena
+		from weightwatcher.quantized import QuantizedMatrix
+
+		W = QuantizedMatrix(self.values, self.scale)
+		with WeightArena() as arena:
+			block = arena.put([W])
+			# int8 values, float64 scales and zero point
+			self.assertEqual(block.nbytes(), self.values.nbytes + self.scale.nbytes + 8)
+			loaded = block.load()[0]
+			self.assertIsInstance(loaded, QuantizedMatrix)
+			self.assertTrue(np.allclose(loaded.toarray(), W.toarray()))
+
+	def test_torch_quantized_model(self):
+		"""Test that quantized torch modules are analyzed from their int8 weights
+		"""
+		import numpy as np
+		import torch
+		from weightwatcher.quantized import QuantizedMatrix
+
+		if not hasattr(torch.ao.quantization, 'quantize_dynamic'):
+			self.skipTest("torch quantization not available")
+
+		quantized_model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+		layers = [l for l in ww.weightwatcher.WWLayerIterator(quantized_model) if l.has_weights]
+		self.assertEqual(len(layers), 2)
+		self.assertIsInstance(layers[0].weights, QuantizedMatrix)
+
+		W = quantized_model[0].weight().dequantize().numpy()
+		expected = np.sort(np.linalg.svd(W.astype(np.float64), compute_uv=False) ** 2)
+		watcher = ww.WeightWatcher(model=quantized_model, log=False)
+		self.assertTrue(np.allclose(watcher.get_ESD(layer='0'), expected))
+		self.assertEqual(len(watcher.analyze()), 2)
+
+
+class Test_OutOfCore(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		import tempfile
+		import numpy as np
+		from weightwatcher import quantized
+
+		rng = np.random.default_rng(0)
+		cls.embeddings = rng.standard_normal((20000, 32)).astype(np.float32)
+		cls.dense = rng.standard_normal((64, 32)).astype(np.float32)
+
+		cls.tmpdir = tempfile.TemporaryDirectory()
+		cls.filename = os.path.join(cls.tmpdir.name, "model.npz")
+		np.savez(cls.filename, **{'embed.weight': cls.embeddings, 'fc.weight': cls.dense})
+
+		# stream the 2.5MB table (5MB in float64) in chunks of 1000 rows
+		cls.chunk_bytes, cls.out_of_core_bytes = quantized.CHUNK_BYTES, quantized.OUT_OF_CORE_BYTES
+		quantized.CHUNK_BYTES, quantized.OUT_OF_CORE_BYTES = 8 * 32 * 1000, 1 << 20
+		cls.watcher = ww.WeightWatcher(log=False)
+
+	@classmethod
+	def tearDownClass(cls):
+		from weightwatcher import quantized
+		quantized.CHUNK_BYTES, quantized.OUT_OF_CORE_BYTES = cls.chunk_bytes, cls.out_of_core_bytes
+		cls.tmpdir.cleanup()
+
+	def test_out_of_core_threshold(self):
+		"""Test that only the matrices larger than OUT_OF_CORE_BYTES are streamed, memory mapped or not
+		"""
+		import numpy as np
+		from weightwatcher.quantized import is_out_of_core
+
+		# larger than one chunk, but not than OUT_OF_CORE_BYTES
+		filename = os.path.join(self.tmpdir.name, "dense.npy")
+		np.save(filename, np.ones((1000, 64), dtype=np.float32))
+		self.assertFalse(is_out_of_core(np.load(filename, mmap_mode='r')))
+		self.assertFalse(is_out_of_core(self.dense))
+		self.assertTrue(is_out_of_core(self.embeddings))
+
+	def test_streamed_randomization(self):
+		"""Test that the rows of the streamed randomized matrix are mixed across the chunks, as in a full shuffle
+		"""
+		import numpy as np
+		from weightwatcher.quantized import random_gram_eigenvalues
+
+		# the first chunk has the rows with a large norm
+		rng = np.random.default_rng(0)
+		W = rng.standard_normal((8000, 32))
+		W[:1000] *= 10
+		
+		full = []
+		for _ in range(3):
+			Wrand = W.flatten()
+			rng.shuffle(Wrand)
+			full.append(np.max(np.linalg.eigvalsh(Wrand.reshape(W.shape).T @ Wrand.reshape(W.shape))))
+		streamed = np.max(random_gram_eigenvalues(W, rng))
+		self.assertTrue(abs(streamed - np.mean(full)) < 0.1 * np.mean(full), msg="{} {}".format(streamed, full))
+
+	def test_embeddings_on_request(self):
+		"""Test that embeddings are only analyzed when selected
+		"""
+		details = self.watcher.describe(model=self.filename)
+		self.assertEqual(list(details.name), ['fc'])
+
+		details = self.watcher.describe(model=self.filename, layers=[LAYER_TYPE.EMBEDDING])
+		self.assertEqual(list(details.name), ['embed'])
+		self.assertEqual((details.N[0], details.M[0]), (20000, 32))
+
+	def test_streamed_esd(self):
+		"""Test that the memory mapped table is streamed, and that its ESD is the ESD of the whole matrix
+		"""
+		import numpy as np
+		from weightwatcher.quantized import QuantizedMatrix
+
+		catalog = self.watcher.layer_catalog(self.filename)
+		layers = list(ww.weightwatcher.WWLayerIterator(catalog.model, filters=['embed'], catalog=catalog))
+		self.assertTrue(layers[0].out_of_core)
+		self.assertIsInstance(layers[0].Wmats[0], QuantizedMatrix)
+
+		expected = np.sort(np.linalg.svd(self.embeddings.astype(np.float64), compute_uv=False) ** 2)
+		evals = self.watcher.get_ESD(model=self.filename, layer='embed')
+		self.assertTrue(np.allclose(evals, expected))
+
+		details = self.watcher.analyze(model=self.filename, layers=[LAYER_TYPE.EMBEDDING], randomize=True)
+		self.assertEqual(details.num_evals[0], 32)
+		self.assertAlmostEqual(details.lambda_max[0], expected[-1], places=2)
+		self.assertTrue(details.max_rand_eval[0] > 0)
+
+
+class Test_Precision(SmallModelTest):
+
+	def test_float32_precision(self):
+		"""Test that the float32 SVDs give the same results as float64
+		"""
+		details = self.watcher.analyze(randomize=True)
+		for precision in ['float32', 'auto']:
+			float32_details = self.watcher.analyze(randomize=True, precision=precision)
+			for column in ['alpha', 'lambda_max', 'log_spectral_norm']:
+				for a, b in zip(details[column], float32_details[column]):
+					self.assertAlmostEqual(a, b, places=4, msg=precision)
+
+	def test_auto_precision(self):
+		"""Test that precision='auto' recomputes the ESD of ill conditioned matrices in float64
+		"""
+		import numpy as np
+		from weightwatcher.spectrum import combined_eigenvalues
+
+		# singular values from 1 down to 1e-6
+		rng = np.random.default_rng(0)
+		U, _ = np.linalg.qr(rng.standard_normal((200, 100)))
+		V, _ = np.linalg.qr(rng.standard_normal((100, 100)))
+		W = (U * np.logspace(0, -6, 100)) @ V.T
+
+		params = {'normalize': False, 'glorot_fix': False, 'conv2d_norm': True}
+		expected, _, _ = combined_eigenvalues([W], 200, 100, 100, dict(params, precision='float64'))
+		float32_evals, _, _ = combined_eigenvalues([W], 200, 100, 100, dict(params, precision='float32'))
+		auto_evals, _, _ = combined_eigenvalues([W], 200, 100, 100, dict(params, precision='auto'))
+
+		self.assertTrue(np.max(np.abs(float32_evals - expected) / expected) > 1e-4)
+		self.assertTrue(np.allclose(auto_evals, expected, rtol=1e-8, atol=0))
+
+
+class Test_Normalization(SmallModelTest):
+
+	@classmethod
+	def make_model(cls):
+		import torch.nn as nn
+		return small_model(nn.Linear(100, 200), nn.Conv2d(16, 32, 3))
+
+	def test_normalized_eigenvalues(self):
+		"""Test that the eigenvalues are scaled by the norm, as if the matrix was rescaled
+		"""
+		import numpy as np
+
+		W = self.model[0].weight.data.numpy().astype(np.float64)
+		N, M = 200, 100
+		
+		evals = self.watcher.get_ESD(layer=1)
+		self.assertTrue(np.allclose(np.sort(evals), np.sort(np.linalg.svd(W, compute_uv=False)**2)))
+
+		# normalize is also applied by combined_eigenvalues(), as 1/N
+		details = self.watcher.analyze(layers=[1], normalize=True)
+		expected = np.linalg.svd(W / np.sqrt(N), compute_uv=False)**2 / N
+		self.assertAlmostEqual(details.lambda_max[0], np.max(expected))
+		
+		details = self.watcher.analyze(layers=[1], glorot_fix=True)
+		kappa = np.sqrt(2 / (N + M))
+		expected = np.linalg.svd(W / kappa, compute_uv=False)**2
+		self.assertAlmostEqual(details.lambda_max[0] / np.max(expected), 1.0)
+
+	def test_matrices_not_copied(self):
+		"""Test that the weight matrices are not rescaled (or copied) by the normalization
+		"""
+		from weightwatcher.weightwatcher import WWLayerIterator, DEFAULT_PARAMS
+
+		params = dict(DEFAULT_PARAMS, normalize=True, glorot_fix=False, conv2d_norm=True)
+		for ww_layer in WWLayerIterator(self.model, params=params):
+			Wmats = ww_layer.Wmats
+			self.watcher.apply_normalize_Wmats(ww_layer, params)
+			self.assertIs(ww_layer.Wmats, Wmats)
+			self.assertNotEqual(ww_layer.w_norm, 1)
+
+	def test_glorot_check(self):
+		"""Test that the Glorot normalization check is only computed if requested
+		"""
+		details = self.watcher.analyze()
+		self.assertFalse('glorot_check' in details.columns)
+		
+		details = self.watcher.analyze(glorot_check=True)
+		self.assertTrue('glorot_check' in details.columns)
+		self.assertTrue('glorot_ok' in details.columns)
+		self.assertTrue((details.glorot_check > 0).all())
+
+
+class Test_Sweep(SmallModelTest):
+
+	@classmethod
+	def setUpClass(cls):
+		"""I run only once for this class
+		"""
+		super().setUpClass()
+		cls.configs = [{}, {'normalize': True}, {'glorot_fix': True}, {'conv2d_norm': False}]
+
+	def test_sweep(self):
+		"""Test that the sweep gives the same details as analyze() for each config
+		"""
+		sweep_details = self.watcher.analyze_sweep(configs=self.configs)
+		self.assertEqual(len(sweep_details), len(self.configs))
+		
+		for config, details in zip(self.configs, sweep_details):
+			expected = self.watcher.analyze(**config)
+			self.assertEqual(len(details), len(expected))
+			for column in ['alpha', 'lambda_max', 'log_norm', 'log_spectral_norm', 'stable_rank']:
+				for a, b in zip(details[column], expected[column]):
+					self.assertAlmostEqual(a / b, 1.0, places=6, msg="{} {}".format(config, column))
+
+	def test_stacked_sweep(self):
+		"""Test the stacked details of the sweep, with the randomized ESDs
+		"""
+		details = self.watcher.analyze_sweep(configs=self.configs, stacked=True, randomize=True)
+		self.assertEqual(len(details), 3 * len(self.configs))
+		self.assertEqual(list(details.config.unique()), list(range(len(self.configs))))
+		self.assertTrue('max_rand_eval' in details.columns)
+		
+		# the randomized ESD is scaled like the ESD
+		ratio = details.max_rand_eval / details.lambda_max
+		for layer_id in details.layer_id.unique():
+			layer_ratio = ratio[(details.layer_id == layer_id) & (details.config.isin([0, 2]))]
+			self.assertAlmostEqual(layer_ratio.iloc[0], layer_ratio.iloc[1])
+		
+		
+class Test_Params(SmallModelTest):
+
+	def test_frozen_params(self):
+		"""Test that the params of each call are read only, and that the defaults are never changed
+		"""
+		from weightwatcher.weightwatcher import make_params, DEFAULT_PARAMS
+
+		defaults = dict(DEFAULT_PARAMS)
+		self.watcher.analyze(normalize=True, mp_fit=True, max_evals=1000)
+		self.assertEqual(dict(DEFAULT_PARAMS), defaults)
+		
+		params = make_params(normalize=True)
+		self.assertTrue(params['normalize'])
+		with self.assertRaises(TypeError):
+			params['normalize'] = False
+		
+		# describe() does not inherit the params of the previous calls
+		details = self.watcher.describe()
+		self.assertEqual(len(details), 3)
+		
+	def test_concurrent_analyze(self):
+		"""Test that concurrent analyze() calls, with different params, do not change each other's settings
+		"""
+		from concurrent.futures import ThreadPoolExecutor
+
+		options = [{'normalize': True}, {'glorot_fix': True}, {'conv2d_norm': False}, {'min_evals': 100}] * 2
+		expected = [self.watcher.analyze(**kwargs) for kwargs in options]
+		
+		with ThreadPoolExecutor(max_workers=4) as pool:
+			results = list(pool.map(lambda kwargs: self.watcher.analyze(**kwargs), options))
+			
+		for kwargs, details, expected_details in zip(options, results, expected):
+			self.assertEqual(len(details), len(expected_details), msg=kwargs)
+			for a, b in zip(details.lambda_max, expected_details.lambda_max):
+				self.assertAlmostEqual(a, b, msg=kwargs)
+
+
+class Test_Seed(SmallModelTest):
+
+	def test_reproducible(self):
+		"""Test that the randomized ESDs are the same for the same seed, and only for the same seed
+		"""
+		import numpy as np
+
+		details = self.watcher.analyze(randomize=True, seed=42)
+		np.random.seed(0)
+		same_details = self.watcher.analyze(randomize=True, seed=42)
+		other_details = self.watcher.analyze(randomize=True, seed=43)
+		
+		self.assertTrue(np.array_equal(details.max_rand_eval, same_details.max_rand_eval))
+		self.assertFalse(np.array_equal(details.max_rand_eval, other_details.max_rand_eval))
+
+	def test_reproducible_workers(self):
+		"""Test that the randomized ESDs do not depend on the number of workers
+		"""
+		import numpy as np
+
+		details = self.watcher.analyze(randomize=True, mp_fit=True, seed=42)
+		worker_details = self.watcher.analyze(randomize=True, mp_fit=True, seed=42, workers=2)
+		for column in ['max_rand_eval', 'rand_sigma_mp']:
+			self.assertTrue(np.array_equal(details[column], worker_details[column]), msg=column)
+
+	def test_shuf_matrix(self):
+		"""Test that shuf_matrix does not reseed the global numpy random state
+		"""
+		import numpy as np
+		from weightwatcher.RMT_Util import shuf_matrix
+
+		W = np.arange(12.0).reshape(3, 4)
+		self.assertTrue(np.array_equal(shuf_matrix(W, seed=1), shuf_matrix(W, seed=1)))
+		
+		np.random.seed(0)
+		expected = np.random.rand()
+		np.random.seed(0)
+		shuf_matrix(W, seed=1)
+		self.assertEqual(np.random.rand(), expected)
+
+
+class Test_Prefetch(SmallModelTest):
+
+	@classmethod
+	def make_model(cls):
+		import torch.nn as nn
+		return small_model(nn.Linear(100, 200), nn.Conv2d(16, 32, 3), nn.Linear(200, 64), nn.Linear(64, 32))
+
+	def test_prefetch(self):
+		"""Test that prefetching the layers gives the same details
+		"""
+		import numpy as np
+
+		details = self.watcher.analyze(randomize=True, seed=42)
+		for prefetch in [1, 2]:
+			prefetched_details = self.watcher.analyze(randomize=True, seed=42, prefetch=prefetch)
+			self.assertEqual(list(details.layer_id), list(prefetched_details.layer_id))
+			for column in ['alpha', 'lambda_max', 'max_rand_eval']:
+				self.assertTrue(np.allclose(details[column], prefetched_details[column]), msg=column)
+
+	def test_prefetch_thread(self):
+		"""Test that the background thread stops when the generator is closed, and that its errors are raised
+		"""
+		import threading
+		from weightwatcher.weightwatcher import make_params
+
+		def is_running():
+			return any([thread.name == "weightwatcher-prefetch" for thread in threading.enumerate()])
+
+		params = make_params(prefetch=1)
+		layers = self.watcher.prefetch_iter_(iter(range(100)), params)
+		self.assertEqual(next(layers), 0)
+		layers.close()
+		self.assertFalse(is_running())
+		
+		def failing():
+			yield 0
+			raise ValueError("extraction failed")
+		
+		layers = self.watcher.prefetch_iter_(failing(), params)
+		self.assertEqual(next(layers), 0)
+		with self.assertRaises(ValueError):
+			next(layers)
+		self.assertFalse(is_running())
+
+	def test_negative_prefetch(self):
+		"""Test that a negative prefetch is rejected, instead of prefetching all the layers
+		"""
+		with self.assertRaises(ValueError):
+			self.watcher.analyze(prefetch=-1)
+
+
+class Test_Async(SmallModelTest):
+
+	@classmethod
+	def make_model(cls):
+		import torch.nn as nn
+		return small_model(nn.Linear(100, 200), nn.Conv2d(16, 32, 3), nn.Linear(200, 64), nn.Linear(64, 32))
+
+	def test_analyze_async(self):
+		"""Test that analyze_async gives the same details as analyze, without blocking the event loop
+		"""
+		import asyncio
+		import numpy as np
+
+		expected = self.watcher.analyze(randomize=True, seed=42)
+		
+		async def analyze_and_tick():
+			ticks = []
+			async def tick():
+				while True:
+					ticks.append(1)
+					await asyncio.sleep(0.001)
+			ticker = asyncio.ensure_future(tick())
+			details = await self.watcher.analyze_async(randomize=True, seed=42, max_concurrency=2)
+			ticker.cancel()
+			return details, len(ticks)
+		
+		details, ticks = asyncio.run(analyze_and_tick())
+		self.assertEqual(list(details.layer_id), list(expected.layer_id))
+		for column in ['alpha', 'lambda_max', 'max_rand_eval']:
+			self.assertTrue(np.allclose(details[column], expected[column]), msg=column)
+		self.assertTrue(ticks > 1)
+
+	def test_layer_timeout(self):
+		"""Test that the layers which time out are skipped
+		"""
+		import asyncio
+		import time
+		
+		watcher = ww.WeightWatcher(model=self.model, log=False)
+		analyze_layer = watcher.analyze_layer_
+		def slow_analyze_layer(ww_layer, params):
+			if ww_layer.layer_id == 2:
+				time.sleep(1)
+			return analyze_layer(ww_layer, params)
+		watcher.analyze_layer_ = slow_analyze_layer
+		
+		details = asyncio.run(watcher.analyze_async(layer_timeout=0.5))
+		self.assertEqual(list(details.layer_id), [1, 3, 4])
+
+	def test_layer_timeout_concurrency(self):
+		"""Test that a layer which timed out keeps its slot until its thread is done, 
+		so no more than max_concurrency layers run at once
+		"""
+		import asyncio
+		import threading
+		import time
+		
+		watcher = ww.WeightWatcher(model=self.model, log=False)
+		analyze_layer = watcher.analyze_layer_
+		lock = threading.Lock()
+		running, max_running = [0], [0]
+		def slow_analyze_layer(ww_layer, params):
+			with lock:
+				running[0] += 1
+				max_running[0] = max(max_running[0], running[0])
+			try:
+				time.sleep(1 if ww_layer.layer_id in [1, 2] else 0.1)
+				return analyze_layer(ww_layer, params)
+			finally:
+				with lock:
+					running[0] -= 1
+		watcher.analyze_layer_ = slow_analyze_layer
+		
+		details = asyncio.run(watcher.analyze_async(layer_timeout=0.5, max_concurrency=1))
+		self.assertEqual(list(details.layer_id), [3, 4])
+		self.assertEqual(max_running[0], 1)
+
+	def test_cancel(self):
+		"""Test that the analysis can be cancelled, after the first layers
+		"""
+		import asyncio
+
+		async def cancel_after_first_layer():
+			rows = []
+			async def consume():
+				async for row in self.watcher.analyze_iter_async():
+					rows.append(row)
+					await asyncio.sleep(10)
+			task = asyncio.ensure_future(consume())
+			while not rows:
+				await asyncio.sleep(0.01)
+			task.cancel()
+			with self.assertRaises(asyncio.CancelledError):
+				await task
+			return rows
+		
+		rows = asyncio.run(cancel_after_first_layer())
+		self.assertEqual(len(rows), 1)
+
+
+class Test_TimeBudget(SmallModelTest):
+
+	@classmethod
+	def make_model(cls):
+		import torch.nn as nn
+		return small_model(nn.Linear(100, 200), nn.Conv2d(16, 32, 3), nn.Linear(400, 300), nn.Linear(64, 32))
+
+	def test_priority(self):
+		"""Test the order the layers are analyzed in, and that the details are in the layer order
+		"""
+		from weightwatcher.weightwatcher import WWLayerIterator, make_params
+		from weightwatcher.constants import PRIORITY
+
+		details = self.watcher.analyze()
+		orders = [(PRIORITY.LARGEST, [3, 1, 2, 4]), (PRIORITY.SMALLEST, [4, 2, 1, 3]), ({4: 2.0, 2: 1.0}, [4, 2, 1, 3])]
+		for priority, expected in orders:
+			params = make_params(priority=priority)
+			layers = WWLayerIterator(self.model, params=params, metadata_only=True)
+			order = [ww_layer.layer_id for ww_layer in self.watcher.prioritized_iter_(layers, params)]
+			self.assertEqual(order, expected, msg=priority)
+			
+			prioritized_details = self.watcher.analyze(priority=priority)
+			self.assertEqual(list(prioritized_details.layer_id), list(details.layer_id))
+			self.assertEqual(list(prioritized_details.alpha), list(details.alpha))
+		
+	def test_time_budget(self):
+		"""Test that the layers are skipped once the time budget is spent
+		"""
+		import time
+
+		watcher = ww.WeightWatcher(model=self.model, log=False)
+		apply_esd = watcher.apply_esd
+		def slow_apply_esd(ww_layer, params):
+			time.sleep(0.5)
+			return apply_esd(ww_layer, params)
+		watcher.apply_esd = slow_apply_esd
+		
+		details = watcher.analyze(time_budget=0.8, priority='largest')
+		self.assertTrue(len(details) < 4)
+		self.assertTrue(3 in list(details.layer_id))
+		self.assertEqual(sorted(list(details.layer_id) + watcher.get_skipped_layers()), [1, 2, 3, 4])
+		
+		details = watcher.analyze(time_budget=100)
+		self.assertEqual(len(details), 4)
+		self.assertEqual(watcher.get_skipped_layers(), [])
+
+	def test_time_budget_first_layer(self):
+		"""Test that a layer too large for the time budget is skipped, even if it is the first one
+		"""
+		import torch.nn as nn
+
+		model = nn.Sequential(nn.Linear(4000, 4000), nn.Linear(100, 50))
+		watcher = ww.WeightWatcher(model=model, log=False)
+		details = watcher.analyze(time_budget=1.0, priority='largest')
+		self.assertEqual(list(details.layer_id), [2])
+		self.assertEqual(watcher.get_skipped_layers(), [1])
+
+	def test_svd_rate(self):
+		"""Test that the SVD rate is timed once per watcher
+		"""
+		from unittest import mock
+
+		watcher = ww.WeightWatcher(model=self.model, log=False)
+		watcher.analyze(time_budget=100)
+		rate = watcher.svd_rate
+		self.assertTrue(rate > 0)
+		with mock.patch('numpy.linalg.svd', side_effect=AssertionError("timed again")):
+			self.assertEqual(watcher.svd_rate_(), rate)
+
+	def test_time_budget_prefetch_workers(self):
+		"""Test that the time budget holds when the layers are extracted ahead, or computed in the workers
+		"""
+		import time
+		import torch.nn as nn
+
+		model = nn.Sequential(*[nn.Linear(200, 200) for _ in range(24)])
+		layer_ids = list(range(1, 25))
+		watcher = ww.WeightWatcher(model=model, log=False)
+		apply_spectral_metrics = watcher.apply_spectral_metrics
+		def slow_apply_spectral_metrics(ww_layer, params):
+			time.sleep(1.0)
+			return apply_spectral_metrics(ww_layer, params)
+		watcher.apply_spectral_metrics = slow_apply_spectral_metrics
+		
+		time_budget = 1.5
+		for options in [{'prefetch': 2}, {'workers': 2}]:
+			start = time.monotonic()
+			details = watcher.analyze(time_budget=time_budget, **options)
+			elapsed = time.monotonic() - start
+			
+			# at most one layer is finished after the deadline
+			self.assertTrue(elapsed < time_budget + 2.5, msg="{} {}s".format(options, elapsed))
+			self.assertTrue(len(watcher.get_skipped_layers()) > 0, msg=options)
+			self.assertEqual(sorted(list(details.layer_id) + watcher.get_skipped_layers()), layer_ids, msg=options)
+
+
 if __name__ == '__main__':
 	unittest.main()
@@ -8,18 +8,9 @@ import warnings
 
 
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-import pandas as pd
 
-import scipy as sp
-from scipy.linalg import svd
-
-from scipy import optimize
-from sklearn.neighbors import KernelDensity
-
-import powerlaw
-import tqdm
+# matplotlib, scipy, sklearn and tqdm are only needed by some of the functions below, 
+# and are slow to import, so they are imported on first use
 
 # ## Generalized Entropy
 
@@ -27,6 +18,7 @@ import tqdm
 # Trace Normalization
 def matrix_entropy(W):
     """Matrix entropy of W real rectangular matrix, computed using the singular values; may be slow"""
+    from scipy.linalg import svd
     W = W / np.trace(W)
     m = W.shape[1]
     u, sv, vh = svd(W)
@@ -100,8 +92,10 @@ def hard_rank(W, sv):
 
 
 # uss FAST SVD method: notice we miss 1 eigenvalue here...using 
-def get_shuffled_eigenvalues(W, layer=7, num=100):
-    "get eigenvalues for this model, but shuffled, num times"
+def get_shuffled_eigenvalues(W, layer=7, num=100, seed=None):
+    "get eigenvalues for this model, but shuffled, num times, with independent random streams derived from seed"
+    from scipy.linalg import svd
+    from tqdm import tqdm
     
     print("get_shuffled_eigenvalues")
     N, M = W.shape[0], W.shape[1]       
@@ -110,9 +104,10 @@ def get_shuffled_eigenvalues(W, layer=7, num=100):
         N, M = W.shape[1], W.shape[0] 
    
     eigenvalues = []
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(num)]
     for idx in tqdm(range(num)):
         W_shuf = W.flatten()
-        np.random.shuffle(W_shuf)
+        rngs[idx].shuffle(W_shuf)
         W_shuf = W_shuf.reshape([N, M])
 
         u, sv, vh = svd(W_shuf)
@@ -145,6 +140,7 @@ def plot_density_and_fit(eigenvalues=None, model=None, layer="",
         title = " W{} ESD, MP Sigma={:0.3}f" 
         
     if plot:
+        import matplotlib.pyplot as plt
         plt.hist(to_fit, bins=100, alpha=alpha, color=color, density=True, label=label);
         plt.legend()
     
@@ -170,6 +166,7 @@ def plot_density_and_fit(eigenvalues=None, model=None, layer="",
         x, mp = marchenko_pastur_pdf(x_min, x_max, Q, sigma)
 
     if plot:
+        import matplotlib.pyplot as plt
         plt.title(title.format(layer, sigma))
         plt.plot(x, mp, linewidth=1, color='r', label="MP fit")
         
@@ -184,6 +181,7 @@ def plot_density(to_plot, sigma, Q, method="MP"):
     """Method = 'MP' or 'QC'
     
     """
+    import matplotlib.pyplot as plt
     to_plot = np.sort(to_plot)
     x_min, x_max = 0, np.max(to_plot)
     
@@ -213,6 +211,7 @@ def matrix_eigenvalues(model, layer=2):
 
 # TODO: refactor
 def scree_plot(model, weightfile, layer=2, color='blue', label=''):    
+    import matplotlib.pyplot as plt
     model.load_weights(weightfile)
     evs = matrix_eigenvalues(model, layer)
     eigvals = np.flip(np.sort(evs), axis=0)
@@ -231,6 +230,7 @@ def stable_rank(evals):
 def matrix_soft_rank(W):
     """compute the matrix soft rank (or stable rank), given rectangular numpy matrix W""
     See:  https://arxiv.org/abs/1810.01075 """ 
+    from scipy.linalg import svd
     W = W / np.trace(W)
     u, sv, vh = svd(W)
     return stable_rank(sv * sv)
@@ -299,11 +299,13 @@ def discrete_entropy(vec, num_bins=100):
     return entropy
 
 
-def max_discrete_entropy(len_vec, num_bins=100, sample_size=100000):
+def max_discrete_entropy(len_vec, num_bins=100, sample_size=100000, seed=None):
     """compute maximum possible entropy for this numpy vector length and bin sizes"""
+    from tqdm import tqdm
+    rng = np.random.default_rng(seed)
     entropies = []
     for i in tqdm(range(sample_size)):
-        test_vec = np.random.normal(0, 1, len_vec)
+        test_vec = rng.normal(0, 1, len_vec)
         s = discrete_entropy(test_vec, num_bins=num_bins)
         entropies.append(s)
 
@@ -398,6 +400,7 @@ def quarter_circle_fun(x, sigma=1):
 
 def resid_mp(p, evals, Q, bw, allresid=True, num_spikes=0, debug=False):  
     "residual that floats sigma but NOT Q or num_spikes YET, 10% cutoff each edge"
+    from sklearn.neighbors import KernelDensity
     sigma = p
 
 #    if (sigma > 1): #sigma must be less than 1
@@ -431,6 +434,7 @@ def resid_mp(p, evals, Q, bw, allresid=True, num_spikes=0, debug=False):
     #     resid = np.nan_to_num(resid)
     
     if debug:
+        import matplotlib.pyplot as plt
         plt.plot(xde, yde)
         plt.plot(xmp, ymp)
         plt.show()
@@ -449,16 +453,16 @@ def shuf_matrix(W, seed=None):
     n, m = w.shape    
     w_flat = w.flatten()
 
-    if seed is not None:
-        np.random.seed(seed)  # for reproduction
-
-    w_shuf = np.random.choice(w_flat, size=int(n * m)).reshape((n, m))
+    # a local generator, the global numpy random state is not reseeded
+    rng = np.random.default_rng(seed)
+    w_shuf = rng.choice(w_flat, size=int(n * m)).reshape((n, m))
     
     return w_shuf
 
 
 def fit_density(evals, Q, bw=0.1, sigma0=None):
     "Fit the esd to a MP distribution: simple fit of evals, only floats sigma right now"
+    from scipy import optimize
     
     if sigma0 is None:
         sigma0 = 1.0
@@ -474,6 +478,7 @@ def fit_density(evals, Q, bw=0.1, sigma0=None):
 
 
 def fit_density_with_range(evals, Q, bw=0.1, sigma_range=(slice(0.3, 1.05, 0.1),)):
+    from scipy import optimize
     
     assert type(sigma_range) == tuple, ValueError("sigma_range must be tuple")
     assert type(sigma_range[0]) == slice
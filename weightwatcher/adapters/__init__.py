@@ -0,0 +1,87 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Framework adapters
+
+The adapter for a model is selected by inspecting the model object, and its module 
+(which imports the framework, i.e. torch or tensorflow) is only loaded at that point.  
+This keeps `import weightwatcher` fast, and lets numpy or PyTorch only users run without tensorflow installed."""
+
+import importlib
+
+from ..constants import FRAMEWORK
+from .base import FrameworkAdapter, logger
+
+# framework -> (adapter module, adapter class), loaded lazily
+ADAPTERS = {
+    FRAMEWORK.PYTORCH: ('.pytorch', 'PyTorchAdapter'),
+    FRAMEWORK.KERAS: ('.keras', 'KerasAdapter'),
+    FRAMEWORK.CHECKPOINT: ('.checkpoint', 'CheckpointAdapter'),
+}
+
+# top level package of the model class -> framework
+MODULE_FRAMEWORKS = {
+    'torch': FRAMEWORK.PYTORCH,
+    'tensorflow': FRAMEWORK.KERAS,
+    'keras': FRAMEWORK.KERAS,
+    'tf_keras': FRAMEWORK.KERAS,
+}
+
+# module of the model class -> framework, for the models defined by weightwatcher itself
+MODEL_MODULES = {
+    __name__ + '.checkpoint': FRAMEWORK.CHECKPOINT,
+}
+
+_adapters = {}
+
+
+def model_framework(model):
+    """Detect the framework of a model from its class hierarchy, without importing any framework"""
+    
+    for cls in type(model).__mro__:
+        module = cls.__module__ or ""
+        if module in MODEL_MODULES:
+            return MODEL_MODULES[module]
+        
+        package = module.split('.')[0]
+        if package in MODULE_FRAMEWORKS:
+            return MODULE_FRAMEWORKS[package]
+        
+    # duck typing, i.e. for wrappers of framework models
+    if hasattr(model, 'layers'):
+        return FRAMEWORK.KERAS
+    elif hasattr(model, 'modules'):
+        return FRAMEWORK.PYTORCH
+    
+    return FRAMEWORK.UNKNOWN
+
+
+def framework_adapter(framework):
+    """Return the (cached) adapter for the framework, or None if the framework is not supported"""
+    
+    if framework not in ADAPTERS:
+        return None
+    
+    if framework not in _adapters:
+        module_name, class_name = ADAPTERS[framework]
+        logger.debug("loading {} adapter".format(framework.name))
+        module = importlib.import_module(module_name, __name__)
+        _adapters[framework] = getattr(module, class_name)()
+        
+    return _adapters[framework]
+
+
+def get_adapter(model):
+    """Return the adapter for this model, or None if the framework is not supported"""
+    return framework_adapter(model_framework(model))
@@ -0,0 +1,120 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Base class for the framework adapters"""
+
+import logging
+
+from ..constants import LAYER_TYPE, FRAMEWORK, CHANNELS
+
+logger = logging.getLogger('weightwatcher')
+
+
+class FrameworkAdapter:
+    """Framework specific parts of weightwatcher: iterate over the layers of a model, 
+    determine the LAYER_TYPE of a layer, and extract its weights and biases (as numpy arrays)"""
+    
+    framework = FRAMEWORK.UNKNOWN
+    channels = CHANNELS.UNKNOWN
+    
+    # True if the LAYER_TYPE only depends on the class of the layer, so it can be memoized per class
+    types_by_class = True
+    
+    def __init__(self):
+        self.type_cache = {}
+    
+    def iter_layers(self, model):
+        """Return a generator over the framework layers of the model"""
+        raise NotImplementedError
+    
+    def iter_named_layers(self, model):
+        """Return a generator over the (name, layer) pairs of the model"""
+        for layer in self.iter_layers(model):
+            yield getattr(layer, 'name', None), layer
+    
+    def layer_type(self, layer):
+        """Given a framework layer, determine the weightwatcher LAYER_TYPE"""
+        return self.infer_layer_type(layer)
+    
+    def cached_layer_type(self, layer):
+        """layer_type(), memoized per layer class when possible"""
+        
+        if not self.types_by_class:
+            return self.layer_type(layer)
+        
+        cls = type(layer)
+        if cls not in self.type_cache:
+            self.type_cache[cls] = self.layer_type(layer)
+        return self.type_cache[cls]
+    
+    def infer_layer_type(self, layer):
+        """Try to infer the LAYER_TYPE from the class name (i.e for huggingface)"""
+
+        the_type = LAYER_TYPE.UNKNOWN
+        typestr = (str(type(layer))).lower()
+        
+        if typestr.endswith(".linear'>"):
+            the_type = LAYER_TYPE.DENSE
+            
+        elif typestr.endswith(".dense'>"):
+            the_type = LAYER_TYPE.DENSE
+            
+        elif typestr.endswith(".conv1d'>"):
+            the_type = LAYER_TYPE.CONV1D
+            
+        elif typestr.endswith(".conv2d'>"):
+            the_type = LAYER_TYPE.CONV2D
+        
+        return the_type
+    
+    def layer_groups(self, layer):
+        """number of groups of a (grouped or depthwise) convolution, 1 otherwise"""
+        groups = getattr(layer, 'groups', 1)
+        if isinstance(groups, int) and groups > 1:
+            return groups
+        return 1
+    
+    def layer_channels(self, layer):
+        """channels layout (first or last) of the conv2D weights of the layer, the layout of the framework by default"""
+        return self.channels
+    
+    def layer_factors(self, layer):
+        """low rank factors of a factored (i.e. LoRA) layer, as a list of (B, A, scale) numpy arrays, 
+        where the effective weights are W = W_base + sum scale B A, or None if the layer is not factored"""
+        return None
+    
+    def factors_rank(self, layer):
+        """total rank r of the low rank factors of the layer, 0 if it is not factored.  Does not read the factors"""
+        return 0
+    
+    def get_weights_and_biases(self, layer):
+        """extract the original weights (as a tensor) for the layer, and biases for the layer, if present
+        returns has_weights, weights, has_biases, biases"""
+        raise NotImplementedError
+    
+    def weights_shape(self, layer):
+        """shape of the weights of the layer, or None if it has no weights.  
+        Adapters should override this to read the shape without extracting the weights"""
+        has_weights, weights, _, _ = self.get_weights_and_biases(layer)
+        if not has_weights:
+            return None
+        return tuple(weights.shape)
+    
+    def load_model(self, filename):
+        """load a model from a file"""
+        raise NotImplementedError("can not load {} models from file".format(self.framework.name))
+    
+    def versions(self):
+        """(name, version) of the framework packages, for the banner"""
+        return []
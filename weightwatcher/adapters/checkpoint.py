@@ -0,0 +1,458 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Checkpoint adapter: analyze the weights stored in a file, without building the model
+
+Supported formats are PyTorch state_dict archives (.pt, .pth, .bin, .ckpt), numpy .npz archives, 
+safetensors files, and Keras HDF5 files and TF checkpoints (see keras_checkpoint.py).  The tensors are memory mapped, and each one is only read when its layer is analyzed, 
+so a checkpoint larger than RAM can be analyzed layer by layer.
+
+The layers are the tensor names, with the .weight / .bias (or /kernel, /bias) suffix removed, 
+and their LAYER_TYPE is inferred from the shape of the weight tensor."""
+
+import os
+import re
+import json
+import struct
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+from ..constants import LAYER_TYPE, FRAMEWORK, CHANNELS
+from ..quantized import QuantizedMatrix, QUANTIZATION
+from .base import FrameworkAdapter, logger
+from .keras_checkpoint import H5_EXTENSIONS, h5_layers, is_tf_checkpoint, tf_checkpoint_layers
+
+SAFETENSORS_EXTENSIONS = ['.safetensors']
+NPZ_EXTENSIONS = ['.npz']
+PYTORCH_EXTENSIONS = ['.pt', '.pth', '.bin', '.ckpt']
+
+CHECKPOINT_EXTENSIONS = SAFETENSORS_EXTENSIONS + NPZ_EXTENSIONS + PYTORCH_EXTENSIONS + H5_EXTENSIONS
+
+WEIGHT_SUFFIXES = ['weight', 'kernel', 'embeddings']
+BIAS_SUFFIXES = ['bias']
+
+# per channel (or per tensor) scales and zero points of int8 weights, W = (weight - zero_point) * scale.
+# SCB (bitsandbytes) is the absmax of each row, W = weight * SCB / 127
+SCALE_SUFFIXES = ['weight_scale', 'weight_scales', 'scales', 'SCB']
+ZERO_POINT_SUFFIXES = ['weight_zero_point', 'zero_points']
+
+# LoRA factors (peft naming): prefix.lora_A[.adapter], prefix.lora_B[.adapter]
+LORA_PATTERN = re.compile(r'^(.*)\.lora_(A|B)(\.[^.]+)?$')
+LORA_CONFIG = "adapter_config.json"
+
+SAFETENSORS_DTYPES = {'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 'BF16': np.uint16,
+                      'I64': np.int64, 'I32': np.int32, 'I16': np.int16, 'I8': np.int8, 'U8': np.uint8,
+                      'BOOL': np.bool_}
+
+
+def is_checkpoint_file(filename):
+    """True if the file extension is one of the supported checkpoint formats, or filename is a TF checkpoint"""
+    return os.path.splitext(filename)[1].lower() in CHECKPOINT_EXTENSIONS or is_tf_checkpoint(filename)
+
+
+def bfloat16_to_float32(raw):
+    """Convert raw bfloat16 bits (as uint16) to float32"""
+    return (np.asarray(raw).astype(np.uint32) << 16).view(np.float32)
+
+
+def bfloat16_weights(raw):
+    """bfloat16 matrices are kept as raw bits, and dequantized chunk by chunk, other tensors are converted to float32"""
+    if raw.ndim == 2:
+        return QuantizedMatrix(raw, kind=QUANTIZATION.BF16)
+    return bfloat16_to_float32(raw)
+
+
+class TensorRef:
+    """Lazy reference to one tensor in a checkpoint file. load() memory maps (or reads) the tensor"""
+    
+    def __init__(self, name, shape, dtype, loader):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.loader = loader
+        
+    def load(self):
+        return self.loader()
+    
+    def __repr__(self):
+        return "TensorRef({}, {}, {})".format(self.name, self.shape, self.dtype)
+
+
+class TensorLayer:
+    """A layer of a checkpoint: a weight tensor and, optionally, its bias, found by tensor name"""
+    
+    def __init__(self, name, weight=None, bias=None, the_type=None, factors=None):
+        self.name = name
+        self.weight = weight
+        self.bias = bias
+        self.the_type = the_type  # if known, i.e. from the Keras model_config
+        self.groups = 1  # groups of grouped conv2D layers, if known, i.e. from the Keras model_config
+        self.channels = None  # channels layout of the weights, if not that of the checkpoint (i.e. Keras kernels)
+        self.factors = factors  # LoRA factors, list of (B, A, scale), with B and A TensorRefs
+        self.scale = None  # scales and zero points of int8 weights
+        self.zero_point = None
+        self.scale_suffix = None
+        
+    @property
+    def shape(self):
+        if self.weight is not None:
+            return self.weight.shape
+        if self.factors:
+            B, A, scale = self.factors[0]
+            return (B.shape[0], A.shape[1])
+        return ()
+    
+    def __repr__(self):
+        return "TensorLayer({}, {})".format(self.name, self.shape)
+
+
+def split_tensor_name(key):
+    """Split a tensor name into (layer name, suffix), i.e. 'features.0.weight' -> ('features.0', 'weight')"""
+    
+    # keras style names may have a :0 suffix
+    key = key.split(':')[0]
+    for sep in ['.', '/']:
+        if sep in key:
+            prefix, suffix = key.rsplit(sep, 1)
+            if suffix in WEIGHT_SUFFIXES + BIAS_SUFFIXES + SCALE_SUFFIXES + ZERO_POINT_SUFFIXES:
+                return prefix, suffix
+    return key, None
+
+
+def group_tensors(refs):
+    """Group the tensor refs by layer, keeping the order of the checkpoint"""
+    
+    layers = OrderedDict()
+    for ref in refs:
+        name, suffix = split_tensor_name(ref.name)
+        if suffix in BIAS_SUFFIXES:
+            layers.setdefault(name, TensorLayer(name)).bias = ref
+        elif suffix in WEIGHT_SUFFIXES:
+            layers.setdefault(name, TensorLayer(name)).weight = ref
+        elif suffix in SCALE_SUFFIXES:
+            layer = layers.setdefault(name, TensorLayer(name))
+            layer.scale, layer.scale_suffix = ref, suffix
+        elif suffix in ZERO_POINT_SUFFIXES:
+            layers.setdefault(name, TensorLayer(name)).zero_point = ref
+        else:
+            # a tensor that is not a weight or a bias, i.e. a position embedding
+            layers[ref.name] = TensorLayer(ref.name, weight=ref)
+            
+    return list(layers.values())
+
+
+def as_array(W):
+    """Dequantized (float32) array of a QuantizedMatrix, W otherwise"""
+    return W.toarray() if isinstance(W, QuantizedMatrix) else W
+
+
+def lora_scale(filename):
+    """LoRA scaling (lora_alpha / r), from the adapter_config.json next to the checkpoint, 1.0 if not found"""
+    
+    config_file = os.path.join(os.path.dirname(os.path.abspath(filename)), LORA_CONFIG)
+    if not os.path.isfile(config_file):
+        return 1.0
+    
+    with open(config_file) as f:
+        config = json.load(f)
+    r, alpha = config.get('r'), config.get('lora_alpha')
+    if not r or not alpha:
+        return 1.0
+    if config.get('use_rslora'):
+        return alpha / np.sqrt(r)
+    return alpha / r
+
+
+def group_lora_factors(layers, scale=1.0):
+    """Merge the lora_A and lora_B layers of a LoRA checkpoint into one factored layer per adapted layer, 
+    together with the base layer weights if they are in the checkpoint (prefix.base_layer or prefix)"""
+    
+    by_name = {layer.name: layer for layer in layers}
+    adapters = OrderedDict()
+    for layer in layers:
+        match = LORA_PATTERN.match(layer.name)
+        if match and layer.weight is not None:
+            prefix, which, adapter = match.group(1), match.group(2), match.group(3)
+            adapters.setdefault(prefix, OrderedDict()).setdefault(adapter, {})[which] = layer
+            
+    # the factored layer replaces its parts, at the position of the first one
+    replaced = {}
+    for prefix, pairs in adapters.items():
+        factors = [(pair['B'].weight, pair['A'].weight, scale) for pair in pairs.values() if len(pair) == 2]
+        if not factors:
+            continue
+        
+        base = by_name.get(prefix + '.base_layer') or by_name.get(prefix)
+        factored = TensorLayer(prefix, factors=factors)
+        parts = [layer for pair in pairs.values() for layer in pair.values()]
+        if base is not None:
+            factored.weight, factored.bias = base.weight, base.bias
+            parts.append(base)
+        for layer in parts:
+            replaced[layer.name] = factored
+            
+    grouped, done = [], set()
+    for layer in layers:
+        layer = replaced.get(layer.name, layer)
+        if id(layer) not in done:
+            done.add(id(layer))
+            grouped.append(layer)
+            
+    return grouped
+
+
+def safetensors_refs(filename):
+    """Read the safetensors header, and memory map each tensor when loaded"""
+    
+    with open(filename, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    data_start = 8 + header_size
+    
+    def loader(dtype, offset, shape, bf16):
+        def load():
+            if int(np.prod(shape)) == 0:
+                return np.zeros(shape, dtype=dtype)
+            W = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+            return bfloat16_weights(W) if bf16 else W
+        return load
+    
+    refs = []
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = SAFETENSORS_DTYPES.get(info['dtype'])
+        if dtype is None:
+            logger.warning("skipping tensor {} with unsupported dtype {}".format(name, info['dtype']))
+            continue
+        begin, _ = info['data_offsets']
+        bf16 = info['dtype'] == 'BF16'
+        refs.append(TensorRef(name, info['shape'], 'bfloat16' if bf16 else np.dtype(dtype).name,
+                              loader(dtype, data_start + begin, info['shape'], bf16)))
+        
+    # the header is not ordered by position in the file
+    refs.sort(key=lambda ref: header[ref.name]['data_offsets'][0])
+    return refs
+
+
+def read_npy_header(f):
+    """Read the header of a .npy file, leaving f at the start of the array data"""
+    
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def npz_refs(filename):
+    """Memory map the uncompressed arrays of an npz archive in place. Compressed arrays are read when loaded"""
+    
+    refs = []
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as f:
+        for info in zf.infolist():
+            if not info.filename.endswith('.npy'):
+                continue
+            name = info.filename[:-len('.npy')]
+            stored = info.compress_type == zipfile.ZIP_STORED
+            
+            if stored:
+                # local file header: 30 bytes + file name + extra field, then the .npy file
+                f.seek(info.header_offset)
+                local_header = f.read(30)
+                name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+                f.seek(info.header_offset + 30 + name_len + extra_len)
+                shape, fortran_order, dtype = read_npy_header(f)
+                offset = f.tell()
+            else:
+                with zf.open(info) as member:
+                    shape, fortran_order, dtype = read_npy_header(member)
+            
+            if stored and not dtype.hasobject:
+                def load(offset=offset, shape=shape, dtype=dtype, order='F' if fortran_order else 'C'):
+                    if int(np.prod(shape)) == 0:
+                        return np.zeros(shape, dtype=dtype)
+                    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape, order=order)
+            else:
+                def load(name=name):
+                    logger.debug("reading compressed array {} from {}".format(name, filename))
+                    with np.load(filename) as archive:
+                        return archive[name]
+            
+            refs.append(TensorRef(name, shape, dtype.name, load))
+            
+    return refs
+
+
+def pytorch_refs(filename):
+    """Load a PyTorch state_dict with memory mapped storages, so the tensors are only read when used"""
+    
+    import torch
+    
+    try:
+        state_dict = torch.load(filename, map_location='cpu', mmap=True, weights_only=True)
+    except (RuntimeError, TypeError, ValueError) as e:
+        # i.e. legacy (non zip) serialization, which can not be memory mapped
+        logger.warning("can not memory map {}, loading it in memory: {}".format(filename, e))
+        state_dict = torch.load(filename, map_location='cpu', weights_only=True)
+    
+    # checkpoints often wrap the state_dict
+    for key in ['state_dict', 'model_state_dict', 'model']:
+        if isinstance(state_dict, dict) and isinstance(state_dict.get(key), dict):
+            state_dict = state_dict[key]
+            break
+    
+    def loader(tensor):
+        def load():
+            t = tensor.detach()
+            if t.is_quantized or (t.dtype == torch.bfloat16 and t.dim() == 2):
+                from .pytorch import quantized_to_numpy
+                return quantized_to_numpy(t)
+            if t.dtype == torch.bfloat16:
+                t = t.float()
+            if t.layout != torch.strided:
+                from .pytorch import sparse_to_scipy
+                return sparse_to_scipy(t)
+            return t.numpy()
+        return load
+    
+    refs = []
+    for name, tensor in state_dict.items():
+        if not torch.is_tensor(tensor):
+            continue
+        dtype = str(tensor.dtype).replace('torch.', '')
+        refs.append(TensorRef(name, tensor.shape, dtype, loader(tensor)))
+        
+    return refs
+
+
+class CheckpointModel:
+    """A model read directly from a checkpoint file, without the framework model (or the model code)"""
+    
+    def __init__(self, filename):
+        self.filename = filename
+        
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in SAFETENSORS_EXTENSIONS:
+            self.layers = group_tensors(safetensors_refs(filename))
+        elif ext in NPZ_EXTENSIONS:
+            self.layers = group_tensors(npz_refs(filename))
+        elif ext in PYTORCH_EXTENSIONS:
+            self.layers = group_tensors(pytorch_refs(filename))
+        elif ext in H5_EXTENSIONS:
+            self.layers = h5_layers(filename)
+        elif is_tf_checkpoint(filename):
+            self.layers = tf_checkpoint_layers(filename)
+        else:
+            raise ValueError("unknown checkpoint format {}, supported: {}".format(filename, CHECKPOINT_EXTENSIONS))
+        
+        self.layers = group_lora_factors(self.layers, lora_scale(filename))
+        
+        logger.info("Found {} layers in {}".format(len(self.layers), filename))
+        
+    def __repr__(self):
+        return "CheckpointModel({})".format(self.filename)
+
+
+class CheckpointAdapter(FrameworkAdapter):
+    
+    framework = FRAMEWORK.CHECKPOINT
+    channels = CHANNELS.LAST
+    types_by_class = False  # all the layers are TensorLayers
+    
+    def iter_layers(self, model):
+        for layer in model.layers:
+            yield layer
+            
+    def layer_type(self, layer):
+        """Infer the LAYER_TYPE from the shape of the weight tensor (and the name, for embeddings)"""
+        
+        if layer.the_type is not None:
+            return layer.the_type
+        
+        the_type = LAYER_TYPE.UNKNOWN
+        ndim = len(layer.shape)
+        
+        if ndim == 2 and 'embed' in layer.name.lower():
+            the_type = LAYER_TYPE.EMBEDDING
+            
+        elif ndim == 2:
+            the_type = LAYER_TYPE.DENSE
+            
+        elif ndim == 3:
+            the_type = LAYER_TYPE.CONV1D
+            
+        elif ndim == 4:
+            the_type = LAYER_TYPE.CONV2D
+            
+        return the_type
+    
+    def layer_channels(self, layer):
+        return layer.channels or self.channels
+    
+    def get_weights_and_biases(self, layer):
+        
+        has_weights, has_biases = False, False
+        weights, biases = None, None
+        
+        if layer.weight is not None:
+            weights = layer.weight.load()
+            has_weights = True
+            if layer.scale is not None:
+                weights = self.quantized_weights(layer, weights)
+            
+        if layer.bias is not None:
+            biases = layer.bias.load()
+            has_biases = True
+            
+        return has_weights, weights, has_biases, biases
+    
+    def weights_shape(self, layer):
+        if layer.weight is None and not layer.factors:
+            return None
+        return tuple(layer.shape)
+    
+    def quantized_weights(self, layer, values):
+        """QuantizedMatrix of int8 weights, with per tensor or per channel (output channel) scales and zero points.
+        Quantized tensors of other shapes are dequantized to float32"""
+        
+        scale = np.asarray(layer.scale.load(), dtype=np.float64).squeeze()
+        if layer.scale_suffix == 'SCB':
+            scale = scale / 127
+        zero_point = 0
+        if layer.zero_point is not None:
+            zero_point = np.asarray(layer.zero_point.load(), dtype=np.float64).squeeze()
+        
+        W = QuantizedMatrix(values, scale, zero_point, axis=0)
+        if values.ndim == 2:
+            return W
+        
+        shape = [-1] + [1] * (values.ndim - 1)
+        zero_point = W.zero_point.reshape(shape) if W.zero_point.ndim else W.zero_point
+        scale = W.scale.reshape(shape) if W.scale.ndim else W.scale
+        return ((values.astype(np.float32) - zero_point) * scale).astype(np.float32)
+    
+    def layer_factors(self, layer):
+        if not layer.factors:
+            return None
+        return [(as_array(B.load()), as_array(A.load()), scale) for B, A, scale in layer.factors]
+    
+    def factors_rank(self, layer):
+        if not layer.factors:
+            return 0
+        return sum([A.shape[0] for B, A, scale in layer.factors])
+    
+    def load_model(self, filename):
+        return CheckpointModel(filename)
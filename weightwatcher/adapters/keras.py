@@ -0,0 +1,87 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Keras (tf 2.x) adapter, tensorflow is only imported when a Keras model is analyzed"""
+
+import tensorflow as tf
+from tensorflow import keras
+
+from ..constants import LAYER_TYPE, FRAMEWORK, CHANNELS
+from .base import FrameworkAdapter, logger
+
+
+class KerasAdapter(FrameworkAdapter):
+    
+    framework = FRAMEWORK.KERAS
+    channels = CHANNELS.FIRST
+    
+    def iter_layers(self, model):
+        for layer in model.layers:
+            yield layer
+    
+    def layer_type(self, layer):
+        
+        if isinstance(layer, keras.layers.Dense): 
+            the_type = LAYER_TYPE.DENSE
+            
+        elif isinstance(layer, keras.layers.Conv1D):                
+            the_type = LAYER_TYPE.CONV1D
+        
+        elif isinstance(layer, keras.layers.Conv2D):                
+            the_type = LAYER_TYPE.CONV2D
+            
+        elif isinstance(layer, keras.layers.Flatten):
+            the_type = LAYER_TYPE.FLATTENED
+            
+        elif isinstance(layer, keras.layers.Embedding):
+            the_type = LAYER_TYPE.EMBEDDING
+            
+        elif isinstance(layer, keras.layers.LayerNormalization):
+            the_type = LAYER_TYPE.NORM
+            
+        else:
+            the_type = self.infer_layer_type(layer)
+        
+        return the_type
+    
+    def get_weights_and_biases(self, layer):
+        
+        has_weights, has_biases = False, False
+        weights, biases = None, None
+        
+        w = layer.get_weights()
+        if len(w) == 1:
+            logger.debug("Linear weights shape  len(w){} type(w){}  w.shape {} ".format(len(w), type(w), w[0].shape))
+            has_weights = True
+            weights = w[0]
+        elif len(w) == 2:
+            has_weights, has_biases = True, True
+            weights, biases = w[0], w[1]
+        elif len(w) > 2:
+            logger.error("unknown weights, with len(w)={} ".format(len(w)))
+            
+        return has_weights, weights, has_biases, biases
+    
+    def weights_shape(self, layer):
+        # same rules as get_weights_and_biases, but the variables are not copied
+        w = layer.weights
+        if len(w) in [1, 2]:
+            return tuple(w[0].shape)
+        return None
+    
+    def load_model(self, filename):
+        return keras.models.load_model(filename)
+    
+    def versions(self):
+        return [("tensorflow", tf.__version__), ("keras", getattr(keras, '__version__', tf.__version__))]
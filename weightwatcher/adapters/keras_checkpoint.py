@@ -0,0 +1,161 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Keras weights read lazily from HDF5 files or TF checkpoints, without deserializing (or compiling) the model
+
+HDF5 (.h5) files, from model.save() or model.save_weights(), are walked group by group, using the layer_names 
+and weight_names attributes, and contiguous datasets are memory mapped in place.  The layer types and the groups 
+of grouped convolutions come from the model_config, when saved.  Otherwise, the types are inferred from the shapes, 
+and the convolutions are not grouped.
+
+TF checkpoints (a prefix with a .index file, or a directory with a checkpoint file) are read with the 
+checkpoint reader of the variable index, which reads one variable at a time."""
+
+import os
+import re
+import json
+
+import numpy as np
+
+from ..constants import LAYER_TYPE, CHANNELS
+from .base import logger
+
+H5_EXTENSIONS = ['.h5', '.hdf5']
+
+# keras layer class_name -> LAYER_TYPE, from the model_config
+KERAS_LAYER_TYPES = {
+    'Dense': LAYER_TYPE.DENSE,
+    'Conv1D': LAYER_TYPE.CONV1D,
+    'Conv2D': LAYER_TYPE.CONV2D,
+    'Flatten': LAYER_TYPE.FLATTENED,
+    'Embedding': LAYER_TYPE.EMBEDDING,
+    'LayerNormalization': LAYER_TYPE.NORM,
+}
+
+TF_VARIABLE_SUFFIX = '/.ATTRIBUTES/VARIABLE_VALUE'
+
+# checkpoint variables that are not model weights
+TF_SKIP_VARIABLES = ['.OPTIMIZER_SLOT', 'optimizer/', 'save_counter', '_CHECKPOINTABLE_OBJECT_GRAPH']
+
+
+def decode(name):
+    return name.decode('utf-8') if isinstance(name, bytes) else name
+
+
+def is_tf_checkpoint(path):
+    """True if path is a TF checkpoint prefix, or a directory with a checkpoint file"""
+    return os.path.isfile(path + '.index') or os.path.isfile(os.path.join(path, 'checkpoint'))
+
+
+def h5_layer_configs(h5file):
+    """Map the layer names to their (LAYER_TYPE, groups), using the model_config (if saved)"""
+    
+    layer_configs = {}
+    config = h5file.attrs.get('model_config')
+    if config is None:
+        return layer_configs
+    
+    config = json.loads(decode(config))
+    for layer in config.get('config', {}).get('layers', []):
+        name = layer.get('config', {}).get('name')
+        the_type = KERAS_LAYER_TYPES.get(layer.get('class_name'), LAYER_TYPE.UNKNOWN)
+        layer_configs[name] = (the_type, layer.get('config', {}).get('groups') or 1)
+        
+    return layer_configs
+
+
+def h5_dataset_loader(filename, dataset):
+    """Memory map the dataset when it is stored contiguously, otherwise read it from the file when loaded"""
+    
+    offset = dataset.id.get_offset()
+    shape, dtype, path = dataset.shape, dataset.dtype, dataset.name
+    
+    if offset is not None and dataset.chunks is None and dataset.compression is None:
+        def load():
+            return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+        def load():
+            import h5py
+            with h5py.File(filename, 'r') as f:
+                return f[path][()]
+            
+    return load
+
+
+def h5_layers(filename):
+    """One TensorLayer for each layer of the HDF5 file, in the order of the model (including layers without weights) """
+    
+    import h5py
+    from .checkpoint import TensorRef, TensorLayer, split_tensor_name, WEIGHT_SUFFIXES, BIAS_SUFFIXES
+    
+    layers = []
+    with h5py.File(filename, 'r') as f:
+        layer_configs = h5_layer_configs(f)
+        group = f['model_weights'] if 'model_weights' in f else f
+        
+        for layer_name in group.attrs['layer_names']:
+            layer_name = decode(layer_name)
+            the_type, groups = layer_configs.get(layer_name, (None, 1))
+            layer = TensorLayer(layer_name, the_type=the_type)
+            layer.groups = groups
+            # keras kernels are (i, j, in, out)
+            layer.channels = CHANNELS.FIRST
+            
+            for weight_name in group[layer_name].attrs['weight_names']:
+                weight_name = decode(weight_name)
+                dataset = group[layer_name][weight_name]
+                ref = TensorRef(weight_name, dataset.shape, dataset.dtype.name, h5_dataset_loader(filename, dataset))
+                
+                _, suffix = split_tensor_name(weight_name)
+                if suffix in WEIGHT_SUFFIXES and layer.weight is None:
+                    layer.weight = ref
+                elif suffix in BIAS_SUFFIXES and layer.bias is None:
+                    layer.bias = ref
+                    
+            layers.append(layer)
+            
+    return layers
+
+
+def natural_key(name):
+    """Sort key so that layer_with_weights-10 comes after layer_with_weights-9"""
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+
+def tf_checkpoint_layers(path):
+    """One TensorLayer for each layer with weights in the TF checkpoint, read from the variable index"""
+    
+    import tensorflow as tf
+    from .checkpoint import TensorRef, group_tensors
+    
+    if os.path.isdir(path):
+        path = tf.train.latest_checkpoint(path)
+    reader = tf.train.load_checkpoint(path)
+    
+    def loader(key):
+        def load():
+            return reader.get_tensor(key)
+        return load
+    
+    shapes = reader.get_variable_to_shape_map()
+    dtypes = reader.get_variable_to_dtype_map()
+    
+    refs = []
+    for key in sorted(shapes.keys(), key=natural_key):
+        if any(skip in key for skip in TF_SKIP_VARIABLES):
+            continue
+        name = key[:-len(TF_VARIABLE_SUFFIX)] if key.endswith(TF_VARIABLE_SUFFIX) else key
+        refs.append(TensorRef(name, shapes[key], dtypes[key].name, loader(key)))
+        
+    return group_tensors(refs)
@@ -0,0 +1,201 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""PyTorch adapter, torch is only imported when a PyTorch model is analyzed"""
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from ..constants import LAYER_TYPE, FRAMEWORK, CHANNELS
+from ..quantized import QuantizedMatrix, QUANTIZATION
+from .base import FrameworkAdapter, logger
+
+
+class PyTorchAdapter(FrameworkAdapter):
+    
+    framework = FRAMEWORK.PYTORCH
+    channels = CHANNELS.LAST
+    
+    def iter_layers(self, model):
+        for layer in model.modules():
+            yield layer
+            
+    def iter_named_layers(self, model):
+        # qualified module names, i.e. features.0, the model itself is named by its class
+        for name, layer in model.named_modules():
+            yield name or type(layer).__name__, layer
+    
+    def layer_type(self, layer):
+        
+        # LoRA layers have the type of the layer they wrap
+        layer = self.base_layer(layer)
+        if isinstance(layer, nn.Linear):
+            the_type = LAYER_TYPE.DENSE
+            
+        elif isinstance(layer, nn.Conv1d):
+            the_type = LAYER_TYPE.CONV1D
+        
+        elif isinstance(layer, nn.Conv2d):
+            the_type = LAYER_TYPE.CONV2D
+            
+        elif isinstance(layer, nn.Embedding):
+            the_type = LAYER_TYPE.EMBEDDING
+                
+        elif isinstance(layer, nn.LayerNorm):
+            the_type = LAYER_TYPE.NORM
+            
+        else:
+            the_type = self.infer_layer_type(layer)
+        
+        return the_type
+    
+    def get_weights_and_biases(self, layer):
+        
+        has_weights, has_biases = False, False
+        weights, biases = None, None
+        
+        # LoRA layers (peft) wrap the base layer
+        layer = self.base_layer(layer)
+        weight, bias = self.layer_tensor(layer, 'weight'), self.layer_tensor(layer, 'bias')
+        if weight is not None:
+            weights = self.to_numpy(weight)
+            has_weights = True
+            logger.debug("Linear weights shape  w.shape {} dtype {}".format(weights.shape, weights.dtype))
+            
+        if bias is not None:
+            biases = self.to_numpy(bias)
+            has_biases = True
+            
+        return has_weights, weights, has_biases, biases
+    
+    def weights_shape(self, layer):
+        weight = self.layer_tensor(self.base_layer(layer), 'weight')
+        if weight is not None:
+            return tuple(weight.shape)
+        
+        lora = self.lora_tensors(layer)
+        if lora:
+            return (lora[0][0].shape[0], lora[0][1].shape[1])
+        return None
+    
+    def layer_tensor(self, layer, name):
+        """The weight or bias tensor of the layer, None if it has none.  Quantized modules return them from methods"""
+        t = getattr(layer, name, None)
+        if callable(t) and not torch.is_tensor(t) and not isinstance(t, nn.Module):
+            try:
+                t = t()
+            except (TypeError, RuntimeError):
+                return None
+        return t if torch.is_tensor(t) else None
+    
+    def base_layer(self, layer):
+        base = getattr(layer, 'base_layer', None)
+        return base if isinstance(base, nn.Module) else layer
+    
+    def lora_tensors(self, layer):
+        """(B, A, scale) tensors of the active adapters of a LoRA layer, W = W_base + sum scale B A. 
+        Supports peft style layers (ModuleDicts of nn.Linear, one per adapter, and a dict of scalings)
+        and loralib style layers (lora_A and lora_B parameters, and a scaling float)"""
+        
+        lora_A, lora_B = getattr(layer, 'lora_A', None), getattr(layer, 'lora_B', None)
+        scaling = getattr(layer, 'scaling', 1.0)
+        
+        if isinstance(lora_A, nn.ModuleDict) and isinstance(lora_B, nn.ModuleDict):
+            active = getattr(layer, 'active_adapters', None) or list(lora_A.keys())
+            if isinstance(active, str):
+                active = [active]
+            
+            tensors = []
+            for name in active:
+                # only the factors of linear layers, LoRA convolutions are analyzed by their base layer
+                if name in lora_A and name in lora_B and getattr(lora_A[name], 'weight', None) is not None \
+                        and lora_A[name].weight.ndim == 2:
+                    scale = scaling.get(name, 1.0) if isinstance(scaling, dict) else scaling
+                    tensors.append((lora_B[name].weight, lora_A[name].weight, float(scale)))
+            return tensors
+        
+        if torch.is_tensor(lora_A) and torch.is_tensor(lora_B) and lora_A.ndim == 2:
+            return [(lora_B, lora_A, float(scaling))]
+        
+        return []
+    
+    def layer_factors(self, layer):
+        factors = [(self.to_numpy(B), self.to_numpy(A), scale) for B, A, scale in self.lora_tensors(layer)]
+        return factors or None
+    
+    def factors_rank(self, layer):
+        return sum([A.shape[0] for B, A, scale in self.lora_tensors(layer)])
+    
+    def to_numpy(self, tensor):
+        """Read only numpy view of a parameter, in its native dtype.  
+        
+        CPU tensors are not copied: the array shares memory with the parameter. GPU tensors are copied to the host once, 
+        and bfloat16 (which numpy does not support) is converted to float32. The spectrum code decides on the precision.
+        Sparse matrices are returned as scipy CSR matrices, see sparse_to_scipy().
+        
+        bfloat16 and quantized (int8) weight matrices are returned as QuantizedMatrix, in their storage format, 
+        and dequantized chunk by chunk by the spectrum code, see quantized_to_numpy()"""
+        
+        t = tensor.detach()
+        if t.device.type != 'cpu':
+            t = t.cpu()
+        if t.is_quantized or (t.dtype == torch.bfloat16 and t.dim() == 2):
+            return quantized_to_numpy(t)
+        if t.dtype == torch.bfloat16:
+            t = t.float()
+        if t.layout != torch.strided:
+            return sparse_to_scipy(t)
+            
+        W = t.numpy()
+        W.flags.writeable = False
+        return W
+    
+    def versions(self):
+        return [("torch", torch.__version__)]
+
+
+def quantized_to_numpy(t):
+    """QuantizedMatrix of a 2D quantized (per tensor or per channel affine) or bfloat16 tensor. 
+    bfloat16 bits are viewed as uint16, without copying.  Quantized tensors of other shapes are dequantized to float32"""
+    
+    if t.dtype == torch.bfloat16:
+        values = t.view(torch.int16).numpy().view(np.uint16)
+        values.flags.writeable = False
+        return QuantizedMatrix(values, kind=QUANTIZATION.BF16)
+    
+    if t.dim() != 2:
+        return t.dequantize().numpy()
+    
+    values = t.int_repr().numpy()
+    if t.qscheme() in [torch.per_channel_affine, torch.per_channel_symmetric]:
+        return QuantizedMatrix(values, t.q_per_channel_scales().numpy(), t.q_per_channel_zero_points().numpy(), 
+                               t.q_per_channel_axis())
+    return QuantizedMatrix(values, t.q_scale(), t.q_zero_point())
+
+
+def sparse_to_scipy(t):
+    """scipy CSR matrix of a sparse (COO, CSR ...) 2D tensor, without densifying it.  
+    Sparse tensors of other shapes are densified, the weight matrices are extracted from dense tensors"""
+    
+    from scipy import sparse
+    
+    if t.dim() != 2:
+        logger.debug("densifying sparse tensor of shape {}".format(tuple(t.shape)))
+        return t.to_dense().numpy()
+    
+    t = t.to_sparse_csr()
+    return sparse.csr_matrix((t.values().numpy(), t.col_indices().numpy(), t.crow_indices().numpy()), 
+                             shape=tuple(t.shape))
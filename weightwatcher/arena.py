@@ -0,0 +1,154 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Memory mapped weight arena, used to hand weight matrices to worker processes
+
+The weight matrices of a layer are written once into a memory mapped block (in /dev/shm when available),
+and workers only receive the (path, offset, shape, dtype) specs of the block, which they map read only.
+Nothing but the specs and the resulting eigenvalues is ever pickled through the process pipes."""
+
+import os
+import shutil
+import tempfile
+import logging
+
+import numpy as np
+
+from .spectrum import combined_eigenvalues, random_eigenvalues, num_random_replicas, matrix_batches, \
+    conv2D_fft_eigenvalues
+from .quantized import QuantizedMatrix
+
+logger = logging.getLogger('weightwatcher')
+
+# align each matrix in a block to a cache line
+ALIGNMENT = 64
+
+SHM_DIR = "/dev/shm"
+
+
+class ArenaBlock:
+    """Picklable reference to the weight matrices of one layer, stored in the arena"""
+
+    def __init__(self, path, specs, layout=None):
+        self.path = path
+        self.specs = specs  # list of (offset, shape, dtype str)
+        # for each matrix: None if it is an array, or (kind, axis, scale ndim, zero_point ndim) if it is a 
+        # QuantizedMatrix, stored as its values, scale and zero_point arrays
+        self.layout = layout if layout is not None else [None] * len(specs)
+
+    def nbytes(self):
+        return sum([int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in self.specs])
+
+    def load(self):
+        """Map the weight matrices of this block, read only and without copying"""
+        arrays = [np.memmap(self.path, dtype=np.dtype(dtype), mode='r', offset=offset, shape=shape)
+                  for offset, shape, dtype in self.specs]
+        
+        Wmats, i = [], 0
+        for quantized in self.layout:
+            if quantized is None:
+                Wmats.append(arrays[i])
+                i += 1
+            else:
+                kind, axis, scale_ndim, zero_point_ndim = quantized
+                values, scale, zero_point = arrays[i:i+3]
+                scale = scale if scale_ndim else scale.reshape(())
+                zero_point = zero_point if zero_point_ndim else zero_point.reshape(())
+                Wmats.append(QuantizedMatrix(values, scale, zero_point, axis, kind))
+                i += 3
+        return Wmats
+
+    def __repr__(self):
+        return "ArenaBlock({}, {} matrices)".format(self.path, len(self.specs))
+
+
+class WeightArena:
+    """Memory mapped arena that holds the weight matrices of the layers currently being processed by workers"""
+
+    def __init__(self, root=None):
+        if root is None and os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+            root = SHM_DIR
+        self.root = tempfile.mkdtemp(prefix="ww_arena_", dir=root)
+        self.num_blocks = 0
+        logger.debug("created weight arena in {}".format(self.root))
+
+    def put(self, Wmats):
+        """Copy the weight matrices (or stacks of matrices) into a new block of the arena, exactly once, and return the block"""
+        arrays, layout = [], []
+        for W in matrix_batches(Wmats):
+            if isinstance(W, QuantizedMatrix):
+                # in their storage format, the workers dequantize them
+                arrays.extend([W.values, np.atleast_1d(W.scale), np.atleast_1d(W.zero_point)])
+                layout.append((W.kind, W.axis, W.scale.ndim, W.zero_point.ndim))
+            else:
+                arrays.append(W)
+                layout.append(None)
+            
+        specs, offset = [], 0
+        for W in arrays:
+            specs.append((offset, tuple(W.shape), W.dtype.str))
+            offset += W.nbytes
+            offset += -offset % ALIGNMENT
+
+        path = os.path.join(self.root, "block_{}.bin".format(self.num_blocks))
+        self.num_blocks += 1
+        with open(path, 'wb') as f:
+            f.truncate(max(offset, 1))
+
+        block = ArenaBlock(path, specs, layout)
+        for W, mm in zip(arrays, self.map_writable(block)):
+            mm[...] = W
+            mm.flush()
+
+        return block
+
+    def map_writable(self, block):
+        for offset, shape, dtype in block.specs:
+            yield np.memmap(block.path, dtype=np.dtype(dtype), mode='r+', offset=offset, shape=shape)
+
+    def release(self, block):
+        """Free the block, once the worker is done with it"""
+        try:
+            os.remove(block.path)
+        except OSError:
+            logger.warning("could not remove arena block {}".format(block.path))
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def arena_eigenvalues(block, N, M, n_comp, params, kernel_size=None, layer_key=(0,)):
+    """Worker entry point: compute the ESD (and the randomized ESD, if needed) of the weight matrices in the block.
+    kernel_size is only given for conv2D layers, and used by conv2d_fft.  
+    layer_key selects the random streams of the layer, as in process, see replica_rng().
+    Only the eigenvalues and metrics are returned to the main process"""
+
+    Wmats = block.load()
+    if params.get('conv2d_fft') and kernel_size is not None:
+        evals, sv_max, rank_loss = conv2D_fft_eigenvalues(Wmats, kernel_size, N, M, params)
+    else:
+        evals, sv_max, rank_loss = combined_eigenvalues(Wmats, N, M, n_comp, params)
+
+    rand_evals = None
+    if params.get('randomize') or params.get('mp_fit'):
+        num_replicas = num_random_replicas(n_comp)
+        rand_evals = random_eigenvalues(Wmats, n_comp, num_replicas, params, layer_key)
+
+    return evals, sv_max, rank_loss, rand_evals
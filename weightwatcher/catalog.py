@@ -0,0 +1,199 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Layer catalog: the metadata of all the layers of a model, built once from the layer types and weight shapes
+
+The catalog is cached by the WeightWatcher, and the layer iterators, filters and lookups use it
+instead of walking the model (and resolving the layer types) again for every query.
+No weights are read to build it.  The cache is checked against the layer objects of the model (or the 
+modification time of the file), so a model changed in place gets a new catalog."""
+
+import os
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+from .constants import LAYER_TYPE, CHANNELS
+
+logger = logging.getLogger('weightwatcher')
+
+
+def conv2D_shape(s):
+    """N, M, i, j and channels of a conv2D tensor of shape: (N,M,i,j) or (i,j,N,M) """
+
+    N, M, imax, jmax = s[0], s[1], s[2], s[3]
+    if N + M >= imax + jmax:
+        logger.debug("Channels Last tensor shape detected: {}x{} (NxM), {}x{} (i,j)".format(N, M, imax, jmax))
+        channels = CHANNELS.LAST
+    else:
+        N, M, imax, jmax = imax, jmax, N, M
+        logger.debug("Channels First shape detected: {}x{} (NxM), {}x{} (i,j)".format(N, M, imax, jmax))
+        channels = CHANNELS.FIRST
+
+    return N, M, imax, jmax, channels
+
+
+def grouped_conv2D_shape(s, channels):
+    """out channels, in channels per group, i and j of a grouped conv2D tensor, 
+    of shape (out, in/groups, i, j) if channels last (PyTorch), or (i, j, in/groups, out) if channels first (Keras)"""
+
+    if channels == CHANNELS.FIRST:
+        return s[3], s[2], s[0], s[1]
+    return s[0], s[1], s[2], s[3]
+
+
+def matrix_shape(the_type, shape, groups=1, channels=CHANNELS.UNKNOWN):
+    """N, M, rf and channels of the weight matrices of a layer, given the shape of its weights (tensor).
+    For grouped convolutions, N x M is the shape of the whole (block diagonal) out x in operator, 
+    and channels (the layout of the framework) must be given"""
+
+    N, M, rf = 0, 0, None
+
+    if the_type in [LAYER_TYPE.DENSE, LAYER_TYPE.CONV1D, LAYER_TYPE.EMBEDDING]:
+        N, M, rf = np.max(shape), np.min(shape), 1
+
+    elif the_type == LAYER_TYPE.CONV2D and groups > 1:
+        out_channels, group_channels, imax, jmax = grouped_conv2D_shape(shape, channels)
+        in_channels = group_channels * groups
+        N, M, rf = max(out_channels, in_channels), min(out_channels, in_channels), imax * jmax
+
+    elif the_type == LAYER_TYPE.CONV2D:
+        N, M, imax, jmax, channels = conv2D_shape(shape)
+        rf = imax * jmax
+
+    else:
+        channels = CHANNELS.UNKNOWN
+
+    return N, M, rf, channels
+
+
+class LayerEntry:
+    """Catalog metadata of one framework layer"""
+
+    def __init__(self, layer_id, name, layer, the_type, shape, adapter):
+        self.layer_id = layer_id
+        self.name = name
+        self.layer = layer
+        self.the_type = the_type
+        self.shape = shape  # shape of the weights, None if the layer has no weights
+        self.adapter = adapter
+        self.groups = adapter.layer_groups(layer) if the_type == LAYER_TYPE.CONV2D else 1
+        self.rank = adapter.factors_rank(layer)  # rank of the low rank (LoRA) factors, 0 if none
+        self.parent = None  # the factored layer this layer is a part of, if any
+
+        self.has_weights = shape is not None
+        self.N, self.M, self.rf, self.channels = 0, 0, None, CHANNELS.UNKNOWN
+        if self.has_weights:
+            self.N, self.M, self.rf, self.channels = matrix_shape(the_type, shape, self.groups, adapter.layer_channels(layer))
+
+    def weights(self):
+        """Extract the weights of the layer (read when called, never cached)"""
+        has_weights, weights, _, _ = self.adapter.get_weights_and_biases(self.layer)
+        return weights
+
+    def __repr__(self):
+        return "LayerEntry({}, {}, {}, {})".format(self.layer_id, self.name, self.the_type.name, self.shape)
+
+
+class LayerCatalog:
+    """Metadata of all the layers of a model, indexed by layer id, name and LAYER_TYPE"""
+
+    def __init__(self, model, adapter, source=None):
+        self.model = model
+        self.adapter = adapter
+        self.source = model if source is None else source  # what the user passed: the model or a file name
+
+        self.entries = []
+        self.by_name = {}
+        self.by_type = defaultdict(list)
+        self.fingerprint = self.model_fingerprint(self.source)
+
+        if adapter is None:
+            return
+
+        for layer_id, (name, layer) in enumerate(adapter.iter_named_layers(model)):
+            the_type = adapter.cached_layer_type(layer)
+            entry = LayerEntry(layer_id, name, layer, the_type, adapter.weights_shape(layer), adapter)
+            self.entries.append(entry)
+            self.by_type[the_type].append(entry)
+            if name is not None:
+                self.by_name.setdefault(name, entry)
+
+        self.link_factors()
+        logger.debug("cataloged {} layers".format(len(self.entries)))
+
+    def link_factors(self):
+        """Mark the sublayers (base layer, lora_A, lora_B ...) of the factored layers, 
+        which are analyzed as part of their factored layer, and not on their own"""
+        for entry in self.entries:
+            if entry.rank and entry.name is not None:
+                prefix = entry.name + '.'
+                for child in self.entries:
+                    if child.name is not None and child.name.startswith(prefix):
+                        child.parent = entry
+
+    def model_fingerprint(self, model):
+        """Cheap fingerprint of the structure of the model: the names and ids of its layers (the catalog 
+        keeps the layers alive, so their ids are not reused), or the modification time and size of the file"""
+        
+        if isinstance(model, str):
+            if not os.path.exists(model):
+                return None
+            stat = os.stat(model)
+            return (stat.st_mtime_ns, stat.st_size)
+        
+        if self.adapter is None or model is not self.model:
+            return None
+        return tuple([(name, id(layer)) for name, layer in self.adapter.iter_named_layers(model)])
+
+    def describes(self, model):
+        """True if the catalog was built for this model (or file name), and its layers have not changed since"""
+        
+        same_source = self.source is model or (isinstance(model, str) and model == self.source)
+        return same_source and self.model_fingerprint(model) == self.fingerprint
+
+    def get(self, key):
+        """Look up a layer entry by id or name, None if not found"""
+        if type(key) is int:
+            if 0 <= key < len(self.entries):
+                return self.entries[key]
+            return None
+        return self.by_name.get(key)
+
+    def select(self, ids=[], names=[], types=[]):
+        """Entries kept by the filters, in layer id order.
+        As in WWLayerIterator.apply_filters(), name filters take precedence over id filters, and id filters over type filters.
+        The parts of factored layers are only selected when asked for explicitly, by id or name"""
+
+        if names:
+            entries = [self.by_name[name] for name in names if name in self.by_name]
+        elif ids:
+            entries = [self.get(layer_id) for layer_id in ids if self.get(layer_id) is not None]
+        elif types:
+            entries = [entry for the_type in types for entry in self.by_type.get(the_type, []) if entry.parent is None]
+        else:
+            return [entry for entry in self.entries if entry.parent is None]
+
+        unique = {entry.layer_id: entry for entry in entries}
+        return [unique[layer_id] for layer_id in sorted(unique)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __repr__(self):
+        return "LayerCatalog({} layers)".format(len(self.entries))
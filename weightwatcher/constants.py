@@ -29,6 +29,7 @@ class FRAMEWORK(IntFlag):
     UNKNOWN = auto()
     PYTORCH = auto()
     KERAS = auto()
+    CHECKPOINT = auto()
     
 
 class CHANNELS(IntFlag):
@@ -66,3 +67,16 @@ class XMAX(IntFlag):
 class XMIN(IntFlag):
     UNKNOWN = auto()
     AUTO = auto()
+    
+    
+# str enums, so the members compare equal to the strings users pass, i.e. precision='float32'
+class PRECISION(str, Enum):
+    FLOAT64 = "float64"
+    FLOAT32 = "float32"
+    AUTO = "auto"  # float32, escalated to float64 if needed
+    
+    
+class PRIORITY(str, Enum):
+    LAYER_ORDER = "layer_order"
+    LARGEST = "largest"  # the most expensive layers first
+    SMALLEST = "smallest"  # the cheapest layers first, to analyze as many layers as possible
@@ -0,0 +1,82 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Per layer memory accounting, used by analyze(max_memory=...)
+
+The peak memory of a layer is estimated from the bytes of its weight matrices and eigenvalues, which are counted 
+before they are released.  Memory mapped matrices (out of core, or model owned views) are not counted.
+
+tracemalloc measures all the python and numpy allocations, but slows them down a lot (i.e. in the powerlaw fits), 
+so it is only used if it was started by the user, and it is never started or stopped here."""
+
+import tracemalloc
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('weightwatcher')
+
+
+def layer_nbytes(ww_layer):
+    """Bytes of the weight matrices and eigenvalues held by the layer, not counting memory mapped matrices"""
+    
+    nbytes = sum([getattr(W, 'nbytes', 0) for W in ww_layer.Wmats if not isinstance(W, np.memmap)])
+    for evals in [ww_layer.evals, ww_layer.rand_evals]:
+        if evals is not None:
+            nbytes += np.asarray(evals).nbytes
+    return nbytes
+
+
+class MemoryTracker:
+    """Track the peak memory of each layer, while it is processed"""
+
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.traced = False
+        self.base = 0
+        self.nbytes = 0
+
+    def start(self):
+        # tracemalloc.reset_peak() is python 3.9+
+        self.traced = tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+        self.reset()
+
+    def reset(self):
+        """Start the accounting of the next layer"""
+        self.nbytes = 0
+        if self.traced:
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+
+    def account(self, ww_layer):
+        """Count the matrices and eigenvalues the layer holds now, i.e. before they are released"""
+        self.nbytes = max(self.nbytes, layer_nbytes(ww_layer))
+
+    def peak(self):
+        """Peak memory (bytes) of the layer since the last reset, traced if tracemalloc was started by the user"""
+        if self.traced:
+            return max(tracemalloc.get_traced_memory()[1] - self.base, 0)
+        return self.nbytes
+
+    def check(self, ww_layer, peak):
+        if peak > self.max_memory:
+            logger.warning("Layer {} {} used {} bytes, more than max_memory {}".format(ww_layer.layer_id, ww_layer.name,
+                                                                                       peak, self.max_memory))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        pass
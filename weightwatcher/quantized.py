@@ -0,0 +1,207 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Quantized and low precision (int8, float16, bfloat16) weight matrices, dequantized chunk by chunk, 
+and out of core (very large, possibly memory mapped) matrices, streamed chunk by chunk
+
+The weights are kept in their storage format (possibly memory mapped), and the spectrum code only sees
+float64 chunks of a bounded size.  The eigenvalues are those of the Gram matrix, accumulated over the chunks,
+so a full float64 copy of the matrix never exists."""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('weightwatcher')
+
+# size (bytes) of each dequantized float64 chunk
+CHUNK_BYTES = 1 << 26
+
+# float64 size (bytes) above which an in memory matrix is streamed too, instead of copied to float64 as a whole
+OUT_OF_CORE_BYTES = 1 << 30
+
+
+class QUANTIZATION:
+    INT = "int"  # int8 / uint8 values, with per tensor or per channel scales and zero points
+    BF16 = "bf16"  # raw bfloat16 bits, as uint16
+    FLOAT = "float"  # float16 (or any float) values
+
+
+class QuantizedMatrix:
+    """N x M weight matrix stored in low precision: W = (values - zero_point) * scale,
+    with scale and zero_point scalars, or vectors along axis (per channel quantization)"""
+
+    ndim = 2
+
+    def __init__(self, values, scale=1.0, zero_point=0, axis=0, kind=QUANTIZATION.INT):
+        self.values = values
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.zero_point = np.asarray(zero_point, dtype=np.float64)
+        self.axis = axis
+        self.kind = kind
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        """dtype of the dequantized weights"""
+        return np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def __mul__(self, norm):
+        """The matrix scaled by norm, without dequantizing it"""
+        return QuantizedMatrix(self.values, self.scale * float(norm), self.zero_point, self.axis, self.kind)
+
+    def chunk_size(self, axis):
+        """Number of rows (axis 0) or columns (axis 1) of each float64 chunk"""
+        other = self.shape[1 - axis]
+        return max(1, CHUNK_BYTES // (8 * other))
+
+    def dequantize(self, start, stop, axis=0, dtype=np.float64):
+        """Dequantize rows (axis 0) or columns (axis 1) start:stop"""
+        return self.dequantize_index(slice(start, stop), axis, dtype)
+
+    def dequantize_index(self, selector, axis=0, dtype=np.float64):
+        """Dequantize the rows (axis 0) or columns (axis 1) selected by a slice, or a sorted array of indices"""
+
+        index = (selector, slice(None)) if axis == 0 else (slice(None), selector)
+        values = self.values[index]
+
+        if self.kind == QUANTIZATION.BF16:
+            W = (np.asarray(values).astype(np.uint32) << 16).view(np.float32).astype(dtype)
+        else:
+            W = np.asarray(values).astype(dtype)
+
+        if self.scale.ndim == 0 and self.zero_point.ndim == 0:
+            if self.zero_point != 0:
+                W -= self.zero_point
+            if self.scale != 1:
+                W *= self.scale
+            return W
+
+        # per channel scales and zero points, along self.axis
+        shape = [1, 1]
+        shape[self.axis] = -1
+        scale, zero_point = self.scale, self.zero_point
+        if scale.ndim > 0 and self.axis == axis:
+            scale = scale[selector]
+        if zero_point.ndim > 0 and self.axis == axis:
+            zero_point = zero_point[selector]
+        W -= zero_point.reshape(shape) if zero_point.ndim > 0 else zero_point
+        W *= scale.reshape(shape) if scale.ndim > 0 else scale
+        return W
+
+    def chunks(self, axis=0, dtype=np.float64):
+        """Generator over the dequantized chunks of rows (axis 0) or columns (axis 1)"""
+        size = self.chunk_size(axis)
+        for start in range(0, self.shape[axis], size):
+            yield self.dequantize(start, start + size, axis, dtype)
+
+    def toarray(self, dtype=np.float32):
+        """The whole dequantized matrix"""
+        return self.dequantize(0, self.shape[0], 0, dtype)
+
+    def count_nonzero(self):
+        """Number of nonzero weights"""
+        if self.kind == QUANTIZATION.BF16:
+            return int(np.count_nonzero(np.asarray(self.values) & 0x7fff))
+        if self.zero_point.ndim == 0:
+            return int(np.count_nonzero(np.asarray(self.values) != self.zero_point))
+        return sum([np.count_nonzero(chunk) for chunk in self.chunks()])
+
+    def __repr__(self):
+        return "QuantizedMatrix({}, {}, {})".format(self.kind, self.shape, self.values.dtype)
+
+
+def is_quantized(W):
+    """True if the eigenvalues of W are computed chunk by chunk: quantized or 2D float16 matrices"""
+    if isinstance(W, QuantizedMatrix):
+        return True
+    return isinstance(W, np.ndarray) and W.ndim == 2 and W.dtype == np.float16
+
+
+def is_out_of_core(W):
+    """True if W is a 2D matrix (in memory, or memory mapped) that should not be copied to float64 as a whole: 
+    larger than OUT_OF_CORE_BYTES in float64.  Smaller matrices get the (better conditioned) batched SVDs"""
+    if not isinstance(W, np.ndarray) or W.ndim != 2:
+        return False
+    return 8 * W.size > OUT_OF_CORE_BYTES
+
+
+def as_quantized(W):
+    if isinstance(W, QuantizedMatrix):
+        return W
+    return QuantizedMatrix(W, kind=QUANTIZATION.FLOAT)
+
+
+def gram_matrix(W):
+    """Gram matrix W^T W (or W W^T, on the small side of W), accumulated over float64 chunks of the long side"""
+
+    W = as_quantized(W)
+    N, M = W.shape
+    axis = 0 if N >= M else 1
+
+    X = np.zeros((min(N, M), min(N, M)), dtype=np.float64)
+    for chunk in W.chunks(axis):
+        if axis == 0:
+            X += chunk.T @ chunk
+        else:
+            X += chunk @ chunk.T
+    return X
+
+
+def gram_eigenvalues(W):
+    """Eigenvalues (squared singular values) of a quantized or low precision matrix, from its streamed Gram matrix"""
+    logger.debug("Running streaming Gram eigenvalues:  W.shape={}".format(W.shape))
+    evals = np.linalg.eigvalsh(gram_matrix(W))
+    return np.clip(evals, 0, None)
+
+
+def random_gram_eigenvalues(W, rng=None):
+    """Eigenvalues of W with its elements randomly shuffled (by the numpy random Generator rng), from the streamed Gram matrix.  
+    The rows (or columns, on the long side) are dealt to the chunks by a random permutation, so each chunk is 
+    a random sample of the whole matrix, and the elements are shuffled within each chunk: the structure of the rows 
+    (i.e. the norms of the rows of an embedding table) does not survive, and only one chunk is ever in memory.  
+    If W fits in one chunk, this is a full shuffle, as in random_eigenvalues()"""
+    
+    if rng is None:
+        rng = np.random.default_rng()
+    W = as_quantized(W)
+    N, M = W.shape
+    axis = 0 if N >= M else 1
+    
+    order = rng.permutation(W.shape[axis])
+    size = W.chunk_size(axis)
+    
+    X = np.zeros((min(N, M), min(N, M)), dtype=np.float64)
+    for start in range(0, W.shape[axis], size):
+        # sorted, so the memory mapped rows are read in order
+        chunk = W.dequantize_index(np.sort(order[start:start + size]), axis)
+        Wrand = chunk.flatten()
+        rng.shuffle(Wrand)
+        chunk = Wrand.reshape(chunk.shape)
+        X += chunk.T @ chunk if axis == 0 else chunk @ chunk.T
+        
+    logger.debug("Running randomized streaming Gram eigenvalues:  W.shape={}".format(W.shape))
+    return np.clip(np.linalg.eigvalsh(X), 0, None)
+
+
+def quantized_norm(W):
+    """Frobenius norm of a quantized matrix, accumulated over the chunks"""
+    return np.sqrt(sum([np.sum(chunk * chunk) for chunk in as_quantized(W).chunks()]))
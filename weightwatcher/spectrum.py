@@ -0,0 +1,402 @@
+# Copyright 2018 Calculation Consulting [calculationconsulting.com]
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Eigenvalue (ESD) computations on extracted weight matrices.
+
+These are plain functions of the weight matrices and the analysis params, so that
+they can run in the main process or in a worker process (see arena.py)"""
+
+import logging
+
+import numpy as np
+
+from .constants import PRECISION
+from .quantized import QuantizedMatrix, is_quantized, gram_eigenvalues, random_gram_eigenvalues, quantized_norm
+
+logger = logging.getLogger('weightwatcher')
+
+# fraction of zero weights above which the ESD is computed from the sparse matrices, see sparse_eigenvalues()
+SPARSE_THRESHOLD = 0.8
+
+# relative error of the float32 eigenvalues above which precision='auto' recomputes them in float64
+PRECISION_TOLERANCE = 1e-4
+
+
+def matrix_batches(Wmats):
+    """Wmats is a list of N x M matrices, or of (k, N, M) stacks of matrices (i.e. the slices of a conv2D layer), 
+    or a single matrix or stack.  Return the list of matrices and stacks, so that each one can be decomposed in one call"""
+    if type(Wmats) is not list:
+        logger.debug("combined_eigenvalues: Wmats -> [WMmats]")
+        Wmats = [Wmats]
+    return Wmats
+
+
+def iter_matrices(Wmats):
+    """Generator over the individual N x M matrices of Wmats (see matrix_batches)"""
+    for W in matrix_batches(Wmats):
+        if W.ndim == 3:
+            for Wslice in W:
+                yield Wslice
+        else:
+            yield W
+
+
+def is_sparse(W):
+    """True if W is a scipy sparse matrix"""
+    from scipy import sparse
+    return sparse.issparse(W)
+
+
+def matrix_sparsity(Wmats):
+    """Fraction of zero elements of the weight matrices (or tensor), scipy sparse matrices included"""
+    
+    zeros, size = 0, 0
+    for W in matrix_batches(Wmats):
+        if is_sparse(W) or isinstance(W, QuantizedMatrix):
+            nnz = W.count_nonzero()
+        else:
+            nnz = np.count_nonzero(W)
+        size += int(np.prod(W.shape))
+        zeros += int(np.prod(W.shape)) - nnz
+        
+    return zeros / size if size else 0.0
+
+
+def matrix_norm(W):
+    """Frobenius norm of a dense, scipy sparse or quantized matrix"""
+    if is_sparse(W):
+        from scipy.sparse.linalg import norm
+        return norm(W)
+    if is_quantized(W):
+        return quantized_norm(W)
+    return np.linalg.norm(W)
+
+
+def dense_matrix(W, dtype=np.float64):
+    """Dense copy of a dense, scipy sparse or quantized matrix"""
+    if is_sparse(W):
+        return W.toarray().astype(dtype, copy=False)
+    if isinstance(W, QuantizedMatrix):
+        return W.toarray(dtype)
+    return np.array(W, dtype=dtype)
+
+
+def to_csr(W):
+    """float64 scipy CSR matrix of W.  Quantized matrices are converted chunk by chunk"""
+    from scipy import sparse
+    if isinstance(W, QuantizedMatrix):
+        return sparse.vstack([sparse.csr_matrix(chunk) for chunk in W.chunks()], format='csr')
+    return sparse.csr_matrix(W, dtype=np.float64)
+
+
+def sparse_gram_eigenvalues(W):
+    """Eigenvalues (squared singular values) of W, a sparse N x M matrix, from its sparse M x M (or N x N) Gram matrix. 
+    The Gram matrix is computed by a sparse product, and only the small side is ever dense"""
+    
+    W = to_csr(W)
+    X = W.T @ W if W.shape[0] >= W.shape[1] else W @ W.T
+    evals = np.linalg.eigvalsh(X.toarray())
+    return np.clip(evals, 0, None)
+
+
+def sparse_eigenvalues(Wmats, N, M, n_comp, params):
+    """Compute the eigenvalues of mostly zero (pruned) or scipy sparse weight matrices, without densifying them
+    
+    The matrices are converted to CSR (only the nonzero weights are kept, in float64), and the eigenvalues 
+    are those of the sparse Gram matrix W^T W, which takes O(nnz^2 / N) for the product, instead of O(N M^2) for the SVD. 
+    
+    Also returns max singular value and rank_loss, as combined_eigenvalues()
+    """
+    
+    all_evals = []
+    for W in iter_matrices(Wmats):
+        logger.debug("Running sparse Gram eigenvalues:  W.shape={}  n_comp = {}".format(W.shape, n_comp))
+        evals = np.sort(sparse_gram_eigenvalues(W))[-n_comp:]
+        all_evals.extend(evals)
+    
+    evals = np.sort(np.array(all_evals))
+    max_sv = np.sqrt(np.max(evals))
+    if params['normalize']:
+        evals = evals / N
+        
+    return evals, max_sv, 0
+
+
+def svd_dtype(params):
+    """dtype of the SVDs: float32 if precision is float32 or auto, float64 otherwise (the default)"""
+    if params and params.get('precision') in [PRECISION.FLOAT32, PRECISION.AUTO]:
+        return np.float32
+    return np.float64
+
+
+def float32_error(sv):
+    """Estimated relative error of the float32 eigenvalues in the upper half of the ESD (where the power law is fit,
+    and lambda_max is). The absolute error of the singular values of a backward stable SVD is about eps s_max, 
+    so the relative error of lambda_i = s_i^2 is about 2 eps s_max / s_i"""
+    
+    s_max, s_median = np.max(sv), np.median(sv)
+    if s_median <= 0:
+        return np.inf
+    return 2 * np.finfo(np.float32).eps * s_max / s_median
+
+
+def combined_eigenvalues(Wmats, N, M, n_comp, params):
+    """Compute the eigenvalues for all weights of the NxM weight matrices (N >= M),
+        combined into a single, sorted, numpy array
+
+        Applied normalization and glorot_fix if specified
+
+        Assumes an array of weights comes from a conv2D layer and applies conv2d_norm normalization by default
+
+        Also returns max singular value and rank_loss, needed for other calculations
+     """
+
+    all_evals = []
+    max_sv = 0.0
+    rank_loss = 0
+
+    # TODO:  allow user to specify
+    normalize = params['normalize']
+    glorot_fix = params['glorot_fix']
+    conv2d_norm = params['conv2d_norm']  # True
+
+    Wmats = matrix_batches(Wmats)
+    count = len(Wmats)
+    for  W in Wmats:
+
+        Q = N / M
+        # SVD can be swapped out here
+        # svd = TruncatedSVD(n_components=M-1, n_iter=7, random_state=10)
+
+        # the weights are kept in their native dtype (and may be views of the model parameters) up to here
+        if is_quantized(W):
+            # quantized and float16 matrices are never converted as a whole, see gram_eigenvalues()
+            sv = np.sqrt(np.sort(gram_eigenvalues(W))[-n_comp:])
+        else:
+            # a (k, N, M) stack is decomposed in a single batched call, keeping the top n_comp singular values of each matrix
+            dtype = svd_dtype(params)
+            logger.debug("Running full SVD:  W.shape={}  n_comp = {} dtype {}".format(W.shape, n_comp, np.dtype(dtype).name))
+            sv = np.linalg.svd(W.astype(dtype, copy=False), compute_uv=False)
+            
+            if dtype == np.float32 and params.get('precision') == PRECISION.AUTO and float32_error(sv) > PRECISION_TOLERANCE:
+                logger.info("float32 eigenvalues of W.shape={} not accurate enough (relative error {:.2g}), using float64"
+                            .format(W.shape, float32_error(sv)))
+                sv = np.linalg.svd(W.astype(np.float64, copy=False), compute_uv=False)
+                
+            sv = np.sort(sv.astype(np.float64, copy=False), axis=-1)[..., -n_comp:]
+            sv = sv.flatten()
+        # TODO:  move to PL fit for robust estimator
+        # if len(sv) > max_evals:
+        #    #logger.info("chosing {} singular values from {} ".format(max_evals, len(sv)))
+        #    sv = np.random.choice(sv, size=max_evals)
+
+        # sv = svd.singular_values_
+        evals = sv * sv
+        if normalize:
+            evals = evals / N
+
+        all_evals.extend(evals)
+
+        max_sv = np.max([max_sv, np.max(sv)])
+        max_ev = np.max(evals)
+        rank_loss = 0  # rank_loss + self.calc_rank_loss(sv, M, max_ev)
+
+    return np.sort(np.array(all_evals)), max_sv, rank_loss
+
+
+def conv2D_fft_eigenvalues(Wmats, kernel_size, N, M, params):
+    """Compute the eigenvalues of a conv2D layer as a linear operator, using the FFT of its kernel.
+    
+    The (rf, N, M) slices of the kernel are zero padded to an fft_grid x fft_grid grid (default: the kernel size)
+    and transformed once.  The singular values of the circular convolution over fft_grid x fft_grid inputs are then 
+    the singular values of the complex N x M matrices at each frequency, computed in a single batched SVD. 
+    W is real, so the frequencies (u, v) and (-u, -v) have the same singular values, and only half the grid is decomposed.
+    
+    The combined ESD is subsampled to max_evals eigenvalues (or rf x M, the size of the sliced ESD, 
+    if max_evals is not set), keeping evenly spaced order statistics, including lambda_max.
+    
+    Also returns max singular value and rank_loss, as combined_eigenvalues()
+    """
+    
+    imax, jmax = kernel_size
+    n = params.get('fft_grid') or max(imax, jmax)
+    if n < max(imax, jmax):
+        logger.warning("fft_grid {} smaller than the kernel size {}, using {}".format(n, kernel_size, max(imax, jmax)))
+        n = max(imax, jmax)
+    
+    Wmats = matrix_batches(Wmats)
+    if len(Wmats) == 1 and Wmats[0].ndim == 3:
+        W = Wmats[0]
+    else:
+        W = np.stack(list(iter_matrices(Wmats)))
+    # grouped convolutions have one (block diagonal) block per group in each slice
+    W = W.reshape(imax, jmax, -1, W.shape[1], W.shape[2]).astype(np.float64, copy=False)
+        
+    logger.debug("Running batched FFT SVD:  W.shape={}  fft grid {}x{}".format(W.shape, n, n))
+    coefs = np.fft.rfft2(W, s=(n, n), axes=(0, 1))
+    sv = np.linalg.svd(coefs, compute_uv=False)
+    
+    # the columns v = 1 .. (n-1)//2 of the half grid stand for the mirrored columns n - v too
+    num_mirrored = (n - 1) // 2
+    sv = np.concatenate([sv.flatten(), sv[:, 1:num_mirrored + 1].flatten()])
+    
+    evals = sv * sv
+    if params['normalize']:
+        evals = evals / N
+    evals = np.sort(evals)
+    
+    max_evals = params.get('max_evals') or imax * jmax * M
+    if len(evals) > max_evals:
+        logger.debug("subsampling {} FFT eigenvalues to {}".format(len(evals), max_evals))
+        evals = evals[np.linspace(0, len(evals) - 1, max_evals).round().astype(int)]
+    
+    return evals, np.max(sv), 0
+
+
+def stack_factors(factors):
+    """Stack the (B, A, scale) factors of a low rank layer into B (N_out x r) and A (r x M_in), with sum scale B A = B A"""
+    B = np.concatenate([scale * B.astype(np.float64) for B, A, scale in factors], axis=1)
+    A = np.concatenate([A.astype(np.float64) for B, A, scale in factors], axis=0)
+    return B, A
+
+
+def factor_singular_values(B, A):
+    """Singular values of B A, without forming it:  with B = Qb Rb and A^T = Qa Ra, B A = Qb (Rb Ra^T) Qa^T, 
+    so only the r x r matrix Rb Ra^T is decomposed"""
+    Rb = np.linalg.qr(B, mode='r')
+    Ra = np.linalg.qr(A.T, mode='r')
+    return np.linalg.svd(Rb @ Ra.T, compute_uv=False)
+
+
+def factored_eigenvalues(factors, N, M, params, norm=1.0):
+    """Compute the eigenvalues of the low rank update W = norm sum scale B A of a factored (LoRA) layer, 
+    from its factors only.  Only the r nonzero eigenvalues are returned, r the total rank of the factors.
+    
+    Also returns max singular value and rank_loss, as combined_eigenvalues()
+    """
+    
+    B, A = stack_factors(factors)
+    logger.debug("Running factored SVD:  B.shape={}  A.shape={}".format(B.shape, A.shape))
+    sv = np.sort(norm * factor_singular_values(B, A))[-M:]
+    
+    evals = sv * sv
+    if params['normalize']:
+        evals = evals / N
+        
+    return np.sort(evals), np.max(sv), 0
+
+
+def random_factored_eigenvalues(factors, num_replicas=1, norm=1.0, params=None, layer_key=(0,)):
+    """Eigenvalues of the low rank update, with the elements of each factor randomly shuffled, see random_eigenvalues()"""
+    
+    all_evals = []
+    
+    B, A = stack_factors(factors)
+    for num in range(num_replicas):
+        rng = replica_rng(params, layer_key, num)
+        Brand, Arand = B.flatten(), A.flatten()
+        rng.shuffle(Brand)
+        rng.shuffle(Arand)
+        
+        sv = norm * factor_singular_values(Brand.reshape(B.shape), Arand.reshape(A.shape))
+        all_evals.extend(sv * sv)
+        
+    return np.sort(np.array(all_evals))
+
+
+def replica_rng(params, layer_key, replica):
+    """Random generator of one replica of the randomized ESD of a layer.  
+    
+    With a seed (params['seed']), the generator is derived from (seed, layer_key, replica) only, so the generators 
+    of the layers and replicas are independent, and the randomized ESDs are the same whatever the number of workers, 
+    and the order the layers are computed in.  Without a seed, it is seeded from the OS entropy"""
+    
+    seed = params.get('seed') if params else None
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, *layer_key, replica])
+
+
+def num_random_replicas(n_comp):
+    """Number of randomized replicas of each W used to estimate the random ESD"""
+    # hack to improve random estimator if we don't have that many evals
+    if n_comp < 100:
+        return 5
+    return 1
+
+
+def random_sparse_eigenvalues(Wmats, n_comp, num_replicas=1, params=None, layer_key=(0,)):
+    """Eigenvalues of the sparse weight matrices, with the elements randomly shuffled: 
+    the nonzero weights are shuffled to random positions, so the random matrices are as sparse, see random_eigenvalues()"""
+    
+    from scipy import sparse
+    
+    all_evals = []
+    
+    logger.info("generating {} replicas for each sparse W of the random eigenvalues".format(num_replicas))
+    for num in range(num_replicas):
+        rng = replica_rng(params, layer_key, num)
+        for W in iter_matrices(Wmats):
+            W = to_csr(W).tocoo()
+            values = W.data[W.data != 0]
+            
+            positions = rng.choice(W.shape[0] * W.shape[1], size=len(values), replace=False)
+            rows, cols = np.unravel_index(positions, W.shape)
+            Wrand = sparse.csr_matrix((rng.permutation(values), (rows, cols)), shape=W.shape)
+            
+            evals = np.sort(sparse_gram_eigenvalues(Wrand))[-n_comp:]
+            all_evals.extend(evals)
+    
+    return np.sort(np.array(all_evals))
+
+
+def random_eigenvalues(Wmats, n_comp, num_replicas=1, params=None, layer_key=(0,)):
+    """Compute the eigenvalues for all weights of the NxM skipping layer, num evals ized weight matrices (N >= M),
+        combined into a single, sorted, numpy array.
+        
+    Each replica is shuffled with its own random generator, see replica_rng()
+
+    see: combined_eigenvalues()
+
+     """
+
+    all_evals = []
+
+    logger.info("generating {} replicas for each W of the random eigenvalues".format(num_replicas))
+    for num in range(num_replicas):
+        rng = replica_rng(params, layer_key, num)
+        for  W in iter_matrices(Wmats):
+
+            M, N = np.min(W.shape), np.max(W.shape)
+            Q = N / M
+
+            if is_quantized(W):
+                # shuffled and accumulated chunk by chunk, see random_gram_eigenvalues()
+                sv = np.sqrt(np.sort(random_gram_eigenvalues(W, rng))[-n_comp:])
+            else:
+                Wrand = W.flatten()
+                rng.shuffle(Wrand)
+                W = Wrand.reshape(W.shape)
+                # the randomized matrix is well conditioned, float32 is accurate enough for precision='auto'
+                W = W.astype(svd_dtype(params), copy=False)
+                logger.debug("Running Randomized Full SVD")
+                sv = np.linalg.svd(W, compute_uv=False)
+                sv = sv.astype(np.float64).flatten()
+                sv = np.sort(sv)[-n_comp:]
+
+            # sv = svd.singular_values_
+            evals = sv * sv
+            all_evals.extend(evals)
+
+    return np.sort(np.array(all_evals))
@@ -14,20 +14,12 @@
 #
 import sys, os
 import logging
+from types import MappingProxyType
 
 import numpy as np
-import pandas as pd
 
-import matplotlib
-import matplotlib.pyplot as plt
-import powerlaw
- 
-import tensorflow as tf
-from tensorflow import keras
-from tensorflow.keras.models import load_model
-
-import torch
-import torch.nn as nn
+# pandas, matplotlib and powerlaw are imported on first use, 
+# and the frameworks (tensorflow, torch) by the adapter of the model being analyzed
 
 #
 # this is use to allow editing in Eclipse but also
@@ -38,10 +30,28 @@ if __package__ is None or __package__ == '':
     # uses current directory visibility
     from RMT_Util import *
     from constants import *
+    from spectrum import combined_eigenvalues, random_eigenvalues, num_random_replicas, conv2D_fft_eigenvalues, \
+        factored_eigenvalues, random_factored_eigenvalues, sparse_eigenvalues, random_sparse_eigenvalues, \
+        matrix_sparsity, matrix_norm, is_sparse, dense_matrix, iter_matrices, SPARSE_THRESHOLD
+    from arena import WeightArena, arena_eigenvalues
+    from quantized import is_out_of_core, as_quantized
+    from memory import MemoryTracker
+    from catalog import LayerCatalog, matrix_shape, conv2D_shape, grouped_conv2D_shape
+    from adapters import get_adapter, framework_adapter
+    from adapters.checkpoint import is_checkpoint_file
 else:
     # uses current package visibility
     from .RMT_Util import *
     from .constants import *
+    from .spectrum import combined_eigenvalues, random_eigenvalues, num_random_replicas, conv2D_fft_eigenvalues, \
+        factored_eigenvalues, random_factored_eigenvalues, sparse_eigenvalues, random_sparse_eigenvalues, \
+        matrix_sparsity, matrix_norm, is_sparse, dense_matrix, iter_matrices, SPARSE_THRESHOLD
+    from .arena import WeightArena, arena_eigenvalues
+    from .quantized import is_out_of_core, as_quantized
+    from .memory import MemoryTracker
+    from .catalog import LayerCatalog, matrix_shape, conv2D_shape, grouped_conv2D_shape
+    from .adapters import get_adapter, framework_adapter
+    from .adapters.checkpoint import is_checkpoint_file
 
 # TODO:  allow configuring custom logging
 import logging
@@ -53,7 +63,22 @@ mpl_logger.setLevel(logging.WARNING)
 
 MAX_NUM_EVALS = 1000
 
-DEFAULT_PARAMS = {'glorot_fix': False, 'normalize':False, 'conv2d_norm':True, 'randomize': True}
+# read only: each analyze() / describe() call makes its own params, see make_params()
+DEFAULT_PARAMS = MappingProxyType({'glorot_fix': False, 'normalize':False, 'conv2d_norm':True, 'randomize': True, 
+                                   'min_evals': 0, 'max_evals': None, 'plot': False, 'mp_fit': False, 'ww2x': False, 
+                                   'workers': None, 'max_memory': None, 'conv2d_fft': False, 'fft_grid': None, 
+                                   'adapter_delta': False, 'precision': PRECISION.FLOAT64, 'glorot_check': False, 
+                                   'seed': None, 'prefetch': None, 'time_budget': None, 'priority': None})
+
+# the params that only rescale the eigenvalues, and can be swept with analyze_sweep()
+SWEEP_PARAMS = ['normalize', 'glorot_fix', 'conv2d_norm']
+    
+
+def make_params(params=DEFAULT_PARAMS, **options):
+    """Frozen params of one call: params (by default, DEFAULT_PARAMS) updated with the options.
+    The params are passed down the apply_xxx() methods and never changed, so that concurrent calls 
+    (in threads, or async tasks) can not change each other's settings"""
+    return MappingProxyType(dict(params, **options))
     
 
 def main():
@@ -68,7 +93,8 @@ class WWLayer:
        Uses pythong metaprogramming to add result columns for the final details dataframe"""
        
     def __init__(self, layer, layer_id=-1, name=None,
-                 the_type=LAYER_TYPE.UNKNOWN, framework=FRAMEWORK.UNKNOWN, skipped=False):
+                 the_type=LAYER_TYPE.UNKNOWN, framework=FRAMEWORK.UNKNOWN, skipped=False, adapter=None, lazy=False, 
+                 entry=None):
         self.layer = layer
         self.layer_id = layer_id  
         self.name = name
@@ -76,18 +102,36 @@ class WWLayer:
         self.the_type = the_type
         self.framework = framework
         
+        # framework specific type detection and weight extraction
+        self.adapter = adapter or framework_adapter(framework)
+        
         self.channels = CHANNELS.UNKNOWN
-
-        if (self.framework == FRAMEWORK.KERAS):
-            self.channels = CHANNELS.FIRST
-        elif (self.framework == FRAMEWORK.PYTORCH):
-            self.channels = CHANNELS.LAST
+        if self.adapter is not None:
+            self.channels = self.adapter.layer_channels(self.layer)
         
-        # get the LAYER_TYPE
-        self.the_type = self.layer_type(self.layer)
+        # get the LAYER_TYPE, from the catalog entry if available
+        if entry is not None:
+            self.the_type = entry.the_type
+        else:
+            self.the_type = self.layer_type(self.layer)
+            
+        # number of groups of grouped and depthwise convolutions
+        self.groups = 1
+        if entry is not None:
+            self.groups = entry.groups
+        elif self.adapter is not None and self.the_type == LAYER_TYPE.CONV2D:
+            self.groups = self.adapter.layer_groups(self.layer)
+            
+        # rank of the low rank factors (B, A) of factored (LoRA) layers, 0 otherwise
+        self.rank = 0
+        if entry is not None:
+            self.rank = entry.rank
+        elif self.adapter is not None:
+            self.rank = self.adapter.factors_rank(self.layer)
+        self.factors = None
         
         if self.name is None and hasattr(self.layer, 'name'):
-            name = self.layer.name
+            self.name = self.layer.name
 
         # original weights (tensor) and biases
         self.has_weights = False
@@ -101,8 +145,16 @@ class WWLayer:
         self.M = 0
         self.num_components = self.M  # default for full SVD, not used yet
         self.rf = 1  # receptive field size, default for dense layer
+        self.kernel_size = None  # (i, j) for conv2D layers
         self.conv2d_count = 1  # reset by slice iterator for back compatability with ww2x
         self.w_norm = 1 # reset if normalize, conv2D_norm, or glorot_fix used
+        
+        # fraction of zero weights, and whether the ESD is computed from sparse matrices (pruned or sparse weights)
+        self.sparsity = None
+        self.sparse = False
+        
+        # the matrix is streamed from memory (or disk), and never copied as a whole, see is_out_of_core()
+        self.out_of_core = False
 
         # to be used for conv2d_fft approach
         self.inputs_shape = []
@@ -114,13 +166,22 @@ class WWLayer:
         
         # details, set by metaprogramming in apply_xxx() methods
         self.columns = []
-        self.make_weights()
+        
+        # lazy layers only know the shapes, until make_weights() is called
+        if lazy or entry is not None:
+            self.set_metadata(entry)
+        else:
+            self.make_weights()
         
     def add_column(self, name, value):
         """Add column to the details dataframe"""
         self.columns.append(name)
         self.__dict__[name] = value
         
+    def random_key(self):
+        """Key of the random streams of the layer (and slice, in ww2x mode), see spectrum.replica_rng()"""
+        return (self.layer_id, self.__dict__.get('slice_id', 0))
+        
     def get_row(self):
         """get a details dataframe row from the columns and metadata"""
         data = {}
@@ -131,6 +192,12 @@ class WWLayer:
         data['N'] = self.N
         data['M'] = self.M
         data['rf'] = self.rf
+        if self.groups > 1:
+            data['groups'] = self.groups
+        if self.rank:
+            data['factor_rank'] = self.rank
+        if self.sparsity is not None:
+            data['sparsity'] = self.sparsity
         
         for col in self.columns:
             data[col] = self.__dict__[col]
@@ -141,60 +208,35 @@ class WWLayer:
         """Given a framework layer, determine the weightwatcher LAYER_TYPE
         This can detect basic Keras and PyTorch classes by type, and will try to infer the type otherwise. """
 
-        the_type = LAYER_TYPE.UNKNOWN
-       
-        typestr = (str(type(layer))).lower()
-            
-        # Keras TF 2.x types
-        if isinstance(layer, keras.layers.Dense): 
-            the_type = LAYER_TYPE.DENSE
-            
-        elif isinstance(layer, keras.layers.Conv1D):                
-            the_type = LAYER_TYPE.CONV1D
-        
-        elif isinstance(layer, keras.layers.Conv2D):                
-            the_type = LAYER_TYPE.CONV2D
-            
-        elif isinstance(layer, keras.layers.Flatten):
-            the_type = LAYER_TYPE.FLATTENED
-            
-        elif isinstance(layer, keras.layers.Embedding):
-            the_type = LAYER_TYPE.EMBEDDING
-            
-        elif isinstance(layer, tf.keras.layers.LayerNormalization):
-            the_type = LAYER_TYPE.NORM
+        if self.adapter is None:
+            return LAYER_TYPE.UNKNOWN
         
-        # PyTorch        
-             
-        elif isinstance(layer, nn.Linear):
-            the_type = LAYER_TYPE.DENSE
-            
-        elif isinstance(layer, nn.Conv1d):
-            the_type = LAYER_TYPE.CONV1D
-        
-        elif isinstance(layer, nn.Conv2d):
-            the_type = LAYER_TYPE.CONV2D
-            
-        elif isinstance(layer, nn.Embedding):
-            the_type = LAYER_TYPE.EMBEDDING
-                
-        elif isinstance(layer, nn.LayerNorm):
-            the_type = LAYER_TYPE.NORM
-        
-        # try to infer type (i.e for huggingface)
-        elif typestr.endswith(".linear'>"):
-            the_type = LAYER_TYPE.DENSE
-            
-        elif typestr.endswith(".dense'>"):
-            the_type = LAYER_TYPE.DENSE
+        return self.adapter.cached_layer_type(layer)
+    
+    def set_metadata(self, entry=None):
+        """Set has_weights, N, M and rf from the shape of the weights only (or the catalog entry), without extracting them. 
+        This is enough to apply the filters, and decide if the layer is supported"""
+        
+        shape = None
+        if self.skipped:
+            pass
+        elif entry is not None:
+            shape = entry.shape
+        elif self.adapter is not None:
+            shape = self.adapter.weights_shape(self.layer)
             
-        elif typestr.endswith(".conv1d'>"):
-            the_type = LAYER_TYPE.CONV1D
+        self.has_weights = shape is not None
+        if self.has_weights:
+            self.N, self.M, self.rf, channels = self.matrix_shape(shape)
+            if channels != CHANNELS.UNKNOWN:
+                self.channels = channels
+            self.num_components = self.M
             
-        elif typestr.endswith(".conv2d'>"):
-            the_type = LAYER_TYPE.CONV2D
-        
-        return the_type
+        return self
+    
+    def matrix_shape(self, shape):
+        """N, M, rf and channels of the weight matrices, given the shape of the weights (tensor)"""
+        return matrix_shape(self.the_type, shape, self.groups, self.channels)
     
     def make_weights(self):
         """ Constructor for WWLayer class.  Make a ww (wrapper)_layer from a framework layer, or return None if layer is skipped.
@@ -210,7 +252,12 @@ class WWLayer:
             if has_biases:
                 self.biases = biases   
                 
-            if has_weights:    
+            # the factors are kept as is, W = W_base + sum scale B A is only formed if needed
+            if self.rank:
+                self.factors = self.adapter.layer_factors(self.layer)
+                self.has_weights = has_weights or self.factors is not None
+                
+            if self.has_weights:    
                 self.weights = weights
                 self.set_weight_matrices(weights)
     
@@ -219,43 +266,24 @@ class WWLayer:
     def get_weights_and_biases(self):
         """extract the original weights (as a tensor) for the layer, and biases for the layer, if present"""
         
-        has_weights, has_biases = False, False
-        weights, biases = None, None
-    
-        if self.framework == FRAMEWORK.PYTORCH:
-            if hasattr(self.layer, 'weight'):
-                w = [np.array(self.layer.weight.data.clone().cpu())]
-                has_weights = True
-                
-        elif self.framework == FRAMEWORK.KERAS:
-            w = self.layer.get_weights()
-            if(len(w) > 0):
-                has_weights = True
-                
-            if(len(w) > 1):
-                has_biases = True
-                
-        else:
+        if self.adapter is None:
             logger.error("unknown framework: weighwatcher only supports keras (tf 2.x) or pytorch ")
-       
-        if has_weights:
-            if len(w) == 1:
-                logger.debug("Linear weights shape  len(w){} type(w){}  w.shape {} ".format(len(w), type(w), w[0].shape))
-                weights = w[0]
-                biases = None
-            elif len(w) == 2:
-                weights = w[0]
-                biases = w[1]
-            else:
-                logger.error("unknown weights, with len(w)={} ".format(len(w)))
+            return False, None, False, None
         
-        return has_weights, weights, has_biases, biases  
+        return self.adapter.get_weights_and_biases(self.layer)
+    
+    def release(self):
+        """Drop the framework layer, weights, matrices and eigenvalues, keeping only the metadata and details columns"""
+        self.layer = None
+        self.weights, self.biases, self.factors = None, None, None
+        self.Wmats = []
+        self.evals, self.rand_evals = None, None
       
     def set_weight_matrices(self, weights, conv2d_fft=False, conv2d_norm=True):
         """extract the weight matrices from the framework layer weights (tensors)
         sets the weights and detailed properties on the ww (wrapper) layer 
     
-        conv2d_fft not supported yet """
+        conv2d_fft is applied to the conv2D matrices when computing the ESD, see conv2D_fft_eigenvalues() """
    
         if not self.has_weights:
             logger.info("Layer {} {} has no weights".format(self.layer_id, self.name))
@@ -267,17 +295,35 @@ class WWLayer:
         Wmats = []
         
         # this may change if we treat Conv1D differently layer
-        if (the_type == LAYER_TYPE.DENSE or the_type == LAYER_TYPE.CONV1D):
+        if the_type == LAYER_TYPE.DENSE and self.weights is None and self.factors is not None:
+            # only the low rank factors (i.e. a LoRA adapter checkpoint), see factored_eigenvalues()
+            B, A, scale = self.factors[0]
+            N, M = max(B.shape[0], A.shape[1]), min(B.shape[0], A.shape[1])
+            n_comp = M
+            rf = 1
+            
+        elif the_type in [LAYER_TYPE.DENSE, LAYER_TYPE.CONV1D, LAYER_TYPE.EMBEDDING]:
             Wmats = [self.weights]
             N, M = np.max(Wmats[0].shape), np.min(Wmats[0].shape)
             n_comp = M
             rf = 1
             
+            # i.e. large memory mapped embedding tables, streamed by row blocks into the M x M Gram matrix
+            if is_out_of_core(self.weights):
+                logger.info("Layer {} {} {} is streamed out of core".format(self.layer_id, self.name, self.weights.shape))
+                self.out_of_core = True
+                Wmats = [as_quantized(self.weights)]
+            
         # TODO: reset channels nere ?    
+        elif the_type == LAYER_TYPE.CONV2D and self.groups > 1:
+            Wmats, N, M, rf, n_comp = self.grouped_conv2D_Wmats(weights, self.groups)
+            self.kernel_size = grouped_conv2D_shape(weights.shape, self.channels)[2:4]
+            
         elif the_type == LAYER_TYPE.CONV2D:
             Wmats, N, M, rf, channels = self.conv2D_Wmats(weights)
             n_comp = M
             self.channels = channels
+            self.kernel_size = self.conv2D_shape(weights.shape)[2:4]
             
         elif the_type == LAYER_TYPE.NORM:
             logger.info("Layer id {}  Layer norm has no matrices".format(self.layer_id))
@@ -291,6 +337,10 @@ class WWLayer:
         self.Wmats = Wmats
         self.num_components = n_comp
         
+        if weights is not None and len(Wmats) > 0:
+            self.sparsity = matrix_sparsity(weights)
+            self.sparse = is_sparse(weights) or self.sparsity >= SPARSE_THRESHOLD
+        
         return 
         
     def __repr__(self):
@@ -302,53 +352,74 @@ class WWLayer:
     
     def conv2D_Wmats(self, Wtensor, channels=CHANNELS.UNKNOWN):
         """Extract W slices from a 4 layer_id conv2D tensor of shape: (N,M,i,j) or (M,N,i,j).  
-        Return ij (N x M) matrices, with receptive field size (rf) and channels flag (first or last)"""
+        Return the ij (N x M) matrices as a single (rf, N, M) strided view of the tensor (no copy), 
+        with receptive field size (rf) and channels flag (first or last)"""
         
         logger.debug("conv2D_Wmats")
         
         # TODO:  detect or use channels
         # if channels specified ...
     
-        Wmats = []
-        s = Wtensor.shape
-        N, M, imax, jmax = s[0], s[1], s[2], s[3]
-        if N + M >= imax + jmax:
-            logger.debug("Channels Last tensor shape detected: {}x{} (NxM), {}x{} (i,j)".format(N, M, imax, jmax))
-            
-            channels = CHANNELS.LAST
-            for i in range(imax):
-                for j in range(jmax):
-                    W = Wtensor[:, :, i, j]
-                    if N < M:
-                        W = W.T
-                    Wmats.append(W)
-        else:
-            N, M, imax, jmax = imax, jmax, N, M          
-            logger.debug("Channels First shape detected: {}x{} (NxM), {}x{} (i,j)".format(N, M, imax, jmax))
-            
-            channels = CHANNELS.FIRST
-            for i in range(imax):
-                for j in range(jmax):
-                    W = Wtensor[i, j, :, :]
-                    if N < M:
-                        W = W.T
-                    Wmats.append(W)
-                    
+        N, M, imax, jmax, channels = self.conv2D_shape(Wtensor.shape)
         rf = imax * jmax  # receptive field size             
+        
+        if channels == CHANNELS.LAST:
+            # (N, M, i, j) -> (i, j, N, M)
+            Wtensor = Wtensor.transpose(2, 3, 0, 1)
+            
+        # slice ij is Wmats[i * jmax + j]
+        Wmats = Wtensor.reshape(rf, Wtensor.shape[2], Wtensor.shape[3])
+        if N < M:
+            Wmats = Wmats.swapaxes(1, 2)
+                    
         logger.debug("get_conv2D_Wmats N={} M={} rf= {} channels = {}".format(N, M, rf, channels))
     
         return Wmats, N, M, rf, channels    
+    
+    def grouped_conv2D_Wmats(self, Wtensor, groups):
+        """Extract the blocks of a grouped (or depthwise) conv2D tensor, in the channels layout of the framework.
+        
+        The out x in operator of each slice ij is block diagonal, with one (out/groups) x (in/groups) block per group, 
+        so its ESD is the union of the ESDs of the blocks.  Return the blocks as a single (rf x groups, n, m) view, 
+        with n >= m, together with N x M, the shape of the whole operator, rf, and the number of components m of each block"""
+        
+        out_channels, group_channels, imax, jmax = grouped_conv2D_shape(Wtensor.shape, self.channels)
+        rf = imax * jmax
+        
+        if self.channels == CHANNELS.FIRST:
+            # (i, j, in/groups, out) -> (i, j, out, in/groups)
+            Wtensor = Wtensor.swapaxes(2, 3)
+        else:
+            # (out, in/groups, i, j) -> (i, j, out, in/groups)
+            Wtensor = Wtensor.transpose(2, 3, 0, 1)
+            
+        # block g of slice ij is Wmats[(i * jmax + j) * groups + g]
+        n, m = out_channels // groups, group_channels
+        Wmats = Wtensor.reshape(rf * groups, n, m)
+        if n < m:
+            Wmats = Wmats.swapaxes(1, 2)
+            
+        in_channels = group_channels * groups
+        N, M = max(out_channels, in_channels), min(out_channels, in_channels)
+        logger.debug("grouped_conv2D_Wmats N={} M={} rf={} groups={} blocks {}x{}".format(N, M, rf, groups, n, m))
+        
+        return Wmats, N, M, rf, min(n, m)
+    
+    def conv2D_shape(self, s):
+        """N, M, i, j and channels of a conv2D tensor of shape: (N,M,i,j) or (i,j,N,M) """
+        return conv2D_shape(s)
 
 
 class ModelIterator:
     """Iterator that loops over ww wrapper layers, with original matrices (tensors) and biases (optional) available."""
 
-    def __init__(self, model, params=DEFAULT_PARAMS):
+    def __init__(self, model, params=DEFAULT_PARAMS, catalog=None):
         
         self.params = params
         self.k = 0
         
         self.model = model
+        self.catalog = catalog
         self.model_iter, self.framework = self.model_iter_(model) 
         
         self.layer_iter = self.make_layer_iter_()            
@@ -369,31 +440,18 @@ class ModelIterator:
     
     def model_iter_(self, model):
         """Return a generator for iterating over the layers in the model.  
-        Also detects the framework being used. 
+        Also detects the framework being used, loads its adapter, and builds the layer catalog if not given. 
         Used by base class and child classes to iterate over the framework layers """
-        layer_iter = None
         
-        if hasattr(model, 'layers'):
-
-            def layer_iter_():
-                for layer in model.layers:
-                        yield layer 
-                        
-            layer_iter = layer_iter_()
-            framework = FRAMEWORK.KERAS
-        elif hasattr(model, 'modules'):
-
-            def layer_iter_():
-                for layer in model.modules():
-                        yield layer 
-                        
-            layer_iter = layer_iter_()    
-            framework = FRAMEWORK.PYTORCH
-        else:
-            layer_iter = None
-            framework = FRAMEWORK.UNKNOWN
+        self.adapter = get_adapter(model)
+        if self.adapter is None:
+            logger.error("unknown framework: weighwatcher only supports keras (tf 2.x) or pytorch ")
+            return None, FRAMEWORK.UNKNOWN
+        
+        if self.catalog is None or self.catalog.model is not model:
+            self.catalog = LayerCatalog(model, self.adapter)
             
-        return layer_iter, framework
+        return (entry.layer for entry in self.catalog), self.adapter.framework
                       
     def make_layer_iter_(self):
         """The layer iterator for this class / instance.
@@ -404,9 +462,11 @@ class ModelIterator:
 class WWLayerIterator(ModelIterator):
     """Creates an iterator that generates WWLayer wrapper objects to the model layers"""
 
-    def __init__(self, model, params=DEFAULT_PARAMS, filters=[]):
+    def __init__(self, model, params=DEFAULT_PARAMS, filters=[], catalog=None, metadata_only=False):
         
-        super().__init__(model, params=params)
+        # metadata only layers have N, M and rf, but no weights or matrices (see describe)
+        self.metadata_only = metadata_only
+        super().__init__(model, params=params, catalog=catalog)
         
         self.filter_ids = []
         self.filter_types = []
@@ -464,11 +524,17 @@ class WWLayerIterator(ModelIterator):
         return ww_layer.skipped
     
     def ww_layer_iter_(self):
-        """Create a generator for iterating over ww_layers, created lazily """
-        for curr_layer in self.model_iter:
-            curr_id, self.k = self.k, self.k + 1
+        """Create a generator for iterating over ww_layers, created lazily.
+        The filters are looked up in the layer catalog, and applied to the layer metadata (shapes), 
+        and the weights are only extracted for the layers kept"""
+        if self.catalog is None:
+            return
+        
+        for entry in self.catalog.select(self.filter_ids, self.filter_names, self.filter_types):
+            self.k = entry.layer_id + 1
             
-            ww_layer = WWLayer(curr_layer, layer_id=curr_id, framework=self.framework)
+            ww_layer = WWLayer(entry.layer, layer_id=entry.layer_id, name=entry.name, framework=self.framework, 
+                               adapter=self.adapter, entry=entry)
             
             self.apply_filters(ww_layer)
             
@@ -476,6 +542,8 @@ class WWLayerIterator(ModelIterator):
                 ww_layer.skipped = True
                         
             if not ww_layer.skipped:
+                if not self.metadata_only:
+                    ww_layer.make_weights()
                 yield ww_layer    
                 
     def make_layer_iter_(self):
@@ -510,7 +578,11 @@ class WWLayerIterator(ModelIterator):
             logger.debug("layer not supported: Layer {} {} type {} unknown".format(layer_id, name, the_type))
             return False
         
-        elif the_type in [LAYER_TYPE.FLATTENED, LAYER_TYPE.NORM]:
+        elif the_type is LAYER_TYPE.EMBEDDING and not self.embeddings_selected():
+            logger.debug("layer not supported: Layer {} {} embeddings are only analyzed on request".format(layer_id, name))
+            return False
+        
+        elif the_type not in [LAYER_TYPE.DENSE, LAYER_TYPE.CONV1D, LAYER_TYPE.CONV2D, LAYER_TYPE.EMBEDDING]:
             logger.debug("layer not supported: Layer {} {} type {} not supported".format(layer_id, name, the_type))
             return False
         
@@ -522,33 +594,48 @@ class WWLayerIterator(ModelIterator):
             logger.debug("layer not supported: Layer {} {}: num_evals {} > max_evals {}".format(layer_id, name, N * rf, max_evals))
             return False
         
-        elif the_type in [LAYER_TYPE.DENSE, LAYER_TYPE.CONV1D, LAYER_TYPE.CONV2D]:
+        elif the_type in [LAYER_TYPE.DENSE, LAYER_TYPE.CONV1D, LAYER_TYPE.CONV2D, LAYER_TYPE.EMBEDDING]:
             supported = True
                         
         return supported
     
+    def embeddings_selected(self):
+        """Embeddings (often very large tables) are only analyzed when selected, by type, or by id or name"""
+        return LAYER_TYPE.EMBEDDING in self.filter_types or len(self.filter_ids) > 0 or len(self.filter_names) > 0
+    
 
 class WW2xSliceIterator(WWLayerIterator):
     """Iterator variant that breaks Conv2D layers into slices for back compatability"""
-    from copy import deepcopy
 
     def ww_slice_iter_(self):
         
         for ww_layer in self.ww_layer_iter_():
             if ww_layer.the_type == LAYER_TYPE.CONV2D:
                 
-                count = len(ww_layer.Wmats)
-                for iw, W in enumerate(ww_layer.Wmats):
-                    ww_slice = deepcopy(ww_layer)
-                    ww_slice.Wmats = [W]
-                    ww_slice.conv2d_count = count
-                    ww_slice.add_column("slice_id", iw)
-                    yield ww_slice
+                # one slice per receptive field position, the matrices are not available in metadata only mode
+                count = ww_layer.rf
+                for iw in range(count):
+                    yield self.make_slice(ww_layer, iw, count)
 
             else:
                 ww_layer.add_column("slice_id", 0)
                 yield ww_layer
                 
+    def make_slice(self, ww_layer, iw, count):
+        """Slim copy of the layer for slice iw: the framework layer, weights and metadata are shared with the layer, 
+        and the slice only references its own (1, N, M) view of the conv2D matrices"""
+        from copy import copy  # not shutil.copy, from RMT_Util
+        
+        ww_slice = copy(ww_layer)
+        ww_slice.columns = list(ww_layer.columns)
+        # grouped convolutions have one block per group in each slice
+        g = ww_layer.groups
+        ww_slice.Wmats = ww_layer.Wmats[iw*g:(iw+1)*g]
+        ww_slice.evals, ww_slice.rand_evals = None, None
+        ww_slice.conv2d_count = count
+        ww_slice.add_column("slice_id", iw)
+        return ww_slice
+                
     def make_layer_iter_(self):
         return self.ww_slice_iter_()
     
@@ -558,6 +645,9 @@ class WeightWatcher(object):
     def __init__(self, model=None, log=True):
         self.model = self.load_model(model)
         self.details = None
+        self.skipped_layers = []
+        self.catalog = None
+        self.svd_rate = None  # see svd_rate_()
         # self.setup_custom_logger(log, logger)     
         logger.info(self.banner())
 
@@ -591,8 +681,13 @@ class WeightWatcher(object):
     def banner(self):
         versions = "\npython      version {}".format(sys.version)
         versions += "\nnumpy       version {}".format(np.__version__)
-        versions += "\ntensforflow version {}".format(tf.__version__)
-        versions += "\nkeras       version {}".format(tf.keras.__version__)
+        
+        # only report the frameworks already loaded, the banner should not import tensorflow or torch
+        adapter = get_adapter(self.model) if self.model is not None else None
+        if adapter is not None:
+            for name, version in adapter.versions():
+                versions += "\n{:<11} version {}".format(name, version)
+                
         return "\n{}{}".format(self.header(), versions)
 
     def __repr__(self):
@@ -602,16 +697,36 @@ class WeightWatcher(object):
             
     # TODO: get rid of this or extend to be more generally useful
     def load_model(self, model):
-        """load the model from a file, only works for keras right now"""
+        """load the model from a file. 
+        PyTorch state_dicts, npz, safetensors and Keras HDF5 files, and TF checkpoints, are read lazily, 
+        without building the model (see adapters.checkpoint), other files are loaded as keras models"""
         res = model
         if isinstance(model, str):
-            if os.path.isfile(model):
+            if os.path.isfile(model) or is_checkpoint_file(model):
                 logger.info("Loading model from file '{}'".format(model))
-                res = load_model(model)
+                if is_checkpoint_file(model):
+                    res = framework_adapter(FRAMEWORK.CHECKPOINT).load_model(model)
+                else:
+                    res = framework_adapter(FRAMEWORK.KERAS).load_model(model)
             else:
                 logger.error("Loading model from file '{}': file not found".format(model))
         return res
     
+    def layer_catalog(self, model=None, refresh=False):
+        """Return the LayerCatalog of the model (or file name), built once and cached.  
+        The catalog is rebuilt if the layers of the model (or the file) have been changed since, 
+        or if refresh=True"""
+        
+        model = model or self.model
+        # the cached catalog is read once, another call (thread) may replace it for another model
+        catalog = self.catalog
+        if refresh or catalog is None or not catalog.describes(model):
+            loaded = self.load_model(model)
+            catalog = LayerCatalog(loaded, get_adapter(loaded), source=model)
+            self.catalog = catalog
+            
+        return catalog
+    
     # TODO: implement
     def same_models(self, model_1, model_2):
         """Compare models to see if the are the same architecture.
@@ -636,6 +751,7 @@ class WeightWatcher(object):
         models should be the same size and from the same framework
            
         """
+        import pandas as pd
         
         # check and throw exception if inputs incorrect
         # TODO: review design here...may need something else
@@ -662,7 +778,7 @@ class WeightWatcher(object):
                 data['name'] = layer_1.name
     
                 if layer_1.has_weights:
-                    data['delta_W'] = np.linalg.norm(layer_1.weights - layer_2.weights)
+                    data['delta_W'] = matrix_norm(layer_1.weights - layer_2.weights)
                     data['W_shape'] = layer_1.weights.shape
     
                     if layer_1.has_biases:
@@ -682,97 +798,95 @@ class WeightWatcher(object):
         """Compute the eigenvalues for all weights of the NxM weight matrices (N >= M), 
             combined into a single, sorted, numpy array
     
-            Applied normalization and glorot_fix if specified
-    
-            Assumes an array of weights comes from a conv2D layer and applies conv2d_norm normalization by default
-    
-            Also returns max singular value and rank_loss, needed for other calculations
+            see: spectrum.combined_eigenvalues()
          """
-    
-        all_evals = []
-        max_sv = 0.0
-        rank_loss = 0
-    
-        # TODO:  allow user to specify
-        normalize = params['normalize']
-        glorot_fix = params['glorot_fix']
-        conv2d_norm = params['conv2d_norm']  # True
-        
-        if type(Wmats) is not list:
-            logger.debug("combined_eigenvalues: Wmats -> [WMmats]")
-            Wmats = [Wmats]
-    
-        count = len(Wmats)
-        for  W in Wmats:
-    
-            Q = N / M  
-            # SVD can be swapped out here
-            # svd = TruncatedSVD(n_components=M-1, n_iter=7, random_state=10)
-    
-            W = W.astype(float)
-            logger.debug("Running full SVD:  W.shape={}  n_comp = {}".format(W.shape, n_comp))
-            sv = np.linalg.svd(W, compute_uv=False)
-            sv = sv.flatten()
-            sv = np.sort(sv)[-n_comp:]
-            # TODO:  move to PL fit for robust estimator
-            # if len(sv) > max_evals:
-            #    #logger.info("chosing {} singular values from {} ".format(max_evals, len(sv)))
-            #    sv = np.random.choice(sv, size=max_evals)
-    
-            # sv = svd.singular_values_
-            evals = sv * sv
-            if normalize:
-                evals = evals / N
-    
-            all_evals.extend(evals)
-    
-            max_sv = np.max([max_sv, np.max(sv)])
-            max_ev = np.max(evals)
-            rank_loss = 0  # rank_loss + self.calc_rank_loss(sv, M, max_ev)
-    
-        return np.sort(np.array(all_evals)), max_sv, rank_loss
+        return combined_eigenvalues(Wmats, N, M, n_comp, params)
             
+    def apply_factors(self, ww_layer, params=DEFAULT_PARAMS):
+        """Set the matrices of a factored (LoRA) layer, with low rank update sum scale B A. 
+        
+        By default, the update is merged into the base weights, W = W_base + sum scale B A, and W is analyzed as a dense layer.  
+        With adapter_delta (or if the base weights are not available), only the update is analyzed: 
+        no matrix is formed, and the norm is applied to the eigenvalues of the factors, see factored_eigenvalues()"""
+        
+        if params.get('adapter_delta') or ww_layer.weights is None:
+            ww_layer.Wmats = []
+            ww_layer.w_norm = 1 / np.sqrt(ww_layer.N) if params['normalize'] else 1.0
+            ww_layer.num_components = min(ww_layer.rank, ww_layer.M)
+            return ww_layer
+        
+        W = dense_matrix(ww_layer.weights)
+        for B, A, scale in ww_layer.factors:
+            delta = B.astype(np.float64) @ A.astype(np.float64)
+            if delta.shape != W.shape:
+                delta = delta.T
+            W += scale * delta
+            
+        ww_layer.Wmats = [W]
+        ww_layer.sparse = False
+        return ww_layer
             
     def apply_normalize_Wmats(self, ww_layer, params=DEFAULT_PARAMS):
-        """Normalize the W matrix or Wmats """
-
-        normalize = params['normalize']
-        glorot_fix = params['glorot_fix']
-        conv2d_norm = params['conv2d_norm']
+        """Set the norm of the layer weight matrices (normalize, conv2d_norm or glorot_fix), w_norm. 
+        
+        All these normalizations are scalar, so the matrices are not rescaled (or copied): 
+        the eigenvalues are scaled by w_norm^2 once computed, see set_esd().  
+        The Glorot normalization check is only computed if glorot_check is set"""
         
+        if ww_layer.factors is not None:
+            self.apply_factors(ww_layer, params)
+            if len(ww_layer.Wmats) == 0:
+                return ww_layer
+
         M = ww_layer.M
         N = ww_layer.N
-        rf = ww_layer.rf
-        norm = ww_layer.w_norm # shoud be 1.0 unless reset for some reason
+        rf_size = ww_layer.conv2d_count
         
-        Wmats = ww_layer.Wmats
-        new_Wmats = []
-        
-        if type(Wmats) is not list:
-            logger.debug("combined_eigenvalues: Wmats -> [WMmats]")
-            Wmats = [Wmats]
-               
-        for  W in Wmats:
-            # not really used
-            rf_size = ww_layer.conv2d_count
-            check, checkTF = self.glorot_norm_check(W, N, M, rf_size) 
-            
-            if glorot_fix:
-                norm = self.glorot_norm_fix(W, N, M, rf_size)
-                
-            elif conv2d_norm and ww_layer.the_type is LAYER_TYPE.CONV2D:
-                # w_norm is reset in slices to fix this
-                norm = np.sqrt(ww_layer.conv2d_count/2.0)
-                
-            if normalize and not glorot_fix:
-                norm = 1 / np.sqrt(N)
-               
-            W = W * norm
-            ww_layer.w_norm = norm
-            new_Wmats.append(W)
-    
-        ww_layer.Wmats = new_Wmats
+        if params.get('glorot_check'):
+            checks = [self.glorot_norm_check(W, N, M, rf_size) for W in iter_matrices(ww_layer.Wmats)]
+            ww_layer.add_column("glorot_check", np.mean([check for check, _ in checks]))
+            ww_layer.add_column("glorot_ok", all([checkTF for _, checkTF in checks]))
+            
+        ww_layer.w_norm = self.layer_norm(ww_layer, params)
         return ww_layer
+    
+    def layer_norm(self, ww_layer, params=DEFAULT_PARAMS):
+        """The norm of the layer weight matrices, w_norm, for the normalize, glorot_fix and conv2d_norm params"""
+        
+        N, M = ww_layer.N, ww_layer.M
+        if ww_layer.factors is not None and len(ww_layer.Wmats) == 0:
+            # only the low rank update is analyzed, see apply_factors()
+            return 1 / np.sqrt(N) if params['normalize'] else 1.0
+        
+        norm = 1.0
+        if params['glorot_fix']:
+            norm = self.glorot_norm(N, M, ww_layer.conv2d_count)
+            
+        elif params['conv2d_norm'] and ww_layer.the_type is LAYER_TYPE.CONV2D:
+            # w_norm is reset in slices to fix this
+            norm = np.sqrt(ww_layer.conv2d_count/2.0)
+            
+        if params['normalize'] and not params['glorot_fix']:
+            norm = 1 / np.sqrt(N)
+            
+        return norm
+    
+    def scaled_layer(self, ww_layer, params=DEFAULT_PARAMS):
+        """Slim copy of the layer, with the ESD (and randomized ESD) of the unnormalized layer 
+        scaled for the normalize, glorot_fix and conv2d_norm params, as if it was computed with them"""
+        from copy import copy
+        
+        scaled = copy(ww_layer)
+        scaled.columns = list(ww_layer.columns)
+        scaled.w_norm = self.layer_norm(ww_layer, params)
+        
+        # as in combined_eigenvalues(), normalize also divides the eigenvalues by N
+        evals = ww_layer.evals / ww_layer.N if params['normalize'] else ww_layer.evals
+        self.set_esd(scaled, evals, ww_layer.sv_max, ww_layer.rank_loss)
+        if ww_layer.rand_evals is not None:
+            scaled.rand_evals = ww_layer.rand_evals * scaled.w_norm**2
+            scaled.add_column("max_rand_eval", np.max(scaled.rand_evals))
+        return scaled
                 
         
                  
@@ -795,8 +909,24 @@ class WeightWatcher(object):
         Wmats = ww_layer.Wmats
         n_comp = ww_layer.num_components
                 
-        evals, sv_max, rank_loss = self.combined_eigenvalues(Wmats, N, M, n_comp, params)
+        if ww_layer.factors is not None and len(Wmats) == 0:
+            evals, sv_max, rank_loss = factored_eigenvalues(ww_layer.factors, N, M, params)
+        elif params.get('conv2d_fft') and the_type == LAYER_TYPE.CONV2D:
+            evals, sv_max, rank_loss = conv2D_fft_eigenvalues(Wmats, ww_layer.kernel_size, N, M, params)
+        elif ww_layer.sparse:
+            evals, sv_max, rank_loss = sparse_eigenvalues(Wmats, N, M, n_comp, params)
+        else:
+            evals, sv_max, rank_loss = self.combined_eigenvalues(Wmats, N, M, n_comp, params)
      
+        return self.set_esd(ww_layer, evals, sv_max, rank_loss)
+    
+    def set_esd(self, ww_layer, evals, sv_max, rank_loss):
+        """save the ESD, computed here or by a worker process, to the layer.
+        The eigenvalues are those of the unnormalized matrices, and are scaled by w_norm^2 here"""
+        
+        norm = ww_layer.w_norm
+        if norm != 1:
+            evals, sv_max = evals * norm**2, sv_max * norm
         ww_layer.evals = evals
         ww_layer.add_column("has_esd", True)
         ww_layer.add_column("num_evals", len(evals))
@@ -824,13 +954,23 @@ class WeightWatcher(object):
     
         Wmats = ww_layer.Wmats
         n_comp = ww_layer.num_components
-        num_replicas = 1
-        # hack to improve random estimator if we don't have that many evals
-        if n_comp < 100:
-            num_replicas = 5
+        num_replicas = num_random_replicas(n_comp)
+        layer_key = ww_layer.random_key()
         
-        rand_evals = self.random_eigenvalues(Wmats, n_comp, num_replicas , params)
+        if ww_layer.factors is not None and len(Wmats) == 0:
+            rand_evals = random_factored_eigenvalues(ww_layer.factors, num_replicas, params=params, layer_key=layer_key)
+        elif ww_layer.sparse:
+            rand_evals = random_sparse_eigenvalues(Wmats, n_comp, num_replicas, params, layer_key)
+        else:
+            rand_evals = self.random_eigenvalues(Wmats, n_comp, num_replicas , params, layer_key)
      
+        return self.set_random_esd(ww_layer, rand_evals, params)
+    
+    def set_random_esd(self, ww_layer, rand_evals, params=DEFAULT_PARAMS):
+        """save the randomized ESD, computed here or by a worker process, to the layer, scaled by w_norm^2 as in set_esd()"""
+        
+        if ww_layer.w_norm != 1:
+            rand_evals = rand_evals * ww_layer.w_norm**2
         ww_layer.rand_evals = rand_evals
         ww_layer.add_column("max_rand_eval", np.max(rand_evals))
         
@@ -842,6 +982,7 @@ class WeightWatcher(object):
            
     def apply_plot_esd(self, ww_layer, params=DEFAULT_PARAMS):
         """Plot the ESD on regular and log scale.  Only used when powerlaw fit not called"""
+        import matplotlib.pyplot as plt
                     
         evals = ww_layer.evals
         name = ww_layer.name
@@ -887,7 +1028,9 @@ class WeightWatcher(object):
     def analyze(self, model=None, layers=[], min_evals=0, max_evals=None,
                 min_size=None, max_size=None,  # deprecated
                 normalize=False, glorot_fix=False, plot=False, randomize=False, 
-                mp_fit=False, conv2d_fft=False,conv2d_norm=True, fit_bulk=False, ww2x=False):#, params=DEFAULT_PARAMS):
+                mp_fit=False, conv2d_fft=False,conv2d_norm=True, fit_bulk=False, ww2x=False, workers=None, 
+                max_memory=None, fft_grid=None, adapter_delta=False, precision=PRECISION.FLOAT64, glorot_check=False, 
+                seed=None, prefetch=None, time_budget=None, priority=None):#, params=DEFAULT_PARAMS):
         """
         Analyze the weight matrices of a model.
 
@@ -902,6 +1045,9 @@ class WeightWatcher(object):
             Ignored if glorot_norm is set
         glorot_fix:
             Adjust the norm for the Glorot Normalization.  
+        glorot_check:
+            Check if each layer is Glorot normalized, and report it in the glorot_check and glorot_ok columns
+            (default False, this takes a full pass over the weights)
         alphas:
             # deprecated
             Compute the power laws (alpha) of the weight matrices. 
@@ -919,19 +1065,66 @@ class WeightWatcher(object):
             Compute the best Marchenko-Pastur fit of each weight matrix ESD
         conv2d_fft:
             For Conv2D layers, use FFT method.  Otherwise, extract and combine the weight matrices for each receptive field
+            The ESD is the exact spectrum of the convolution (with circular padding) over fft_grid x fft_grid inputs.
             Note:  for conf2d_fft, the ESD is automatically subsampled to max_evals eigenvalues max
+            (or to rf x M eigenvalues, if max_evals is not set).  Not used in ww2x mode
+        fft_grid:
+            Size of the FFT grid for conv2d_fft (default None, the kernel size)
         fit_bulk: 
             Attempt to fit bulk region of ESD only  N/A yet
         ww2x:
             Use weightwatcher version 0.2x style iterator, which slices up Conv2D layers in N=rf matrices
+        workers:
+            Number of worker processes used to compute the ESDs (default None, in process).
+            The weight matrices are passed to the workers through a memory mapped arena, not pickled
+        max_memory:
+            Memory budget, in bytes (default None, no budget).  If set, the weights and matrices of each layer
+            are released as soon as its ESD is computed, only the details are kept, and the peak memory of each layer 
+            is reported in the peak_memory column: the bytes of its matrices and eigenvalues, or the peak traced 
+            by tracemalloc, if it was started by the caller (tracing slows down the analysis a lot, 
+            so it is never started by analyze).  In process, max_memory is a reporting 
+            threshold: a warning is logged for the layers that go over it, but they are still analyzed, and the 
+            prefetched layers are not limited.  Only with workers are the weight matrices in flight kept under the budget
+        adapter_delta:
+            For factored (LoRA) layers, analyze only the low rank update sum scale B A, computed from the factors, 
+            instead of the merged weights W_base + sum scale B A (default False).  Only the factors named lora_A and lora_B 
+            (peft and loralib layers, and LoRA checkpoints) are detected: a low rank layer written as two thin Linear (or Dense) 
+            layers is analyzed as two separate dense layers
+        precision:
+            Precision of the SVDs: 'float64' (default), 'float32' (half the memory, and about twice as fast), 
+            or 'auto': float32, recomputed in float64 for the layers where the float32 eigenvalues of the upper half
+            of the ESD (the power law fit and lambda_max) may be off by more than 1e-4 (relative)
+        seed:
+            Seed of the randomized ESDs (default None, not reproducible).  With a seed, each layer and replica 
+            has its own random stream, so the results are the same whatever the number of workers
+        prefetch:
+            Number of layers extracted ahead (weights copied to numpy, and sliced), in a background thread, 
+            while the ESD of the current layer is computed (default None, no prefetching).  
+            With max_memory, the prefetched layers count in the peak memory of the current layer
+        time_budget:
+            Time limit of the analysis, in seconds (default None, no limit).  The layers are skipped once it is passed, 
+            or if they are not predicted to finish in time (from their cost and the time of the layers done so far, 
+            or of a small SVD for the first layer).  With prefetch or workers, the layers extracted or in flight 
+            when it is passed are dropped (the ones already running in a worker are finished first).
+            The details have the rows of the layers done, and the ids of the skipped layers are in get_skipped_layers()
+        priority:
+            Order the layers are analyzed in (default None, the layer order): 'largest' (the most expensive layers first),
+            'smallest' (the cheapest first, to analyze as many layers as possible), or a mapping of layer ids to scores, 
+            highest first (i.e. the deviation of alpha from a previous analysis), the other layers last.  
+            The details are in the layer order.  Not used in ww2x mode
         device: N/A yet
             if 'gpu'  use torch.svd()
             else 'cpu' use np.linalg.svd
         params:  
             N/A as inputs: dictionary of default parameters, which can be set but will be over-written by 
         """
+        import time
+        import pandas as pd
+        
+        deadline = time.monotonic() + time_budget if time_budget else None
 
-        model = model or self.model   
+        catalog = self.layer_catalog(model)
+        model = catalog.model
         
         if min_size or max_size:
             logger.warn("min_size and max_size options changed to min_evals, max_evals, ignored for now")     
@@ -940,62 +1133,533 @@ class WeightWatcher(object):
         # can not specify params on input yet
         # maybe just have a different analyze() that only uses this 
         
-        params=DEFAULT_PARAMS
-        params['min_evals'] = min_evals 
-        params['max_evals'] = max_evals
-        params['plot'] = plot
-        params['randomize'] = randomize
-        params['mp_fit'] = mp_fit
-        params['normalize'] = normalize
-        params['glorot_fix'] = glorot_fix
-        params['conv2d_norm'] = conv2d_norm
-        params['ww2x'] = ww2x
+        if conv2d_fft and ww2x:
+            logger.warn("conv2d_fft applies to whole conv2D layers, ignored in ww2x mode")
+            conv2d_fft = False
+            
+        if (time_budget or priority is not None) and ww2x:
+            logger.warn("time_budget and priority apply to whole layers, ignored in ww2x mode")
+            deadline, time_budget, priority = None, None, None
+        
+        params = make_params(min_evals=min_evals, max_evals=max_evals, plot=plot, randomize=randomize, mp_fit=mp_fit, 
+                             normalize=normalize, glorot_fix=glorot_fix, glorot_check=glorot_check, conv2d_norm=conv2d_norm, 
+                             ww2x=ww2x, workers=workers, max_memory=max_memory, conv2d_fft=conv2d_fft, fft_grid=fft_grid, 
+                             adapter_delta=adapter_delta, precision=precision, seed=seed, prefetch=prefetch, 
+                             time_budget=time_budget, priority=priority)
 
             
         logger.info("params {}".format(params))
         if not self.valid_params(params):
             logger.error("Error, params not valid: \n {}".format(params))
+        
+        # a queue of maxsize < 1 is unbounded, so the prefetched layers would not be bounded in memory
+        if prefetch is not None and prefetch < 0:
+            raise ValueError("prefetch must be >= 0, got {}".format(prefetch))
    
+        candidates = []
         if ww2x:
             logger.info("Using weightwatcher 0.2x style layer and slice iterator")
-            layer_iterator = WW2xSliceIterator(model, filters=layers, params=params)     
+            layer_iterator = WW2xSliceIterator(model, filters=layers, params=params, catalog=catalog)     
+        elif time_budget or priority is not None:
+            # the weights are extracted when each layer is started, in the order of priority
+            layer_iterator = WWLayerIterator(model, filters=layers, params=params, catalog=catalog, metadata_only=True)
+            candidates = [ww_layer for ww_layer in layer_iterator if not ww_layer.skipped and ww_layer.has_weights]
+            layer_iterator = self.prioritized_iter_(candidates, params, deadline)
         else:
-            layer_iterator = WWLayerIterator(model, filters=layers, params=params)     
+            layer_iterator = WWLayerIterator(model, filters=layers, params=params, catalog=catalog)     
         
         details = pd.DataFrame(columns=['layer_id', 'name'])
+        
+        if prefetch:
+            logger.info("Extracting {} layers ahead in a background thread".format(prefetch))
+            layer_iterator = self.prefetch_iter_(layer_iterator, params)
+        
+        if workers and workers > 1:
+            logger.info("Computing the ESDs with {} worker processes".format(workers))
+            layer_iterator = self.parallel_esd_iter_(layer_iterator, params)
+        
+        tracker = None
+        if max_memory:
+            logger.info("Releasing the layer weights as soon as possible, max_memory {}".format(max_memory))
+            tracker = MemoryTracker(max_memory)
+            tracker.start()
            
-        for ww_layer in layer_iterator:
-            if not ww_layer.skipped and ww_layer.has_weights:
-                logger.info("LAYER: {} {}  : {}".format(ww_layer.layer_id, ww_layer.the_type, type(ww_layer.layer)))
-                
-                self.apply_normalize_Wmats(ww_layer, params)
-                self.apply_esd(ww_layer, params)
-                
+        try:
+            for ww_layer in layer_iterator:
+                # checked here, as the layers may be extracted ahead, or computed in the workers
+                if deadline is not None and time.monotonic() > deadline:
+                    logger.info("Out of time, stopping the analysis")
+                    break
                 
-                if ww_layer.evals is not None:
-                    self.apply_fit_powerlaw(ww_layer, params)
-                    if params['mp_fit']:
-                        logger.info("MP Fitting Layer: {} {} ".format(ww_layer.layer_id, ww_layer.name)) 
-                        self.apply_mp_fit(ww_layer, random=False, params=params)
+                if not ww_layer.skipped and ww_layer.has_weights:
+                    logger.info("LAYER: {} {}  : {}".format(ww_layer.layer_id, ww_layer.the_type, type(ww_layer.layer)))
                     
-                    if params['randomize'] or params['mp_fit']:
-                        logger.info("Randomizing Layer: {} {} ".format(ww_layer.layer_id, ww_layer.name))
-                        self.apply_random_esd(ww_layer, params)
-                        logger.info("MP Fitting Random layer: {} {} ".format(ww_layer.layer_id, ww_layer.name)) 
-                        self.apply_mp_fit(ww_layer, random=True, params=params)
+                    if ww_layer.evals is None:
+                        self.apply_normalize_Wmats(ww_layer, params)
+                        self.apply_esd(ww_layer, params)
                     
-                    self.apply_norm_metrics(ww_layer, params)
+                    if tracker is not None:
+                        tracker.account(ww_layer)
+                        self.release_weights(ww_layer, params)
+                        tracker.account(ww_layer)
                     
-                # TODO: add find correlation traps here
-                details = details.append(ww_layer.get_row(), ignore_index=True)
-
+                    if ww_layer.evals is not None:
+                        self.apply_spectral_metrics(ww_layer, params)
+                        
+                    if tracker is not None:
+                        peak = tracker.peak()
+                        tracker.check(ww_layer, peak)
+                        ww_layer.add_column('peak_memory', peak)
+                        ww_layer.release()
+                        
+                    # TODO: add find correlation traps here
+                    details = details.append(ww_layer.get_row(), ignore_index=True)
+                
+                if tracker is not None:
+                    tracker.reset()
+        finally:
+            # stops the prefetch thread, and drops the layers in flight in the workers
+            if hasattr(layer_iterator, 'close'):
+                layer_iterator.close()
+
+        if priority is not None:
+            details = details.sort_values('layer_id', kind='stable').reset_index(drop=True)
+        
+        done = set(details.layer_id)
+        skipped = [ww_layer.layer_id for ww_layer in candidates if ww_layer.layer_id not in done]
+        if skipped:
+            logger.warning("{} layers skipped, out of time: {}".format(len(skipped), skipped))
+            
         self.details = details
+        self.skipped_layers = sorted(skipped)
         return details
     
+    def analyze_sweep(self, model=None, configs=[], layers=[], stacked=False, min_evals=0, max_evals=None, 
+                      plot=False, randomize=False, mp_fit=False, conv2d_fft=False, fit_bulk=False, ww2x=False, 
+                      workers=None, fft_grid=None, adapter_delta=False, precision=PRECISION.FLOAT64, glorot_check=False, 
+                      seed=None):
+        """
+        Analyze the weight matrices of a model for several normalization settings, decomposing each layer only once.
+        
+        configs:
+            List of dicts of the normalization params of analyze(): normalize, glorot_fix and conv2d_norm 
+            (missing params take the analyze() defaults).  These only rescale the eigenvalues, 
+            so the ESD of each layer is computed once, unnormalized, and scaled for each config
+        stacked:
+            Return a single details dataframe, with a config column (the index of the config in configs), 
+            instead of the list of details dataframes, one per config (default False)
+            
+        The other params are the same as in analyze(), and shared by all the configs
+        """
+        import pandas as pd
+
+        catalog = self.layer_catalog(model)
+        model = catalog.model
+        
+        params = make_params(min_evals=min_evals, max_evals=max_evals, randomize=randomize, mp_fit=mp_fit, ww2x=ww2x, 
+                             workers=workers, max_memory=None, conv2d_fft=conv2d_fft and not ww2x, fft_grid=fft_grid, 
+                             adapter_delta=adapter_delta, precision=precision, glorot_check=glorot_check, seed=seed)
+        
+        # the ESDs are computed once, with no normalization
+        raw_params = make_params(params, normalize=False, glorot_fix=False, conv2d_norm=False, plot=False)
+        
+        sweep = []
+        for config in configs:
+            unknown = [key for key in config if key not in SWEEP_PARAMS]
+            if unknown:
+                logger.warning("params {} can not be swept, ignored".format(unknown))
+            options = dict(normalize=False, glorot_fix=False, conv2d_norm=True, plot=plot)
+            options.update({key: value for key, value in config.items() if key in SWEEP_PARAMS})
+            sweep.append(make_params(params, **options))
+        
+        logger.info("sweep params {}".format(sweep))
+        if not self.valid_params(raw_params):
+            logger.error("Error, params not valid: \n {}".format(raw_params))
+   
+        if ww2x:
+            layer_iterator = WW2xSliceIterator(model, filters=layers, params=raw_params, catalog=catalog)     
+        else:
+            layer_iterator = WWLayerIterator(model, filters=layers, params=raw_params, catalog=catalog)     
+        
+        if workers and workers > 1:
+            logger.info("Computing the ESDs with {} worker processes".format(workers))
+            layer_iterator = self.parallel_esd_iter_(layer_iterator, raw_params)
+        
+        rows = [[] for config_params in sweep]
+        for ww_layer in layer_iterator:
+            if ww_layer.skipped or not ww_layer.has_weights:
+                continue
+            
+            logger.info("LAYER: {} {}  : {}".format(ww_layer.layer_id, ww_layer.the_type, type(ww_layer.layer)))
+            if ww_layer.evals is None:
+                self.apply_normalize_Wmats(ww_layer, raw_params)
+                self.apply_esd(ww_layer, raw_params)
+                
+            if (randomize or mp_fit) and ww_layer.rand_evals is None:
+                self.apply_random_esd(ww_layer, raw_params)
+                
+            for config_rows, config_params in zip(rows, sweep):
+                scaled = self.scaled_layer(ww_layer, config_params)
+                self.apply_spectral_metrics(scaled, config_params)
+                config_rows.append(scaled.get_row())
+        
+        # a single append per config, row by row appends are quadratic in the number of layers
+        sweep_details = [pd.DataFrame(columns=['layer_id', 'name']).append(config_rows, ignore_index=True) 
+                         for config_rows in rows]
+        if stacked:
+            for config_id, details in enumerate(sweep_details):
+                details['config'] = config_id
+            return pd.concat(sweep_details, ignore_index=True)
+        
+        return sweep_details
+    
+    async def analyze_iter_async(self, model=None, layers=[], min_evals=0, max_evals=None, normalize=False, 
+                                 glorot_fix=False, randomize=False, mp_fit=False, conv2d_fft=False, conv2d_norm=True, 
+                                 fft_grid=None, adapter_delta=False, precision=PRECISION.FLOAT64, glorot_check=False, 
+                                 seed=None, executor=None, max_concurrency=1, layer_timeout=None):
+        """
+        Async generator over the details rows (dicts) of the layers of a model, in layer order, for asyncio applications.
+        The model is loaded, and the weights extraction, ESD and fits of each layer are run in an executor, 
+        so the event loop is never blocked.
+        
+        executor:
+            concurrent.futures Executor the layers are run in (default None, the default executor of the event loop). 
+            An executor shared by all the analyses of a service limits the threads they use in total
+        max_concurrency:
+            Maximum number of layers of this analysis running at once in the executor (default 1)
+        layer_timeout:
+            Time limit, in seconds, of each layer, from the time it starts running (default None, no limit).  
+            The layers which time out are skipped, with a warning.  A layer already running can not be interrupted,
+            it is finished in the background, and its result is dropped.  It keeps its slot (of max_concurrency) 
+            until it is finished, so the timed out layers do not pile up in the executor
+            
+        The other params are the same as in analyze().  plot, ww2x, workers, max_memory and prefetch are not supported.
+        Cancelling the task consuming the generator (or closing it) cancels the layers not started yet
+        """
+        import asyncio
+        from collections import deque
+        
+        loop = asyncio.get_running_loop()
+        catalog = await loop.run_in_executor(executor, self.layer_catalog, model)
+        
+        params = make_params(min_evals=min_evals, max_evals=max_evals, normalize=normalize, glorot_fix=glorot_fix, 
+                             randomize=randomize, mp_fit=mp_fit, conv2d_fft=conv2d_fft, conv2d_norm=conv2d_norm, 
+                             fft_grid=fft_grid, adapter_delta=adapter_delta, precision=precision, 
+                             glorot_check=glorot_check, seed=seed, plot=False)
+        
+        logger.info("params {}".format(params))
+        if not self.valid_params(params):
+            logger.error("Error, params not valid: \n {}".format(params))
+        
+        # only the metadata of the layers is read here, the weights are extracted in the executor
+        layer_iterator = WWLayerIterator(catalog.model, filters=layers, params=params, catalog=catalog, metadata_only=True)
+        
+        # running layers, a slot is released when the thread of the layer is done, not when it times out
+        slots = asyncio.Semaphore(max_concurrency)
+        
+        def release(future):
+            slots.release()
+            if not future.cancelled():
+                # the errors of the layers which timed out are dropped, with their result
+                future.exception()
+        
+        async def run_layer(ww_layer):
+            await slots.acquire()
+            future = loop.run_in_executor(executor, self.analyze_layer_, ww_layer, params)
+            future.add_done_callback(release)
+            try:
+                # shielded, so the future is only done when the thread is
+                return await asyncio.wait_for(asyncio.shield(future), layer_timeout)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except asyncio.TimeoutError:
+                logger.warning("Layer {} {} timed out after {}s, skipped".format(ww_layer.layer_id, ww_layer.name, layer_timeout))
+                return None
+        
+        pending = deque()
+        try:
+            for ww_layer in layer_iterator:
+                if ww_layer.skipped or not ww_layer.has_weights:
+                    continue
+                    
+                pending.append(asyncio.ensure_future(run_layer(ww_layer)))
+                while len(pending) >= max_concurrency:
+                    row = await pending.popleft()
+                    if row is not None:
+                        yield row
+                        
+            while pending:
+                row = await pending.popleft()
+                if row is not None:
+                    yield row
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def analyze_async(self, model=None, layers=[], **kwargs):
+        """Same as analyze(), for asyncio applications: returns the details dataframe, without blocking the event loop.
+        The details are not kept by the WeightWatcher (use get_summary(details)).  
+        The params are those of analyze_iter_async()"""
+        import pandas as pd
+        
+        rows = [row async for row in self.analyze_iter_async(model, layers, **kwargs)]
+        return pd.DataFrame(columns=['layer_id', 'name']).append(rows, ignore_index=True)
+    
+    def analyze_layer_(self, ww_layer, params=DEFAULT_PARAMS):
+        """Extract the weights of a (metadata only) layer, compute its ESD, randomized ESD and metrics, 
+        and release its weights.  Returns the details row of the layer, None if it has no weights"""
+        
+        ww_layer.make_weights()
+        if not ww_layer.has_weights:
+            return None
+        
+        self.apply_normalize_Wmats(ww_layer, params)
+        self.apply_esd(ww_layer, params)
+        self.release_weights(ww_layer, params)
+        self.apply_spectral_metrics(ww_layer, params)
+            
+        row = ww_layer.get_row()
+        ww_layer.release()
+        return row
+    
+    def release_weights(self, ww_layer, params=DEFAULT_PARAMS):
+        """Drop the weights and matrices of the layer once its ESD is computed. 
+        The randomized ESD also needs the matrices, so it is computed first, if needed"""
+        
+        if (params['randomize'] or params['mp_fit']) and ww_layer.rand_evals is None \
+                and (len(ww_layer.Wmats) > 0 or ww_layer.factors is not None):
+            logger.info("Randomizing Layer: {} {} ".format(ww_layer.layer_id, ww_layer.name))
+            self.apply_random_esd(ww_layer, params)
+            
+        ww_layer.weights, ww_layer.biases, ww_layer.Wmats, ww_layer.factors = None, None, [], None
+        return ww_layer
+    
+    def apply_spectral_metrics(self, ww_layer, params=DEFAULT_PARAMS):
+        """Fit the ESD of the layer and compute the metrics that depend on it, once the eigenvalues are available"""
+        
+        self.apply_fit_powerlaw(ww_layer, params)
+        if params['mp_fit']:
+            logger.info("MP Fitting Layer: {} {} ".format(ww_layer.layer_id, ww_layer.name)) 
+            self.apply_mp_fit(ww_layer, random=False, params=params)
+        
+        if params['randomize'] or params['mp_fit']:
+            if ww_layer.rand_evals is None:
+                logger.info("Randomizing Layer: {} {} ".format(ww_layer.layer_id, ww_layer.name))
+                self.apply_random_esd(ww_layer, params)
+            logger.info("MP Fitting Random layer: {} {} ".format(ww_layer.layer_id, ww_layer.name)) 
+            self.apply_mp_fit(ww_layer, random=True, params=params)
+        
+        self.apply_norm_metrics(ww_layer, params)
+        
+        return ww_layer
+    
+    def layer_cost(self, ww_layer, params=DEFAULT_PARAMS):
+        """Estimated cost (flops of the SVDs) of the ESD of a layer, from its metadata"""
+        
+        if ww_layer.rank and params.get('adapter_delta'):
+            return ww_layer.N * ww_layer.rank**2
+        return ww_layer.rf * ww_layer.N * ww_layer.M**2
+    
+    def prioritize(self, layers, params=DEFAULT_PARAMS):
+        """Sort the layers in the order of params['priority'], see analyze()"""
+        
+        priority = params.get('priority')
+        if priority is None or priority == PRIORITY.LAYER_ORDER:
+            return layers
+        elif priority == PRIORITY.LARGEST:
+            key = lambda ww_layer: -self.layer_cost(ww_layer, params)
+        elif priority == PRIORITY.SMALLEST:
+            key = lambda ww_layer: self.layer_cost(ww_layer, params)
+        else:
+            # highest score first, the layers without a score last
+            key = lambda ww_layer: -priority.get(ww_layer.layer_id, -np.inf)
+            
+        return sorted(layers, key=key)
+    
+    def svd_rate_(self, size=256, repeats=3):
+        """Time per unit of cost (see layer_cost()) of the SVD of a random size x size matrix, on this machine.  
+        Timed once per WeightWatcher, the fastest of a few repeats, so a noisy timing is not extrapolated to large layers"""
+        
+        import time
+        
+        if self.svd_rate is None:
+            W = np.random.default_rng(0).standard_normal((size, size))
+            times = []
+            for _ in range(repeats):
+                start = time.monotonic()
+                np.linalg.svd(W, compute_uv=False)
+                times.append(time.monotonic() - start)
+            self.svd_rate = min(times) / size**3
+            
+        return self.svd_rate
+    
+    def prioritized_iter_(self, layer_iterator, params=DEFAULT_PARAMS, deadline=None, skipped=None):
+        """Generator over the layers of a metadata only layer_iterator, in the order of priority (see prioritize()). 
+        The weights of each layer are extracted when it is started.
+        
+        If a deadline (time.monotonic()) is given, the time of each layer is predicted from its cost (see layer_cost()) 
+        and the time per unit of cost of the layers done so far (of an SVD, see svd_rate_(), until a layer is done).  
+        The layers predicted to finish after the deadline (and all the layers, once it is passed) are skipped, 
+        and their ids added to skipped"""
+        
+        import time
+        
+        if skipped is None:
+            skipped = []
+        layers = [ww_layer for ww_layer in layer_iterator if not ww_layer.skipped and ww_layer.has_weights]
+        
+        # so that a layer too large for the time budget is skipped, even if it is the first one
+        rate = self.svd_rate_() if deadline is not None else 0.0
+        
+        done_cost, done_time = 0, 0.0
+        for ww_layer in self.prioritize(layers, params):
+            start = time.monotonic()
+            cost = self.layer_cost(ww_layer, params)
+            
+            if deadline is not None:
+                predicted = cost * done_time / done_cost if done_cost > 0 else cost * rate
+                if start + predicted > deadline:
+                    logger.info("skipping layer {} {}, out of time".format(ww_layer.layer_id, ww_layer.name))
+                    skipped.append(ww_layer.layer_id)
+                    continue
+                
+            ww_layer.make_weights()
+            yield ww_layer
+            
+            # the layer is done when the next one is asked for
+            done_cost += cost
+            done_time += time.monotonic() - start
+    
+    def prefetch_iter_(self, layer_iterator, params=DEFAULT_PARAMS):
+        """Generator over the layers of layer_iterator, which are extracted (weights copied to numpy, and sliced) 
+        in a background thread, up to prefetch layers ahead of the layer being analyzed.
+        
+        The layers are passed through a bounded queue, so at most prefetch extracted layers (and the one being extracted) 
+        are kept in memory.  Errors in the background thread are raised here, and the thread stops 
+        when the generator is closed"""
+        
+        import queue
+        import threading
+        
+        layers = queue.Queue(maxsize=params['prefetch'])
+        stop = threading.Event()
+        done = object()
+        
+        def put(item):
+            # wait for a free slot, unless the generator has been closed
+            while not stop.is_set():
+                try:
+                    layers.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def extract():
+            try:
+                for ww_layer in layer_iterator:
+                    if not put(ww_layer):
+                        return
+                put(done)
+            except Exception as error:
+                put(error)
+                
+        thread = threading.Thread(target=extract, name="weightwatcher-prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = layers.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+    
+    def parallel_esd_iter_(self, layer_iterator, params=DEFAULT_PARAMS):
+        """Generator that computes the ESD of each layer in a pool of worker processes, and yields the layers in order.
+        
+        The weight matrices are written once into a memory mapped WeightArena, 
+        and the workers only receive the offsets, shapes and dtypes of the matrices. 
+        The layers drop their weights as soon as they are in the arena, and at most 2 x workers layers are in flight"""
+        
+        import multiprocessing
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
+        
+        workers = params['workers']
+        max_pending = 2 * workers
+        max_memory = params.get('max_memory')
+        pending = deque()
+        
+        def finish(ww_layer, future, block):
+            if future is None:
+                # computed in process
+                return ww_layer
+            try:
+                evals, sv_max, rank_loss, rand_evals = future.result()
+            finally:
+                arena.release(block)
+            self.set_esd(ww_layer, evals, sv_max, rank_loss)
+            if rand_evals is not None:
+                self.set_random_esd(ww_layer, rand_evals, params)
+            return ww_layer
+        
+        context = multiprocessing.get_context("spawn")
+        with WeightArena() as arena, ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            try:
+                for ww_layer in layer_iterator:
+                    if ww_layer.skipped or not ww_layer.has_weights:
+                        continue
+                    
+                    self.apply_normalize_Wmats(ww_layer, params)
+                
+                    # the ESDs of a low rank update (from the factors) and of sparse matrices are cheap, and computed in process,
+                    # and out of core matrices are not copied to the arena
+                    if (ww_layer.factors is not None and len(ww_layer.Wmats) == 0) or ww_layer.sparse or ww_layer.out_of_core:
+                        self.apply_esd(ww_layer, params)
+                        pending.append((ww_layer, None, None))
+                        while len(pending) >= max_pending:
+                            yield finish(*pending.popleft())
+                        continue
+                
+                    # keep the matrices in flight under the memory budget, but always allow one layer
+                    if max_memory:
+                        nbytes = sum([W.nbytes for W in ww_layer.Wmats])
+                        while pending and sum([p[2].nbytes() for p in pending if p[2] is not None]) + nbytes > max_memory:
+                            yield finish(*pending.popleft())
+                
+                    block = arena.put(ww_layer.Wmats)
+                    kernel_size = ww_layer.kernel_size if ww_layer.the_type == LAYER_TYPE.CONV2D else None
+                    future = pool.submit(arena_eigenvalues, block, ww_layer.N, ww_layer.M, ww_layer.num_components, dict(params), 
+                                         kernel_size, ww_layer.random_key())
+                
+                    # the arena holds the only copy the workers need
+                    ww_layer.weights, ww_layer.Wmats, ww_layer.factors = None, [], None
+                    pending.append((ww_layer, future, block))
+                
+                    while len(pending) >= max_pending:
+                        yield finish(*pending.popleft())
+                    
+                while pending:
+                    yield finish(*pending.popleft())
+            finally:
+                # closed early (i.e. out of time): the pool only waits for the layers already running
+                for ww_layer, future, block in pending:
+                    if future is not None:
+                        future.cancel()
+    
     def get_details(self):
         """get the current details, created by analyze"""
         return self.details
     
+    def get_skipped_layers(self):
+        """get the ids of the layers skipped by the last analyze, out of time (see time_budget)"""
+        return self.skipped_layers
+    
     def get_summary(self, details=None):
         """Return metric averages, as dict, if available """
         
@@ -1023,20 +1687,18 @@ class WeightWatcher(object):
         """
         Same as analyze() , but does not run the ESD or Power law fits
         
+        All the columns are derived from the shapes of the weights (in the layer catalog), the weights are never read
         """
+        import pandas as pd
 
-        model = model or self.model    
+        catalog = self.layer_catalog(model)
+        model = catalog.model
         
         if min_size or max_size:
             logger.warn("min_size and max_size options changed to min_evals, max_evals, ignored for now")     
         
-        params = DEFAULT_PARAMS
-        params['min_evals'] = min_evals
-        params['max_evals'] = max_evals
-        params['plot'] = plot
-        params['normalize'] = normalize
-        params['glorot_fix'] = glorot_fix
-        params['conv2d_norm'] = conv2d_norm 
+        params = make_params(min_evals=min_evals, max_evals=max_evals, plot=plot, mp_fit=mp_fit, randomize=False,
+                             normalize=normalize, glorot_fix=glorot_fix, conv2d_norm=conv2d_norm, ww2x=ww2x)
             
         logger.info("params {}".format(params))
         if not self.valid_params(params):
@@ -1044,20 +1706,21 @@ class WeightWatcher(object):
    
         if ww2x:
             logger.info("Using weightwatcher 0.2x style layer and slice iterator")
-            layer_iterator = WW2xSliceIterator(model, filters=layers, params=params)     
+            layer_iterator = WW2xSliceIterator(model, filters=layers, params=params, catalog=catalog, metadata_only=True)     
         else:
-            layer_iterator = WWLayerIterator(model, filters=layers, params=params)  
+            layer_iterator = WWLayerIterator(model, filters=layers, params=params, catalog=catalog, metadata_only=True)  
    
         
-        details = pd.DataFrame(columns=['layer_id', 'name'])
-           
+        rows = []
         for ww_layer in layer_iterator:
             if not ww_layer.skipped and ww_layer.has_weights:
                 logger.debug("LAYER TYPE: {} {}  layer type {}".format(ww_layer.layer_id, ww_layer.the_type, type(ww_layer.layer)))
-                logger.debug("weights shape : {}  max size {}".format(ww_layer.weights.shape, params['max_evals']))
+                logger.debug("N {} M {} rf {}  max size {}".format(ww_layer.N, ww_layer.M, ww_layer.rf, params['max_evals']))
                 ww_layer.add_column('num_evals', ww_layer.M * ww_layer.rf)
-                details = details.append(ww_layer.get_row(), ignore_index=True)
+                rows.append(ww_layer.get_row())
 
+        # a single append, row by row appends are quadratic in the number of layers
+        details = pd.DataFrame(columns=['layer_id', 'name']).append(rows, ignore_index=True)
         return details
 
     def valid_params(self, params):
@@ -1083,6 +1746,31 @@ class WeightWatcher(object):
         elif max_evals and max_evals < -1:
             logger.warn(" max_evals {} < -1 ".format(max_evals))
             valid = False
+            
+        max_memory = params.get('max_memory')
+        if max_memory is not None and max_memory <= 0:
+            logger.warn(" max_memory {} <= 0 ".format(max_memory))
+            valid = False
+            
+        prefetch = params.get('prefetch')
+        if prefetch is not None and prefetch < 0:
+            logger.warn(" prefetch {} < 0 ".format(prefetch))
+            valid = False
+            
+        time_budget = params.get('time_budget')
+        if time_budget is not None and time_budget <= 0:
+            logger.warn(" time_budget {} <= 0 ".format(time_budget))
+            valid = False
+            
+        priority = params.get('priority')
+        if isinstance(priority, str) and priority not in [PRIORITY.LAYER_ORDER, PRIORITY.LARGEST, PRIORITY.SMALLEST]:
+            logger.warn("param priority unknown, ignoring {}".format(priority))
+            valid = False
+            
+        precision = params.get('precision')
+        if precision and precision not in [PRECISION.FLOAT64, PRECISION.FLOAT32, PRECISION.AUTO]:
+            logger.warn("param precision unknown, using float64 {}".format(precision))
+            valid = False
         
         return valid
     
@@ -1098,57 +1786,23 @@ class WeightWatcher(object):
 #         return self.details
     
     
- # not used yet   
-    def get_conv2D_fft(self, W, n=32):
-        """Compute FFT of Conv2D channels, to apply SVD later"""
-        
-        logger.info("get_conv2D_fft on W {}".format(W.shape))
-
-        # is pytorch or tensor style 
-        s = W.shape
-        logger.debug("    Conv2D SVD ({}): Analyzing ...".format(s))
-
-        N, M, imax, jmax = s[0], s[1], s[2], s[3]
-        # probably better just to check what col N is in 
-        if N + M >= imax + jmax:
-            logger.debug("[2,3] tensor shape detected: {}x{} (NxM), {}x{} (i,j)".format(N, M, imax, jmax))    
-            fft_axes = [2, 3]
-        else:
-            N, M, imax, jmax = imax, jmax, N, M          
-            fft_axes = [0, 1]
-            logger.debug("[1,2] tensor shape detected: {}x{} (NxM), {}x{} (i,j)".format(N, M, imax, jmax))
-
-        # Switch N, M if in wrong order
-        if N < M:
-            M, N = N, M
-
-        #  receptive_field / kernel size
-        rf = np.min([imax, jmax])
-        # aspect ratio
-        Q = N / M 
-        # num non-zero eigenvalues  rf is receptive field size (sorry calculated again here)
-        n_comp = rf * N * M
-        
-        logger.info("N={} M={} n_comp {} ".format(N, M, n_comp))
-
-        # run FFT on each channel
-        fft_grid = [n, n]
-        fft_coefs = np.fft.fft2(W, fft_grid, axes=fft_axes)
-        
-        return [fft_coefs], N, M, n_comp
-
     # not used
     def normalize_evals(self, evals, N, M):
         """Normalizee evals matrix by 1/N"""
         logger.debug(" normalzing evals, N, M {},{},{}".format(N, M))
         return evals / N
 
+    def glorot_norm(self, N, M, rf_size):
+        """Scale of the Glorot Normalization Fix, 1/kappa"""
+        
+        kappa = np.sqrt(2 / ((N + M) * rf_size))
+        return 1 / kappa
+
     def glorot_norm_fix(self, W, N, M, rf_size):
         """Apply Glorot Normalization Fix """
 
-        kappa = np.sqrt(2 / ((N + M) * rf_size))
-        W = W / kappa
-        return W , 1/kappa
+        norm = self.glorot_norm(N, M, rf_size)
+        return W * norm, norm
 
     def pytorch_norm_fix(self, W, N, M, rf_size):
         """Apply pytorch Channel Normalization Fix
@@ -1165,7 +1819,7 @@ class WeightWatcher(object):
         """Check if this layer needs Glorot Normalization Fix"""
 
         kappa = np.sqrt(2 / ((N + M) * rf_size))
-        norm = np.linalg.norm(W)
+        norm = matrix_norm(W)
 
         check1 = norm / np.sqrt(N * M)
         check2 = norm / (kappa * np.sqrt(N * M))
@@ -1180,45 +1834,18 @@ class WeightWatcher(object):
             else:
                 return check1, False
     
-    def random_eigenvalues(self, Wmats, n_comp, num_replicas=1, params=DEFAULT_PARAMS):
+    def random_eigenvalues(self, Wmats, n_comp, num_replicas=1, params=DEFAULT_PARAMS, layer_key=(0,)):
         """Compute the eigenvalues for all weights of the NxM skipping layer, num evals ized weight matrices (N >= M), 
             combined into a single, sorted, numpy array.  
     
-        see: combined_eigenvalues()
+        see: spectrum.random_eigenvalues()
         
          """
-         
-        normalize = params['normalize']
-        glorot_fix = params['glorot_fix']
-        conv2d_norm = params['conv2d_norm']  # True
-         
-        all_evals = []
-
-        logger.info("generating {} replicas for each W of the random eigenvalues".format(num_replicas))
-        for num in range(num_replicas):
-            count = len(Wmats)
-            for  W in Wmats:
-    
-                M, N = np.min(W.shape), np.max(W.shape)
-                Q = N / M
-               
-                Wrand = W.flatten()
-                np.random.shuffle(Wrand)
-                W = Wrand.reshape(W.shape)
-                W = W.astype(float)
-                logger.debug("Running Randomized Full SVD")
-                sv = np.linalg.svd(W, compute_uv=False)
-                sv = sv.flatten()
-                sv = np.sort(sv)[-n_comp:]    
-                
-                # sv = svd.singular_values_
-                evals = sv * sv 
-                all_evals.extend(evals)
-                                       
-        return np.sort(np.array(all_evals))
+        return random_eigenvalues(Wmats, n_comp, num_replicas, params, layer_key)
    
     def plot_random_esd(self, ww_layer, params=DEFAULT_PARAMS):
         """Plot histogram and log histogram of ESD and randomized ESD"""
+        import matplotlib.pyplot as plt
           
         evals = ww_layer.evals
         rand_evals = ww_layer.rand_evals
@@ -1263,6 +1890,7 @@ class WeightWatcher(object):
             if xmax is 'auto' or None, xmax = np.max(evals)
                      
          """
+        import powerlaw
              
         num_evals = len(evals)
         logger.debug("fitting power law on {} eigenvalues".format(num_evals))
@@ -1302,6 +1930,7 @@ class WeightWatcher(object):
         num_pl_spikes = len(evals[evals>=fit.xmin])
 
         if plot:
+            import matplotlib.pyplot as plt
             fig2 = fit.plot_pdf(color='b', linewidth=2)
             fit.power_law.plot_pdf(color='b', linestyle='--', ax=fig2)
             fit.plot_ccdf(color='r', linewidth=2, ax=fig2)
@@ -1346,29 +1975,23 @@ class WeightWatcher(object):
     def get_ESD(self, model=None, layer=None, params=DEFAULT_PARAMS):
         """Get the ESD (empirical spectral density) for the layer, specified by id or name)"""
         
-        model = self.model or model
+        catalog = self.layer_catalog(model)
         
-        details = self.describe(model=model)
-        layer_ids = details['layer_id'].to_numpy()
-        layer_names = details['name'].to_numpy()
-        
-        if type(layer) is int and layer not in layer_ids:
-            logger.error("Can not find layer id {} in valid layer_ids {}".format(layer, layer_ids))
-            return []
-        
-        elif type(layer) is str and layer not in layer_names:
-            logger.error("Can not find layer name {} in valid layer_names {}".format(layer, layer_names))
+        if catalog.get(layer) is None:
+            logger.error("Can not find layer {} in the model".format(layer))
             return []
     
         logger.info("Getting ESD for layer {} ".format(layer))
 
-        layer_iter = WWLayerIterator(model=model, filters=[layer], params=params)     
-        details = pd.DataFrame(columns=['layer_id', 'name'])
+        layer_iter = WWLayerIterator(model=catalog.model, filters=[layer], params=params, catalog=catalog)     
            
-        ww_layer = next(layer_iter)
-        assert(not ww_layer.skipped) 
-        assert(ww_layer.has_weights)
+        ww_layer = next(layer_iter, None)
+        if ww_layer is None:
+            logger.error("Layer {} is not supported".format(layer))
+            return []
         
+        if ww_layer.factors is not None:
+            self.apply_factors(ww_layer, params)
         self.apply_esd(ww_layer, params)
             
         esd = ww_layer.evals
@@ -1471,6 +2094,7 @@ class WeightWatcher(object):
             
             #Even if the quarter circle applies, still plot the MP_fit
             if plot:
+                import matplotlib.pyplot as plt
                 plot_density(to_plot, s1, Q, method = "MP")
                 plt.legend([r'$\rho_{emp}(\lambda)$', 'MP fit'])
                 plt.title("MP ESD, sigma auto-fit ")
@@ -1484,6 +2108,7 @@ class WeightWatcher(object):
                               Q=Q, num_spikes=0, sigma=s1, verbose = False, plot=plot)
         
         if plot:
+            import matplotlib.pyplot as plt
             title = fit_law+" "+title+"\n Q={:0.3} ".format(Q)
             title = title + r"$\sigma_{mp}=$"+"{:0.3} ".format(sigma_mp)
             title = title + r"$\mathcal{R}_{mp}=$"+"{:0.3} ".format(mp_softrank)